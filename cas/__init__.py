@@ -6,4 +6,4 @@ import cas.log
 import cas.util
 import cas.files
 
-from cas.storage import CAS, CASLocked
+from cas.storage import CAS, CASLocked, CASReadOnly, AmbiguousSum
@@ -0,0 +1,440 @@
+"""
+Benchmarks of the storage operations, at scales from a thousand to a
+million objects.
+
+A run generates a synthetic corpus (the object count, size distribution
+and how many distinct meta values there are are all configurable), adds it
+to a fresh store and then times each scenario against that store, writing
+throughput and latency percentiles as JSON. ``compare`` reads two such
+files, say from before and after a change, and reports the scenarios that
+got slower:
+
+    $ python -m cas.bench run --scale 100k -o after.json
+    $ python -m cas.bench compare before.json after.json
+"""
+
+from cas.config import CAS_INDEX_BACKEND, CAS_BATCH_SIZE, CAS_WORKERS, CAS_HASH
+from cas.storage import CAS
+from cas.files import CASFileType, register_type, InvalidFileType
+from cas.index import BACKENDS
+from cas.hashes import HASHES
+import cas
+import click
+import subprocess
+import platform
+import datetime
+import tempfile
+import shutil
+import random
+import json
+import math
+import time
+import sys
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+FORMAT = 1
+
+SCALES = {
+  '1k': 1000,
+  '100k': 100000,
+  '1m': 1000000,
+}
+
+SIZE_DISTRIBUTIONS = ['fixed', 'uniform', 'lognormal']
+
+SCENARIOS = ['add_many', 'open', 'add', 'has_sum', 'list', 'match', 'query',
+  'remove', 'gc']
+
+class BenchType(CASFileType):
+    """
+    Corpus objects, which start with a line of their ``key=value`` meta
+    """
+    type = 'bench'
+
+    def verify(self):
+        with open(self.filename) as fd:
+            if not fd.readline().startswith('bench '):
+                raise InvalidFileType(self.filename, self.type)
+
+    def meta(self):
+        with open(self.filename) as fd:
+            return dict(word.split('=', 1) for word in fd.readline().split() if '=' in word)
+
+register_type(BenchType)
+
+class Corpus(object):
+    """
+    ``count`` reproducible objects (for a given ``seed``), of around
+    ``size`` bytes each, with ``keys`` meta keys of ``cardinality`` values
+    each
+    """
+    def __init__(self, count, size=4096, distribution='lognormal', keys=3,
+                 cardinality=100, seed=0):
+        if distribution not in SIZE_DISTRIBUTIONS:
+            raise ValueError('invalid size distribution "%s", must be one of: %s' %
+              (distribution, ', '.join(SIZE_DISTRIBUTIONS)))
+        self.count = count
+        self.size = size
+        self.distribution = distribution
+        self.keys = keys
+        self.cardinality = cardinality
+        self.seed = seed
+
+    def params(self):
+        return {
+          'count': self.count,
+          'size': self.size,
+          'distribution': self.distribution,
+          'keys': self.keys,
+          'cardinality': self.cardinality,
+          'seed': self.seed,
+        }
+
+    def _size(self, rng):
+        if self.distribution == 'fixed':
+            return self.size
+        elif self.distribution == 'uniform':
+            return rng.randint(1, self.size * 2)
+        # a long tail of big objects, like most real artifact stores
+        return int(min(rng.lognormvariate(math.log(self.size), 1), self.size * 64))
+
+    def meta(self, rng):
+        return dict(('k%d' % key, 'v%d' % rng.randrange(self.cardinality))
+          for key in range(self.keys))
+
+    def objects(self, start=0, count=None):
+        """
+        Yield the data of objects ``start`` to ``start + count``. Each is
+        unique, since it includes its own number.
+        """
+        count = self.count - start if count is None else count
+        for i in xrange(start, start + count):
+            rng = random.Random('%d-%d' % (self.seed, i))
+            meta = ' '.join('%s=%s' % pair for pair in sorted(self.meta(rng).items()))
+            header = 'bench %s #%d\n' % (meta, i)
+            size = max(self._size(rng) - len(header), 0)
+            # random hex digits, so the filler compresses about as well as
+            # text (a bit under 2:1) and gives the chunker no repeats
+            filler = size and '%0*x' % (size, rng.getrandbits(4 * size)) or ''
+            yield header + filler
+
+    def write(self, directory, start=0, count=None):
+        """
+        Write objects to files under ``directory``, returning their paths
+        and total size
+        """
+        paths, total = [], 0
+        for i, data in enumerate(self.objects(start, count), start):
+            path = os.path.join(directory, '%03d' % (i % 1000), '%d' % i)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as fd:
+                fd.write(data)
+            paths.append(path)
+            total += len(data)
+        return paths, total
+
+def percentile(values, pct):
+    """
+    The nearest-rank ``pct`` percentile of sorted ``values``
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+def summarize(latencies, seconds=None, size=None):
+    """
+    Throughput and latency percentiles (in seconds) for a list of per
+    operation latencies, over ``seconds`` of wall time (by default their
+    sum) and ``size`` bytes
+    """
+    latencies = sorted(latencies)
+    seconds = sum(latencies) if seconds is None else seconds
+    result = {
+      'ops': len(latencies),
+      'seconds': seconds,
+      'ops_per_second': seconds and len(latencies) / seconds or None,
+      'latency': {
+        'mean': latencies and sum(latencies) / len(latencies) or None,
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies and latencies[-1] or None,
+      },
+    }
+    if size is not None:
+        result['bytes_per_second'] = seconds and size / seconds or None
+    return result
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+def revision():
+    """
+    The git revision of the code being benchmarked, if it is a checkout
+    """
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+          cwd=os.path.dirname(os.path.abspath(__file__)),
+          stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Bench(object):
+    """
+    Runs the scenarios against a store under ``workdir``, created with the
+    ``CAS`` keyword arguments ``options``. Scenarios that time individual
+    operations do ``sample`` of them.
+    """
+    def __init__(self, corpus, workdir, sample=1000, batch_size=CAS_BATCH_SIZE,
+                 workers=CAS_WORKERS, **options):
+        self.corpus = corpus
+        self.workdir = workdir
+        self.root = os.path.join(workdir, 'store')
+        self.corpusdir = os.path.join(workdir, 'corpus')
+        self.sample = max(min(sample, corpus.count), 1)
+        self.batch_size = batch_size
+        self.workers = workers
+        self.options = options
+        self.rng = random.Random(corpus.seed)
+        self.storage = None
+        self.sums = []
+
+    def params(self):
+        params = dict(self.options, sample=self.sample, batch_size=self.batch_size,
+          workers=self.workers)
+        params['corpus'] = self.corpus.params()
+        return params
+
+    def run(self, scenarios=SCENARIOS):
+        results = {}
+        try:
+            for scenario in SCENARIOS:
+                if scenario not in scenarios and scenario != 'add_many':
+                    continue
+                LOG.debug('running scenario %s' % scenario)
+                result = getattr(self, 'bench_' + scenario)()
+                if scenario in scenarios:
+                    results[scenario] = result
+        finally:
+            if self.storage is not None:
+                self.storage.unlock()
+                # and close the indices before the store is deleted
+                self.storage = None
+        return results
+
+    def bench_add_many(self):
+        """
+        Add the whole corpus in batches, which every other scenario needs
+        """
+        paths, size = self.corpus.write(self.corpusdir)
+        self.storage = CAS(self.root, **self.options)
+        latencies, last = [], time.time()
+        start = last
+        batch = 0
+        for sum in self.storage.add_many(paths, type=BenchType,
+                                         batch_size=self.batch_size, workers=self.workers):
+            self.sums.append(sum)
+            batch += 1
+            if batch == self.batch_size:
+                now = time.time()
+                latencies.append((now - last) / batch)
+                last, batch = now, 0
+        now = time.time()
+        if batch:
+            latencies.append((now - last) / batch)
+        shutil.rmtree(self.corpusdir)
+
+        # per object latencies are averaged over each batch
+        result = summarize(latencies, now - start, size)
+        result['ops'] = len(self.sums)
+        result['ops_per_second'] = len(self.sums) / (now - start)
+        return result
+
+    def bench_open(self):
+        self.storage.unlock()
+        latencies = []
+        for _ in range(min(self.sample, 20)):
+            start = time.time()
+            storage = CAS(self.root, **self.options)
+            latencies.append(time.time() - start)
+            storage.unlock()
+        self.storage = CAS(self.root, **self.options)
+        return summarize(latencies)
+
+    def bench_add(self):
+        objects = self.corpus.objects(self.corpus.count, self.sample)
+        latencies = []
+        for data in objects:
+            start = time.time()
+            self.sums.append(self.storage.add_bytes(data, type=BenchType))
+            latencies.append(time.time() - start)
+        return summarize(latencies)
+
+    def bench_has_sum(self):
+        # half hits, half misses
+        sums = self.rng.sample(self.sums, self.sample // 2 or 1)
+        sums += ['%040x' % self.rng.getrandbits(160) for _ in range(self.sample // 2)]
+        return summarize([timed(self.storage.has_sum, sum) for sum in sums])
+
+    def bench_list(self):
+        start = time.time()
+        count = sum(1 for _ in self.storage.list())
+        seconds = time.time() - start
+
+        # and pages of 1000 from random points
+        latencies = []
+        for after in self.rng.sample(self.sums, min(self.sample, 100)):
+            latencies.append(timed(lambda: list(self.storage.list(after=after, limit=1000))))
+        result = summarize(latencies)
+        result['full'] = {'items': count, 'seconds': seconds,
+          'items_per_second': seconds and count / seconds or None}
+        return result
+
+    def _random_pair(self):
+        key = 'k%d' % self.rng.randrange(max(self.corpus.keys, 1))
+        return key, 'v%d' % self.rng.randrange(self.corpus.cardinality)
+
+    def bench_match(self):
+        latencies = []
+        for _ in range(self.sample):
+            key, value = self._random_pair()
+            latencies.append(timed(lambda: list(self.storage.equals(key, value))))
+        return summarize(latencies)
+
+    def bench_query(self):
+        latencies = []
+        for _ in range(self.sample):
+            (k1, v1), (k2, v2) = self._random_pair(), self._random_pair()
+            expression = '%s=%s and not %s=%s' % (k1, v1, k2, v2)
+            latencies.append(timed(lambda: list(self.storage.query(expression))))
+        return summarize(latencies)
+
+    def bench_remove(self):
+        sums = self.rng.sample(self.sums, self.sample)
+        latencies = [timed(self.storage.remove, sum) for sum in sums]
+        removed = set(sums)
+        self.sums = [sum for sum in self.sums if sum not in removed]
+        return summarize(latencies)
+
+    def bench_gc(self):
+        return summarize([timed(self.storage.gc, full=True)])
+
+def run(corpus, scenarios=SCENARIOS, workdir=None, **kwargs):
+    """
+    Benchmark ``scenarios`` against ``corpus``, returning the report
+    """
+    tmpdir = tempfile.mkdtemp(prefix='cas-bench-', dir=workdir)
+    try:
+        bench = Bench(corpus, tmpdir, **kwargs)
+        started = datetime.datetime.now().isoformat()
+        results = bench.run(scenarios)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    return {
+      'format': FORMAT,
+      'version': cas.__version__,
+      'revision': revision(),
+      'python': platform.python_version(),
+      'platform': platform.platform(),
+      'started': started,
+      'params': bench.params(),
+      'scenarios': results,
+    }
+
+# measures where bigger is better, the rest are latencies
+THROUGHPUTS = ['ops_per_second', 'bytes_per_second']
+
+def compare(old, new, threshold=0.1):
+    """
+    Compare two reports, returning ``(scenario, measure, old, new, change,
+    regressed)`` for every measure they share, where ``change`` is the
+    relative change and ``regressed`` says whether it got worse by more
+    than ``threshold``
+    """
+    rows = []
+    for scenario in sorted(set(old['scenarios']) & set(new['scenarios'])):
+        before, after = old['scenarios'][scenario], new['scenarios'][scenario]
+        measures = [(m, before.get(m), after.get(m)) for m in THROUGHPUTS]
+        measures += [('latency.' + m, before['latency'].get(m), after['latency'].get(m))
+          for m in ['p50', 'p90', 'p99']]
+        for measure, a, b in measures:
+            if not a or b is None:
+                continue
+            change = (b - a) / float(a)
+            worse = measure in THROUGHPUTS and -change or change
+            rows.append((scenario, measure, a, b, change, worse > threshold))
+    return rows
+
+@click.group(name='cas-bench')
+@click.option('--debug', is_flag=True)
+def main(debug):
+    if debug:
+        from cas.log import enable_debug
+        enable_debug()
+
+@main.command(name='run')
+@click.option('--scale', type=click.Choice(sorted(SCALES, key=SCALES.get)),
+  help='Number of objects: 1k, 100k or 1m')
+@click.option('-n', '--count', type=int, metavar='N', help='Number of objects, overrides --scale')
+@click.option('--size', type=int, default=4096, metavar='BYTES', help='Typical object size')
+@click.option('--size-dist', type=click.Choice(SIZE_DISTRIBUTIONS), default='lognormal',
+  help='Distribution of object sizes around --size')
+@click.option('--keys', type=int, default=3, metavar='N', help='Meta keys per object')
+@click.option('--cardinality', type=int, default=100, metavar='N',
+  help='Distinct values of each meta key')
+@click.option('--seed', type=int, default=0)
+@click.option('--sample', type=int, default=1000, metavar='N',
+  help='Operations to time in each scenario')
+@click.option('-s', '--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+  help='Only run these scenarios (add_many always runs, to fill the store)')
+@click.option('--index', type=click.Choice(sorted(BACKENDS)), default=CAS_INDEX_BACKEND)
+@click.option('--hash', type=click.Choice(sorted(HASHES)), default=CAS_HASH)
+@click.option('--batch-size', type=int, default=CAS_BATCH_SIZE, metavar='N')
+@click.option('-j', '--jobs', type=int, default=CAS_WORKERS, metavar='N')
+@click.option('--pack-threshold', type=int, default=0, metavar='BYTES')
+@click.option('--bloom-filter', is_flag=True)
+@click.option('--workdir', metavar='DIRECTORY', help='Where to create the store and corpus')
+@click.option('-o', '--output', type=click.File('w'), default='-',
+  help='Write the JSON report here rather than to stdout')
+def run_command(scale, count, size, size_dist, keys, cardinality, seed, sample, scenarios,
+                index, hash, batch_size, jobs, pack_threshold, bloom_filter, workdir, output):
+    """
+    Benchmark the storage operations against a synthetic corpus
+    """
+    if count is None:
+        count = SCALES[scale or '1k']
+    corpus = Corpus(count, size, size_dist, keys, cardinality, seed)
+    report = run(corpus, scenarios or SCENARIOS, workdir, sample=sample,
+      batch_size=batch_size, workers=jobs, index=index, hash=hash,
+      pack_threshold=pack_threshold, bloom_filter=bloom_filter)
+    json.dump(report, output, sort_keys=True, indent=2)
+    output.write('\n')
+
+@main.command(name='compare')
+@click.argument('old', type=click.File('r'))
+@click.argument('new', type=click.File('r'))
+@click.option('-t', '--threshold', type=float, default=0.1, metavar='FRACTION',
+  help='Flag measures that got worse by more than FRACTION')
+def compare_command(old, new, threshold):
+    """
+    Compare two reports, exiting non-zero if anything regressed
+    """
+    rows = compare(json.load(old), json.load(new), threshold)
+    regressed = False
+    for scenario, measure, a, b, change, worse in rows:
+        click.echo('%-10s %-16s %14.6g %14.6g %+8.1f%%%s' % (scenario, measure, a, b,
+          change * 100, worse and '  REGRESSED' or ''))
+        regressed = regressed or worse
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+A Bloom filter over the stored sums, so that asking for a sum that isn't
+stored (the usual answer to "do we have this already?") can be answered
+from memory instead of with a ``stat`` through several directory levels.
+
+A filter never forgets a sum added to it, but it may claim to hold sums it
+doesn't (roughly ``error_rate`` of them), so only its negative answers can
+be trusted. Sums can't be taken back out, so removed objects are only
+forgotten when the filter is rebuilt.
+"""
+
+import hashlib
+import struct
+import math
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+MAGIC = 'cas-bloom'
+VERSION = 1
+
+class BloomFilter(object):
+    """
+    A filter sized to hold ``capacity`` sums with a false positive rate of
+    about ``error_rate``
+    """
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.error_rate = error_rate
+        self.size = max(int(math.ceil(-self.capacity * math.log(error_rate) /
+          math.log(2) ** 2)), 8)
+        self.hashes = max(int(round(float(self.size) / self.capacity * math.log(2))), 1)
+        self.count = 0
+        self._bits = bytearray((self.size + 7) // 8)
+
+    @classmethod
+    def from_sums(cls, sums, count, error_rate=0.01):
+        """
+        A filter holding ``sums``, with room for twice their ``count``
+        """
+        bloom = cls(max(count * 2, 1024), error_rate)
+        for sum in sums:
+            bloom.add(sum)
+        return bloom
+
+    def _positions(self, sum):
+        # double hashing, see Kirsch and Mitzenmacher, "Less Hashing, Same
+        # Performance"
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(sum).digest())
+        for i in xrange(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, sum):
+        for pos in self._positions(sum):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, sum):
+        for pos in self._positions(sum):
+            if not self._bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def save(self, filename):
+        """
+        Atomically write the filter to ``filename``
+        """
+        tmpfile = filename + '.new'
+        with open(tmpfile, 'wb') as fd:
+            fd.write('%s %d %d %r %d\n' % (MAGIC, VERSION, self.capacity,
+              self.error_rate, self.count))
+            fd.write(self._bits)
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.rename(tmpfile, filename)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        The filter saved to ``filename``, or ``None`` if there isn't a valid
+        one
+        """
+        try:
+            with open(filename, 'rb') as fd:
+                header = fd.readline().split()
+                if len(header) != 5 or header[0] != MAGIC or int(header[1]) != VERSION:
+                    LOG.debug('ignoring unknown bloom filter format in "%s"' % filename)
+                    return None
+                bloom = cls(int(header[2]), float(header[3]))
+                bloom.count = int(header[4])
+                bits = bytearray(fd.read())
+        except (IOError, ValueError), e:
+            LOG.debug('cannot load bloom filter from "%s": %s' % (filename, e))
+            return None
+
+        if len(bits) != len(bloom._bits):
+            LOG.debug('ignoring truncated bloom filter in "%s"' % filename)
+            return None
+        bloom._bits = bits
+        return bloom
@@ -0,0 +1,91 @@
+from cas.util import stat_key
+import shelve
+import threading
+import heapq
+import time
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# files modified this recently may be modified again within the same mtime
+# tick, without their stat key changing
+RACY_SECONDS = 1.0
+
+class ChecksumCache(shelve.DbfilenameShelf):
+    """
+    Remembers the checksum of a file by its real path, so an unchanged
+    file only costs a ``stat`` to checksum again.
+
+    An entry is only trusted while the file's device, inode, size and
+    mtime still match what they were when it was hashed, and files
+    modified within ``RACY_SECONDS`` of being hashed aren't cached at all.
+    The cache holds at most ``max_entries`` paths, evicting the least
+    recently used ones when it grows past that. Hits only update recency in
+    memory, which is written back on ``sync``. It is safe to share between
+    threads.
+    """
+    def __init__(self, filename, max_entries, *args, **kwargs):
+        shelve.DbfilenameShelf.__init__(self, filename, *args, **kwargs)
+        self.max_entries = max_entries
+        self._lock = threading.RLock()
+        # counting walks every key on some dbms, so it's only done once
+        self._count = len(self)
+        self._used = {}
+
+    def lookup(self, path, key=None):
+        """
+        Return the cached checksum for ``path``, or ``None`` if it isn't
+        cached or the file changed since
+        """
+        key = key or stat_key(path)
+        with self._lock:
+            entry = self.get(path)
+            if entry is None or entry[0] != key:
+                return None
+            self._used[path] = time.time()
+            return entry[1]
+
+    def store(self, path, key, sum):
+        now = time.time()
+        if now - key[3] / 1e9 < RACY_SECONDS:
+            LOG.debug('not caching checksum of recently modified "%s"' % path)
+            return
+
+        with self._lock:
+            if not self.has_key(path):
+                self._count += 1
+            self[path] = (key, sum, now)
+            self._used.pop(path, None)
+            if self._count > self.max_entries:
+                self._evict()
+
+    def __delitem__(self, path):
+        with self._lock:
+            shelve.DbfilenameShelf.__delitem__(self, path)
+            self._count -= 1
+            self._used.pop(path, None)
+
+    def clear(self):
+        with self._lock:
+            shelve.DbfilenameShelf.clear(self)
+            self._count = 0
+            self._used.clear()
+
+    def _evict(self):
+        # evict a tenth at a time, so the walk to find the oldest entries
+        # only happens every few inserts
+        count = max(self._count - self.max_entries, self.max_entries // 10, 1)
+        LOG.debug('evicting %d entries from checksum cache' % count)
+        ages = ((self._used.get(path, entry[2]), path) for path, entry in self.iteritems())
+        for _, path in heapq.nsmallest(count, ages):
+            del self[path]
+
+    def sync(self):
+        with self._lock:
+            # write back the recency of the entries hit since the last sync
+            for path, used in self._used.iteritems():
+                entry = self.get(path)
+                if entry is not None:
+                    self[path] = (entry[0], entry[1], used)
+            self._used.clear()
+            shelve.DbfilenameShelf.sync(self)
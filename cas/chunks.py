@@ -0,0 +1,335 @@
+"""
+Content-defined chunking, the storage tier for large objects.
+
+Objects at or above the storage's chunk threshold are split into chunks
+wherever a rolling (gear) hash of the last few dozen bytes matches a mask,
+so the boundaries move along with the content: an edit only changes the
+chunks around it, and every other chunk is shared with earlier versions of
+the file. Each unique chunk is stored once under ``chunks/``, by its own
+sum, and the object's manifest under ``manifests/`` lists its chunks in
+order. Objects keep their whole-file sum.
+
+Removing an object only removes its manifest, since its chunks may be
+shared. Chunks no manifest refers to any more are deleted by ``sweep``.
+
+The rolling hash is computed with numpy. A byte at a time in Python it
+would be far slower than reading the file, so without numpy files are cut
+into fixed-size chunks instead: still readable wherever numpy is around,
+but only sharing chunks with versions that weren't edited before them.
+"""
+
+from cas.config import CAS_CHUNK_SIZE
+from cas.util import shard, mkdir_p
+import tempfile
+import hashlib
+import os
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LOG = logging.getLogger(__name__)
+
+# a fixed pseudo-random value for every byte, changing these would move
+# every chunk boundary
+GEAR = [int(hashlib.md5(chr(i)).hexdigest()[:8], 16) for i in range(256)]
+
+# the suffix of the manifests ``stage`` writes
+MANIFEST_SUFFIX = '.manifest'
+
+# the least read from a file at once
+READ_SIZE = 2**20
+
+if numpy is not None:
+    GEAR_ARRAY = numpy.array(GEAR, dtype=numpy.uint32)
+
+def _gear_hashes(data, start, end):
+    """
+    The 32 bit gear hash ``h = (h << 1) + GEAR[byte]`` after each byte of
+    ``data[start:end]``, starting from zero
+    """
+    hashes = GEAR_ARRAY[numpy.frombuffer(data, numpy.uint8, end - start, start)]
+    # a byte's gear value is shifted out of the hash 32 bytes later, so each
+    # hash is the sum of the last 32 gear values, shifted by their distance.
+    # Sums of the last 1, 2, 4, ... 32 values each take one pass.
+    shift = 1
+    while shift < 32 and shift < len(hashes):
+        hashes[shift:] += hashes[:-shift] << numpy.uint32(shift)
+        shift *= 2
+    return hashes
+
+def _cut_point(data, start, end, mask, step):
+    """
+    The offset just past the first byte of ``data[start:end]`` where the
+    gear hash since ``start`` has none of the ``mask`` bits set, or ``end``.
+    The hashes are computed ``step`` bytes at a time, since a boundary is
+    usually found long before ``end``.
+    """
+    mask = numpy.uint32(mask)
+    pos = start
+    while pos < end:
+        stop = min(pos + step, end)
+        # the hashes from ``pos`` on only need the 31 bytes before it
+        lead = min(pos - start, 31)
+        hashes = _gear_hashes(data, pos - lead, stop)[lead:]
+        # the low bits of a gear hash only depend on the last few bytes, so
+        # boundaries are chosen on the high bits
+        cuts = numpy.flatnonzero((hashes & mask) == 0)
+        if cuts.size:
+            return pos + int(cuts[0]) + 1
+        pos = stop
+    return end
+
+def chunks(fileobj, avg_size=CAS_CHUNK_SIZE):
+    """
+    Split the data read from ``fileobj`` into content-defined chunks of
+    ``avg_size`` bytes on average, between a quarter and four times that,
+    or into chunks of exactly ``avg_size`` bytes without numpy
+    """
+    min_size, max_size = avg_size // 4, avg_size * 4
+    bits = max(avg_size.bit_length() - 1, 1)
+    mask = ((1 << bits) - 1) << (32 - bits)
+
+    # chunks are cut from ``start`` on, and only the leftover data is copied
+    # when more is read
+    buf, start, eof = '', 0, False
+    while True:
+        if not eof and len(buf) - start < max_size:
+            data = fileobj.read(max(max_size, READ_SIZE))
+            eof = not data
+            buf = buf[start:] + data
+            start = 0
+            continue
+        if start >= len(buf):
+            return
+
+        end = min(len(buf), start + max_size)
+        if numpy is None:
+            cut = min(len(buf), start + avg_size)
+        elif end - start <= min_size:
+            cut = end
+        else:
+            cut = _cut_point(buf, start + min_size, end, mask, avg_size)
+        yield buf[start:cut]
+        start = cut
+
+class ChunkedReader(object):
+    """
+    A read-only file object reassembling an object from its chunks
+    """
+    def __init__(self, store, manifest):
+        self.store = store
+        self.manifest = manifest
+        self.size = sum(length for _, length in manifest)
+        self._next = 0
+        self._fd = None
+        self._pos = 0
+
+    def _open(self, index):
+        self._close_chunk()
+        self._fd = open(self.store.chunk_path(self.manifest[index][0]), 'rb')
+        self._next = index + 1
+
+    def _close_chunk(self):
+        if self._fd is not None:
+            self._fd.close()
+            self._fd = None
+
+    def read(self, size=-1):
+        parts, remaining = [], size
+        while size < 0 or remaining > 0:
+            if self._fd is None:
+                if self._next >= len(self.manifest):
+                    break
+                self._open(self._next)
+
+            data = self._fd.read(size < 0 and -1 or remaining)
+            if not data:
+                self._close_chunk()
+                continue
+            parts.append(data)
+            remaining -= len(data)
+
+        data = ''.join(parts)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.size
+        self._pos = pos = min(max(pos, 0), self.size)
+
+        # skip straight to the chunk holding the new position
+        self._close_chunk()
+        self._next = len(self.manifest)
+        start = 0
+        for index, (_, length) in enumerate(self.manifest):
+            if pos < start + length:
+                self._open(index)
+                self._fd.seek(pos - start)
+                break
+            start += length
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self._close_chunk()
+        self._next = len(self.manifest)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ChunkStore(object):
+    """
+    The chunks and manifests under ``root``, sharded like ``storage/``.
+    New chunks are named by their checksum under ``hash_func``.
+    """
+    def __init__(self, root, width, depth, avg_size=CAS_CHUNK_SIZE, hash_func=hashlib.sha1):
+        self.root = root
+        self.width = width
+        self.depth = depth
+        self.avg_size = avg_size
+        self.hash_func = hash_func
+
+    @property
+    def chunkdir(self):
+        return os.path.join(self.root, 'chunks')
+
+    @property
+    def manifestdir(self):
+        return os.path.join(self.root, 'manifests')
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.chunkdir, *shard(chunk, self.width, self.depth))
+
+    def manifest_path(self, sum):
+        return os.path.join(self.manifestdir, *shard(sum, self.width, self.depth))
+
+    def has(self, sum):
+        return os.path.isfile(self.manifest_path(sum))
+
+    def _publish(self, data, path, tmpdir):
+        fdno, tmpfile = tempfile.mkstemp(dir=tmpdir)
+        with os.fdopen(fdno, 'wb') as fd:
+            fd.write(data)
+        mkdir_p(os.path.dirname(path))
+        os.rename(tmpfile, path)
+
+    def stage(self, filename, tmpdir):
+        """
+        Chunk ``filename``, storing its new chunks, and write its manifest
+        to a file in ``tmpdir`` (ending in ``MANIFEST_SUFFIX``) for
+        ``publish``, returning the manifest's filename. Chunks are published
+        atomically under their own sums, so this is safe to run in many
+        workers at once.
+        """
+        manifest, new = [], 0
+        with open(filename, 'rb') as fd:
+            for data in chunks(fd, self.avg_size):
+                chunk = self.hash_func(data).hexdigest()
+                path = self.chunk_path(chunk)
+                if not os.path.isfile(path):
+                    self._publish(data, path, tmpdir)
+                    new += 1
+                manifest.append((chunk, len(data)))
+
+        LOG.debug('chunked "%s" into %d chunks, %d of them new' % (filename, len(manifest), new))
+        fdno, tmpfile = tempfile.mkstemp(suffix=MANIFEST_SUFFIX, dir=tmpdir)
+        with os.fdopen(fdno, 'wb') as fd:
+            fd.write(''.join('%s %d\n' % entry for entry in manifest))
+        return tmpfile
+
+    def publish(self, sum, manifest):
+        """
+        Move a manifest written by ``stage`` into place as the object
+        ``sum``
+        """
+        path = self.manifest_path(sum)
+        mkdir_p(os.path.dirname(path))
+        os.rename(manifest, path)
+
+    def store(self, sum, filename, tmpdir):
+        """
+        Chunk ``filename`` and store it as the object ``sum``, staging
+        new files in ``tmpdir``
+        """
+        # the manifest goes last, so an object is never visible before all
+        # of its chunks are
+        self.publish(sum, self.stage(filename, tmpdir))
+
+    def manifest(self, sum):
+        """
+        The ``(chunk, length)`` pairs making up an object, in order
+        """
+        with open(self.manifest_path(sum)) as fd:
+            return [(chunk, int(length)) for chunk, length in
+              (line.split() for line in fd)]
+
+    def open(self, sum):
+        return ChunkedReader(self, self.manifest(sum))
+
+    def remove(self, sum, dst=None):
+        """
+        Drop an object's manifest, moving it to ``dst`` instead of deleting
+        it if given
+        """
+        path = self.manifest_path(sum)
+        if dst is None:
+            os.remove(path)
+        else:
+            os.rename(path, dst)
+        self._clean_dirs(os.path.dirname(path), self.manifestdir)
+
+    def rename(self, sum, new):
+        """
+        Move an object's manifest to the sum ``new``
+        """
+        path, dst = self.manifest_path(sum), self.manifest_path(new)
+        mkdir_p(os.path.dirname(dst))
+        os.rename(path, dst)
+        self._clean_dirs(os.path.dirname(path), self.manifestdir)
+
+    def _clean_dirs(self, dir, top):
+        while dir != top and os.path.isdir(dir) and not os.listdir(dir):
+            os.rmdir(dir)
+            dir = os.path.dirname(dir)
+
+    def _walk(self, top):
+        for dirpath, dirnames, filenames in os.walk(top):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def sums(self):
+        """
+        Yield the sums of the chunked objects
+        """
+        for path in self._walk(self.manifestdir):
+            yield os.path.relpath(path, self.manifestdir).replace(os.path.sep, '')
+
+    def sweep(self):
+        """
+        Delete the chunks no manifest refers to, returning how many
+        """
+        live = set()
+        for path in self._walk(self.manifestdir):
+            with open(path) as fd:
+                live.update(line.split()[0] for line in fd)
+
+        removed = 0
+        for path in self._walk(self.chunkdir):
+            chunk = os.path.relpath(path, self.chunkdir).replace(os.path.sep, '')
+            if chunk not in live:
+                os.remove(path)
+                self._clean_dirs(os.path.dirname(path), self.chunkdir)
+                removed += 1
+
+        LOG.debug('swept %d unreferenced chunks' % removed)
+        return removed
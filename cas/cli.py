@@ -1,21 +1,67 @@
 import click
-from cas.config import DEBUG, CAS_ROOT, CAS_PLUGIN_DIR
+from cas.config import DEBUG, CAS_ROOT, CAS_PLUGIN_DIR, CAS_BATCH_SIZE, \
+  CAS_WORKERS, CAS_POOL, CAS_CHECKSUM_CACHE, CAS_INDEX_BACKEND, CAS_LOCK_TIMEOUT, \
+  CAS_PACK_THRESHOLD, CAS_CHUNK_THRESHOLD, CAS_COMPRESSION, CAS_COMPRESSION_THRESHOLD, \
+  CAS_VERIFY_RATE, CAS_BLOOM_FILTER, CAS_HASH, CAS_METRICS_FILE
 from cas.log import enable_debug
-from cas import CAS
+from cas import CAS, CASLocked, AmbiguousSum
 from cas.files import DEFAULT_TYPE, types, get_type, InvalidFileType
 import json
 import os
-from cas.util import load_plugin_dir
+import sys
+from cas.util import load_plugin_dir, iter_delimited
+from cas.ingest import MODES, DEFAULT_MODE
+from cas.query import QuerySyntaxError
+from cas.index import BACKENDS
+from cas.compression import CODECS, NO_COMPRESSION
+from cas.hashes import HASHES
+from cas.daemon import Daemon, connect
+import cas.metrics
+
+# commands that only read from storage, and so can share it with each other
+READ_ONLY_COMMANDS = ['ls', 'path', 'cat', 'meta', 'match', 'query', 'fsck', 'stats']
+
+# commands that a running daemon can serve
+DAEMON_COMMANDS = ['add', 'rm', 'ls', 'path', 'cat', 'meta', 'match', 'query', 'gc', 'repack',
+  'stats', 'fsck']
 
 @click.group(name='cas')
 @click.option('--debug', is_flag=True)
 @click.option('--root', metavar='DIRECTORY')
 @click.option('--plugins-dir', metavar='DIRECTORY', default=CAS_PLUGIN_DIR)
+@click.option('--checksum-cache', type=int, metavar='N', default=CAS_CHECKSUM_CACHE,
+  help='Remember checksums of up to N unchanged files (0 disables)')
+@click.option('--index', type=click.Choice(sorted(BACKENDS)), default=CAS_INDEX_BACKEND,
+  help='Index backend to use when creating a new store')
+@click.option('--wait', type=float, metavar='SECONDS', default=CAS_LOCK_TIMEOUT,
+  help='Wait up to SECONDS for another process to release the storage')
+@click.option('--no-daemon', is_flag=True,
+  help="Don't use a running daemon, even if there is one")
+@click.option('--pack-threshold', type=int, metavar='BYTES', default=CAS_PACK_THRESHOLD,
+  help='Store files smaller than BYTES in packfiles (0 disables)')
+@click.option('--chunk-threshold', type=int, metavar='BYTES', default=CAS_CHUNK_THRESHOLD,
+  help='Split files of at least BYTES into deduplicated chunks (0 disables)')
+@click.option('--compression', type=click.Choice(sorted(CODECS.keys() + [NO_COMPRESSION])),
+  help='Codec to compress files with when creating a new store')
+@click.option('--compression-threshold', type=int, metavar='BYTES',
+  help='Only compress files of at least BYTES when creating a new store')
+@click.option('--bloom-filter/--no-bloom-filter', default=CAS_BLOOM_FILTER,
+  help='Look up checksums in a bloom filter before going to disk')
+@click.option('--hash', type=click.Choice(sorted(HASHES)), default=CAS_HASH,
+  help='Hash function to name files by when creating a new store')
+@click.option('--metrics-file', metavar='FILE', default=CAS_METRICS_FILE,
+  help='Write metrics to FILE when done, as Prometheus text if it ends in .prom')
 @click.pass_context
-def main(ctx, debug, root, plugins_dir):
+def main(ctx, debug, root, plugins_dir, checksum_cache, index, wait, no_daemon,
+         pack_threshold, chunk_threshold, compression, compression_threshold,
+         bloom_filter, hash, metrics_file):
     if debug and not DEBUG:
         enable_debug()
 
+    # the daemon writes its own every CAS_METRICS_INTERVAL seconds
+    if metrics_file and ctx.invoked_subcommand != 'daemon':
+        ctx.call_on_close(lambda: cas.metrics.write(metrics_file))
+
     rootdir = CAS_ROOT or root
 
     if not rootdir:
@@ -26,34 +72,125 @@ def main(ctx, debug, root, plugins_dir):
     elif os.path.isdir(rootdir) and os.listdir(rootdir) and not CAS.check(rootdir):
         raise click.UsageError('"%s" does not look like a valid CAS directory' % rootdir) 
 
-    # load plugins
-    load_plugin_dir(plugins_dir)
+    remote = None
+    if not no_daemon and ctx.invoked_subcommand in DAEMON_COMMANDS:
+        remote = connect(CAS(rootdir, autoload=False).socketfile)
+
+    # load plugins, which only add needs if a daemon is doing the work
+    if remote is None or ctx.invoked_subcommand == 'add':
+        load_plugin_dir(plugins_dir)
+
+    if remote is not None:
+        ctx.obj = remote
+        check_compression(remote, compression, compression_threshold)
+        return
+
+    # a reader can't create the storage, so the first command run against
+    # a new root always opens it for writing
+    readonly = ctx.invoked_subcommand in READ_ONLY_COMMANDS and CAS.check(rootdir)
 
-    ctx.obj = CAS(rootdir)
+    try:
+        ctx.obj = CAS(rootdir, checksum_cache=checksum_cache, index=index,
+          readonly=readonly, lock_timeout=wait, pack_threshold=pack_threshold,
+          chunk_threshold=chunk_threshold, compression=compression or CAS_COMPRESSION,
+          compression_threshold=CAS_COMPRESSION_THRESHOLD if compression_threshold is None
+            else compression_threshold,
+          bloom_filter=bloom_filter, hash=hash)
+    except CASLocked:
+        if connect(CAS(rootdir, autoload=False).socketfile) is not None:
+            # the daemon holds the lock until it stops, so waiting won't help
+            raise click.ClickException('storage is held by a running daemon, stop '
+              'it to run %s' % (no_daemon and 'commands with --no-daemon' or
+              ctx.invoked_subcommand))
+        raise click.ClickException('storage is locked by another process, '
+          'try again or pass --wait')
+    check_compression(ctx.obj, compression, compression_threshold)
+
+def check_compression(storage, codec, threshold):
+    """
+    Refuse compression options (the ones given, not the defaults) that
+    differ from what the storage recorded when it was created, rather than
+    silently ignore them
+    """
+    recorded = storage.meta()['compression']
+    for option, value, key in [('--compression', codec, 'codec'),
+                               ('--compression-threshold', threshold, 'threshold')]:
+        if value is not None and value != recorded[key]:
+            raise click.UsageError('%s only applies to new stores, this one has '
+              '%s %s' % (option, option, recorded[key]))
 
 @click.command(name='add')
-@click.argument('filename', nargs=-1, required=True)
+@click.argument('filename', nargs=-1)
 @click.option('-t', '--type', metavar='TYPE', default=DEFAULT_TYPE)
+@click.option('--from-stdin', is_flag=True,
+  help='Read paths to add from stdin, one per line')
+@click.option('-0', '--null', is_flag=True,
+  help='Paths read from stdin are NUL-delimited')
+@click.option('--batch-size', type=int, default=CAS_BATCH_SIZE, metavar='N',
+  help='Commit indices every N files')
+@click.option('-j', '--jobs', type=int, default=CAS_WORKERS, metavar='N',
+  help='Checksum and inspect files using N workers')
+@click.option('--pool', type=click.Choice(['thread', 'process']), default=CAS_POOL,
+  help='Kind of worker pool to use with --jobs')
+@click.option('-m', '--mode', type=click.Choice(sorted(MODES.keys() + [DEFAULT_MODE])),
+  default=DEFAULT_MODE, help='How to place file contents into storage. hardlink '
+  'shares a file stored as it is with storage and makes it read-only, so it '
+  'must never be edited in place afterwards')
 @click.pass_obj
-def add(storage, filename, type):
+def add(storage, filename, type, from_stdin, null, batch_size, jobs, pool, mode):
     valid_types = types()
     if type not in valid_types:
         raise click.UsageError('invalid type, must pass one of: %s' % ', '.join(valid_types))
 
-    if not filename:
+    if from_stdin and filename:
+        raise click.UsageError('cannot pass files when reading from stdin')
+    elif not from_stdin and not filename:
         raise click.UsageError('must pass one or more files to add')
+    elif '-' in filename and len(filename) > 1:
+        raise click.UsageError('cannot pass files when adding the contents of stdin')
 
-    sums = set()
-
-    for f in filename:
+    if filename == ('-',):
         try:
-            sum = storage.add(f, type=get_type(type))
-            sums.add(sum)
+            click.echo(storage.add_stream(click.get_binary_stream('stdin'),
+              type=get_type(type)))
         except InvalidFileType, e:
-            raise click.UsageError('file "%s" is not of type "%s"' % (f, type))
+            raise click.UsageError('stdin is not of type "%s"' % type)
+        return
 
-    for sum in sorted(list(sums)):
-        click.echo(sum)
+    if from_stdin:
+        delimiter = null and '\0' or '\n'
+        filenames = iter_delimited(click.get_binary_stream('stdin'), delimiter)
+    else:
+        filenames = filename
+
+    sums = storage.add_many(filenames, type=get_type(type), batch_size=batch_size,
+      workers=jobs, pool=pool, mode=mode)
+
+    try:
+        if from_stdin:
+            # stream results back as each batch is committed
+            for sum in sums:
+                click.echo(sum)
+        else:
+            for sum in sorted(set(sums)):
+                click.echo(sum)
+    except InvalidFileType, e:
+        raise click.UsageError('file "%s" is not of type "%s"' % (e.filename, type))
+
+def resolve(storage, checksum):
+    """
+    The full checksum an abbreviated one stands for
+    """
+    try:
+        sum = storage.resolve(checksum)
+    except AmbiguousSum, e:
+        raise click.UsageError(str(e))
+    except KeyError:
+        sum = None
+
+    if sum is None or not storage.has_sum(sum):
+        raise click.UsageError("no such checksum '%s' in storage" % checksum)
+    return sum
 
 @click.command(name='rm')
 @click.argument('checksum', nargs=-1, required=True)
@@ -62,13 +199,17 @@ def rm(storage, checksum):
     if not checksum:
         raise click.UsageError('must pass one or more checksums to remove')
 
-    for c in checksum:
+    for c in [resolve(storage, c) for c in checksum]:
         storage.remove(c)
 
 @click.command(name='ls')
+@click.option('-p', '--prefix', metavar='PREFIX', help='Only checksums starting with PREFIX')
+@click.option('--after', metavar='CHECKSUM',
+  help='Only checksums after CHECKSUM, such as the last one of the previous page')
+@click.option('-n', '--limit', type=int, metavar='N', help='List at most N checksums')
 @click.pass_obj
-def ls(storage):
-    for sum in storage.list():
+def ls(storage, prefix, after, limit):
+    for sum in storage.list(prefix=prefix, after=after, limit=limit):
         click.echo(sum)
 
 @click.command(name='path')
@@ -78,10 +219,41 @@ def path(storage, checksum):
     if not checksum:
         raise click.UsageError('must pass a checksum')
 
-    if not storage.has_sum(checksum):
-        raise click.UsageError("no such checksum '%s' in storage" % checksum)
+    checksum = resolve(storage, checksum)
+    path = storage.path(checksum)
+    if not os.path.isfile(path):
+        raise click.UsageError("checksum '%s' isn't stored as a file of its own, "
+          "use cas cat to read it" % checksum)
+
+    click.echo(path)
+
+def parse_range(value):
+    """
+    Parse a ``START-[END]`` byte range (inclusive, like HTTP and curl) into
+    an ``(offset, length)`` pair
+    """
+    start, sep, end = value.partition('-')
+    try:
+        offset, length = int(start), None
+        if end:
+            length = int(end) - offset + 1
+    except ValueError:
+        raise click.BadParameter('must look like START-END or START-')
+    if not sep or offset < 0 or (length is not None and length < 1):
+        raise click.BadParameter('must look like START-END or START-')
+    return offset, length
 
-    click.echo(storage.path(c))
+@click.command(name='cat')
+@click.argument('checksum', required=True)
+@click.option('-r', '--range', 'byte_range', metavar='START-[END]',
+  help='Only output bytes START to END (inclusive, from 0). Compressed files '
+  'are decompressed from their start to get to START.')
+@click.pass_obj
+def cat(storage, checksum, byte_range):
+    offset, length = byte_range and parse_range(byte_range) or (0, None)
+
+    checksum = resolve(storage, checksum)
+    storage.send(checksum, click.get_binary_stream('stdout'), offset, length)
 
 @click.command(name='meta')
 @click.pass_obj
@@ -90,23 +262,177 @@ def meta(storage):
 
 @click.command(name='match')
 @click.argument('key', required=True)
-@click.argument('value', metavar='REGEX', required=True)
+@click.argument('value', metavar='[REGEX]', required=False)
 @click.option('-e', '--exact', is_flag=True)
+@click.option('-p', '--prefix', metavar='PREFIX', help='Only values starting with PREFIX')
+@click.option('--ge', metavar='VALUE', help='Only values sorting at or after VALUE')
+@click.option('--lt', metavar='VALUE', help='Only values sorting before VALUE')
 @click.pass_obj
-def match(storage, key, value, exact):
+def match(storage, key, value, exact, prefix, ge, lt):
     if exact:
-        func = storage.equals
+        if value is None or prefix or ge or lt:
+            raise click.UsageError('--exact takes a value and no other filters')
+        sums = storage.equals(key, value)
+    elif value is None and prefix is None and ge is None and lt is None:
+        raise click.UsageError('must pass a regex, --prefix, --ge or --lt')
     else:
-        func = storage.match
-    for sum in func(key, value):
+        sums = storage.match(key, value, prefix=prefix, start=ge, stop=lt)
+    for sum in sums:
         click.echo(sum)
 
+@click.command(name='query')
+@click.argument('expression', nargs=-1, required=True)
+@click.pass_obj
+def query(storage, expression):
+    """
+    Find sums matching a compound query, e.g.
+
+        rpm.name=foo and rpm.arch=x86_64 and not rpm.release~el6
+    """
+    try:
+        sums = storage.query(' '.join(expression))
+        for sum in sums:
+            click.echo(sum)
+    except QuerySyntaxError, e:
+        raise click.UsageError('invalid query: %s' % e)
+
+@click.command(name='reindex')
+@click.pass_obj
+def reindex(storage):
+    storage.reindex()
+
+@click.command(name='gc')
+@click.option('--full', is_flag=True, help='Check every indexed sum against storage')
+@click.option('--batch-size', type=int, default=CAS_BATCH_SIZE, metavar='N',
+  help='Commit and checkpoint a full sweep every N sums')
+@click.option('--restart', is_flag=True, help="Don't resume an interrupted full sweep")
+@click.pass_obj
+def gc(storage, full, batch_size, restart):
+    storage.gc(full=full, batch_size=batch_size, resume=not restart)
+
+SIZE_SUFFIXES = {'k': 2**10, 'm': 2**20, 'g': 2**30}
+
+def parse_size(value):
+    """
+    Parse a number of bytes, optionally suffixed with K, M or G
+    """
+    multiplier = SIZE_SUFFIXES.get(value[-1:].lower(), 1)
+    if multiplier != 1:
+        value = value[:-1]
+    try:
+        size = int(value) * multiplier
+    except ValueError:
+        raise click.BadParameter('must be a number of bytes, like 1048576 or 50M')
+    if size < 0:
+        raise click.BadParameter('must not be negative')
+    return size
+
+@click.command(name='fsck')
+@click.option('-j', '--jobs', type=int, default=CAS_WORKERS, metavar='N',
+  help='Hash files using N threads')
+@click.option('--rate', metavar='BYTES', default=str(CAS_VERIFY_RATE),
+  help='Read at most BYTES (K, M or G) per second, 0 for no limit')
+@click.option('--batch-size', type=int, default=CAS_BATCH_SIZE, metavar='N',
+  help='Checkpoint every N sums')
+@click.option('--restart', is_flag=True, help="Don't resume an interrupted check")
+@click.option('--quarantine', is_flag=True,
+  help='Move corrupt and orphaned files to quarantine/ and unindex missing ones')
+@click.pass_obj
+def fsck(storage, jobs, rate, batch_size, restart, quarantine):
+    """
+    Check that every file still matches its checksum and the indices
+    """
+    rate = parse_size(rate)
+
+    if quarantine and storage.readonly:
+        # fixing things needs the storage to ourselves
+        storage.unlock()
+        try:
+            storage = CAS(storage.root, lock_timeout=storage.lock_timeout)
+        except CASLocked:
+            raise click.ClickException('storage is locked by another process, '
+              'try again or pass --wait')
+
+    found = False
+    for problem in storage.verify(workers=jobs, rate=rate, batch_size=batch_size,
+                                  resume=not restart, quarantine=quarantine):
+        click.echo('%s %s: %s' % problem)
+        found = True
+
+    if found:
+        sys.exit(1)
+
+@click.command(name='migrate-index')
+@click.argument('backend', type=click.Choice(sorted(BACKENDS)))
+@click.pass_obj
+def migrate_index(storage, backend):
+    storage.migrate_index(backend)
+
+@click.command(name='rehash')
+@click.argument('hash', type=click.Choice(sorted(HASHES)))
+@click.option('-j', '--jobs', type=int, default=CAS_WORKERS, metavar='N',
+  help='Hash files using N threads')
+@click.option('--batch-size', type=int, default=CAS_BATCH_SIZE, metavar='N',
+  help='Commit indices every N files')
+@click.pass_obj
+def rehash(storage, hash, jobs, batch_size):
+    """
+    Rename every file by its checksum under another hash function
+    """
+    try:
+        storage.rehash(hash, workers=jobs, batch_size=batch_size)
+    except ValueError, e:
+        raise click.ClickException(str(e))
+
+@click.command(name='repack')
+@click.pass_obj
+def repack(storage):
+    """
+    Reclaim the space held in packfiles and chunks by removed files
+    """
+    storage.repack()
+
+@click.command(name='stats')
+@click.option('-f', '--format', type=click.Choice(['text', 'json', 'prometheus']),
+  default='text')
+@click.pass_obj
+def stats(storage, format):
+    """
+    Show the size of the storage and the metrics collected so far, which
+    cover the daemon's lifetime if one is running
+    """
+    snapshot = storage.stats()
+    if format == 'json':
+        click.echo(json.dumps(snapshot, sort_keys=True, indent=2))
+    elif format == 'prometheus':
+        click.echo(cas.metrics.to_prometheus(snapshot), nl=False)
+    else:
+        click.echo(cas.metrics.to_text(snapshot), nl=False)
+
+@click.command(name='daemon')
+@click.pass_context
+def daemon(ctx):
+    """
+    Keep the storage open and serve other cas commands from it
+    """
+    Daemon(ctx.obj, metrics_file=ctx.parent.params['metrics_file']).serve()
+
 main.add_command(add)
 main.add_command(rm)
 main.add_command(ls)
 main.add_command(path)
+main.add_command(cat)
 main.add_command(meta)
 main.add_command(match)
+main.add_command(query)
+main.add_command(reindex)
+main.add_command(gc)
+main.add_command(fsck)
+main.add_command(migrate_index)
+main.add_command(rehash)
+main.add_command(repack)
+main.add_command(stats)
+main.add_command(daemon)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,128 @@
+"""
+Per-object compression codecs.
+
+A compressed object is stored next to where its uncompressed version would
+be, with the codec's suffix appended, so each object says for itself how it
+was stored and objects that didn't compress well are simply left as they
+are. Checksums are always of the uncompressed data.
+"""
+
+import zlib
+import errno
+import os
+import bz2
+import logging
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+LOG = logging.getLogger(__name__)
+
+class Codec(object):
+    def __init__(self, name, compressor, decompressor):
+        self.name = name
+        self.suffix = '.' + name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+CODECS = {
+  'zlib': Codec('zlib', lambda: zlib.compressobj(6), zlib.decompressobj),
+  'bz2': Codec('bz2', bz2.BZ2Compressor, bz2.BZ2Decompressor),
+}
+
+if lzma is not None:
+    CODECS['lzma'] = Codec('lzma', lzma.LZMACompressor, lzma.LZMADecompressor)
+
+NO_COMPRESSION = 'none'
+
+def get_codec(name):
+    """
+    The codec called ``name``, or ``None`` for no compression
+    """
+    if name in (None, NO_COMPRESSION):
+        return None
+    if name not in CODECS:
+        raise ValueError('invalid compression "%s", must be one of: %s' %
+          (name, ', '.join(sorted(CODECS.keys() + [NO_COMPRESSION]))))
+    return CODECS[name]
+
+def compress_file(src, dst, codec, block_size=2**20):
+    """
+    Write a compressed copy of ``src`` to ``dst``, returning its size
+    """
+    compressor = codec.compressor()
+    size = 0
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            while True:
+                data = fsrc.read(block_size)
+                if not data:
+                    break
+                data = compressor.compress(data)
+                fdst.write(data)
+                size += len(data)
+            data = compressor.flush()
+            fdst.write(data)
+            size += len(data)
+    return size
+
+class DecompressingReader(object):
+    """
+    A read-only file object decompressing another one as it is read. It
+    can only seek forwards, by decompressing and discarding what it skips.
+    """
+    def __init__(self, fileobj, codec, block_size=2**16):
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self._decompressor = codec.decompressor()
+        self._buffer = ''
+        self._eof = False
+        self._pos = 0
+
+    def _fill(self, size):
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            data = self.fileobj.read(self.block_size)
+            if not data:
+                self._eof = True
+                if hasattr(self._decompressor, 'flush'):
+                    self._buffer += self._decompressor.flush()
+                break
+            self._buffer += self._decompressor.decompress(data)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            data, self._buffer = self._buffer, ''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence != os.SEEK_SET:
+            raise IOError(errno.ESPIPE, 'can only seek from the start or current position')
+        if pos < self._pos:
+            raise IOError(errno.ESPIPE, 'can only seek forwards')
+
+        while self._pos < pos:
+            if not self.read(min(pos - self._pos, self.block_size)):
+                break
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -5,3 +5,57 @@ DEBUG = os.environ.get('CAS_DEBUG', 'false') == 'true'
 CAS_ROOT = os.environ.get('CAS_ROOT', None)
 
 CAS_PLUGIN_DIR = os.path.join(os.path.dirname(__file__), 'plugins')
+
+CAS_BATCH_SIZE = int(os.environ.get('CAS_BATCH_SIZE', 1000))
+
+CAS_WORKERS = int(os.environ.get('CAS_WORKERS', 1))
+
+CAS_POOL = os.environ.get('CAS_POOL', 'thread')
+
+# max number of paths remembered by the checksum cache, 0 disables it
+CAS_CHECKSUM_CACHE = int(os.environ.get('CAS_CHECKSUM_CACHE', 0))
+
+# index backend used for new stores, either 'shelve' or 'sqlite'
+CAS_INDEX_BACKEND = os.environ.get('CAS_INDEX_BACKEND', 'shelve')
+
+# seconds to wait for another process to release a conflicting lock on the
+# storage, 0 fails immediately
+CAS_LOCK_TIMEOUT = float(os.environ.get('CAS_LOCK_TIMEOUT', 0))
+
+# objects smaller than this many bytes are stored in packfiles rather than
+# as files of their own, 0 disables packing
+CAS_PACK_THRESHOLD = int(os.environ.get('CAS_PACK_THRESHOLD', 0))
+
+# packfiles stop taking new objects at this many bytes
+CAS_PACK_SIZE = int(os.environ.get('CAS_PACK_SIZE', 64 * 2**20))
+
+# objects of at least this many bytes are split into content-defined chunks,
+# each stored once, 0 disables chunking
+CAS_CHUNK_THRESHOLD = int(os.environ.get('CAS_CHUNK_THRESHOLD', 0))
+
+# average size of those chunks, in bytes
+CAS_CHUNK_SIZE = int(os.environ.get('CAS_CHUNK_SIZE', 128 * 2**10))
+
+# codec used to compress objects in new stores, 'none', 'zlib', 'bz2' or
+# 'lzma' (if an lzma module is installed)
+CAS_COMPRESSION = os.environ.get('CAS_COMPRESSION', 'none')
+
+# objects smaller than this many bytes are never compressed
+CAS_COMPRESSION_THRESHOLD = int(os.environ.get('CAS_COMPRESSION_THRESHOLD', 4096))
+
+# bytes per second that ``cas fsck`` may read, 0 for no limit
+CAS_VERIFY_RATE = int(os.environ.get('CAS_VERIFY_RATE', 0))
+
+# keep a bloom filter of the stored sums, so looking up sums that aren't
+# stored doesn't touch the disk
+CAS_BLOOM_FILTER = os.environ.get('CAS_BLOOM_FILTER', 'false') == 'true'
+
+# hash function that new stores name their objects by, e.g. 'sha1',
+# 'sha256' or 'sha512' (see ``cas.hashes``)
+CAS_HASH = os.environ.get('CAS_HASH', 'sha1')
+
+# file that commands (and the daemon, every ``CAS_METRICS_INTERVAL``
+# seconds) write their metrics to, as Prometheus text if it ends in '.prom'
+# and JSON otherwise
+CAS_METRICS_FILE = os.environ.get('CAS_METRICS_FILE', None)
+CAS_METRICS_INTERVAL = float(os.environ.get('CAS_METRICS_INTERVAL', 15))
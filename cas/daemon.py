@@ -0,0 +1,381 @@
+"""
+A long-running server holding one open ``CAS``, so that commands run
+against it skip importing plugins, opening the indices, collecting garbage
+and locking the storage each time.
+
+The daemon listens on a Unix socket in the storage root. Each connection
+carries one request, a line of JSON naming a ``CAS`` method and its
+arguments. Methods returning a single value reply with one ``result`` line,
+while those returning a sequence stream one ``item`` line per element and
+finish with a ``done`` line, so large listings are never built up in memory.
+Either may end with an ``error`` line instead. An ``add_stream`` request is
+followed by the data to add, up to the end of the client's half of the
+connection. Requests are served one at a time, since a ``CAS`` isn't safe
+to share between threads.
+
+``RemoteCAS`` stands in for a ``CAS`` on the client side.
+"""
+
+from cas.config import CAS_BATCH_SIZE, CAS_WORKERS, CAS_POOL, CAS_VERIFY_RATE, \
+  CAS_METRICS_INTERVAL
+from cas.files import NullType, get_type, InvalidFileType
+from cas.query import QuerySyntaxError
+from cas.storage import CASLocked, CASReadOnly, AmbiguousSum, Problem
+from cas.util import fullpath
+import cas.metrics
+import SocketServer
+import threading
+import socket
+import signal
+import errno
+import io
+import shutil
+import json
+import sys
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# the CAS methods that are served, and whether each returns a sequence
+METHODS = {
+  'add_many': True,
+  'add_stream': False,
+  'remove': False,
+  'list': True,
+  'path': False,
+  'resolve': False,
+  'has_sum': False,
+  'stream': True,
+  'meta': False,
+  'equals': True,
+  'match': True,
+  'values': True,
+  'query': True,
+  'gc': False,
+  'repack': False,
+  'stats': False,
+  'verify': True,
+}
+
+# exceptions re-raised as themselves on the client
+ERRORS = dict((cls.__name__, cls) for cls in [OSError, IOError, ValueError,
+  TypeError, KeyError, InvalidFileType, QuerySyntaxError, CASLocked, CASReadOnly,
+  AmbiguousSum])
+
+class DaemonError(RuntimeError): pass
+
+def _bytes(obj):
+    """
+    Undo the latin-1 decoding of byte strings done by ``_dumps``
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('latin-1')
+    elif isinstance(obj, list):
+        return [_bytes(item) for item in obj]
+    elif isinstance(obj, dict):
+        return dict((_bytes(k), _bytes(v)) for k, v in obj.iteritems())
+    return obj
+
+def _dumps(obj):
+    # paths, meta values and object data are arbitrary byte strings, which
+    # JSON can only carry losslessly as text if every byte maps to one
+    # character. Sending that text as UTF-8 rather than escaping every
+    # non-ASCII character keeps binary data from growing six-fold.
+    line = json.dumps(obj, encoding='latin-1', ensure_ascii=False) + '\n'
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return line
+
+def _loads(line):
+    return _bytes(json.loads(line))
+
+def _error(e):
+    if isinstance(e, InvalidFileType):
+        args = [e.filename, e.type]
+    elif isinstance(e, AmbiguousSum):
+        args = [e.prefix, e.candidates]
+    elif isinstance(e, EnvironmentError) and e.filename is not None:
+        args = [e.errno, e.strerror, e.filename]
+    elif type(e).__name__ in ERRORS:
+        args = [isinstance(a, (basestring, int, long, float)) and a or str(a)
+          for a in e.args]
+    else:
+        args = [str(e)]
+    return {'error': type(e).__name__, 'args': args}
+
+class Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+
+        result = None
+        try:
+            request = _loads(line)
+            method, args = request['method'], request.get('args', [])
+            if method == 'add_stream':
+                # the data follows the request
+                args = [self.rfile] + args
+            result = self.server.call(method, args, request.get('kwargs', {}))
+
+            if METHODS[method]:
+                for item in result:
+                    self._reply({'item': item})
+                self._reply({'done': True})
+            else:
+                self._reply({'result': result})
+        except socket.error, e:
+            LOG.debug('client went away: %s' % e)
+        except Exception, e:
+            LOG.debug('request failed: %s' % e)
+            try:
+                self._reply(_error(e))
+            except socket.error:
+                pass
+        finally:
+            # finish (or abandon) whatever a generator was in the middle of
+            if hasattr(result, 'close'):
+                result.close()
+
+    def _reply(self, obj):
+        self.wfile.write(_dumps(obj))
+        self.wfile.flush()
+
+class Daemon(SocketServer.UnixStreamServer):
+    """
+    Serves ``storage``, which must be open for writing, on ``socketfile``
+    (by default the storage's own socket file). If ``metrics_file`` is
+    given, the daemon's metrics are written to it every ``metrics_interval``
+    seconds while serving, and when it stops (see ``cas.metrics.write``).
+    """
+    def __init__(self, storage, socketfile=None, metrics_file=None,
+                 metrics_interval=CAS_METRICS_INTERVAL):
+        self.storage = storage
+        self.socketfile = socketfile or storage.socketfile
+        self.metrics_file = metrics_file
+        self.metrics_interval = metrics_interval
+        SocketServer.UnixStreamServer.__init__(self, self.socketfile, Handler)
+
+    def server_bind(self):
+        # holding the storage lock means no other daemon is serving it, so
+        # any socket left behind is stale
+        if os.path.exists(self.socketfile):
+            os.remove(self.socketfile)
+
+        # only the storage owner may ask the daemon to read files for it
+        umask = os.umask(0077)
+        try:
+            SocketServer.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+    def call(self, method, args, kwargs):
+        if method not in METHODS:
+            raise ValueError('unknown method "%s"' % method)
+
+        if method in ('add_many', 'add_stream'):
+            type_name = kwargs.get('type', NullType.type)
+            kwargs['type'] = get_type(type_name)
+            if kwargs['type'] is None:
+                raise ValueError('invalid type "%s"' % type_name)
+
+        LOG.debug('serving %s' % method)
+        return getattr(self.storage, method)(*args, **kwargs)
+
+    def export_metrics(self):
+        if self.metrics_file is None:
+            return
+        try:
+            cas.metrics.write(self.metrics_file)
+        except EnvironmentError, e:
+            LOG.warn('cannot write metrics to "%s": %s' % (self.metrics_file, e))
+
+    def _export_periodically(self, stopped):
+        while not stopped.wait(self.metrics_interval):
+            self.export_metrics()
+
+    def serve_forever(self, poll_interval=0.5):
+        # metrics are written from a thread of their own, so that requests
+        # never wait on the disk for them
+        stopped = threading.Event()
+        exporter = threading.Thread(target=self._export_periodically, args=(stopped,))
+        exporter.daemon = True
+        if self.metrics_file is not None:
+            exporter.start()
+        try:
+            SocketServer.UnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            stopped.set()
+            if exporter.is_alive():
+                exporter.join()
+            self.export_metrics()
+
+    def serve(self):
+        """
+        Serve requests until interrupted or terminated
+        """
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        LOG.debug('serving "%s" on "%s"' % (self.storage.root, self.socketfile))
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.server_close()
+            if os.path.exists(self.socketfile):
+                os.remove(self.socketfile)
+            self.storage.unlock()
+
+class RemoteCAS(object):
+    """
+    Forwards the served subset of the ``CAS`` API to a daemon
+    """
+    # daemons always hold their storage open for writing
+    readonly = False
+
+    def __init__(self, socketfile):
+        self.socketfile = socketfile
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socketfile)
+        except:
+            sock.close()
+            raise
+        return sock
+
+    def _raise(self, reply):
+        cls = ERRORS.get(reply['error'])
+        if cls is None:
+            raise DaemonError('%s: %s' % (reply['error'], ' '.join(map(str, reply['args']))))
+        raise cls(*reply['args'])
+
+    def _replies(self, method, args, kwargs, body=None):
+        sock = self._connect()
+        try:
+            sock.sendall(_dumps({'method': method, 'args': args, 'kwargs': kwargs}))
+            if body is not None:
+                try:
+                    shutil.copyfileobj(body, sock.makefile('wb', 0), 2**20)
+                    sock.shutdown(socket.SHUT_WR)
+                except socket.error, e:
+                    # the daemon may have rejected the request without
+                    # reading the data, in which case it says why
+                    LOG.debug('sending data failed: %s' % e)
+            for line in sock.makefile('rb'):
+                reply = _loads(line)
+                if 'error' in reply:
+                    self._raise(reply)
+                yield reply
+        finally:
+            sock.close()
+        raise DaemonError('daemon closed the connection')
+
+    def _call(self, method, *args, **kwargs):
+        for reply in self._replies(method, args, kwargs):
+            return reply['result']
+
+    def _send(self, body, method, *args, **kwargs):
+        for reply in self._replies(method, args, kwargs, body):
+            return reply['result']
+
+    def _stream(self, method, *args, **kwargs):
+        for reply in self._replies(method, args, kwargs):
+            if 'done' in reply:
+                return
+            yield reply['item']
+
+    def add(self, filename, type=NullType):
+        return list(self.add_many([filename], type=type))[0]
+
+    def add_many(self, filenames, type=NullType, batch_size=CAS_BATCH_SIZE,
+                 workers=CAS_WORKERS, pool=CAS_POOL, mode=None):
+        # the daemon doesn't share our working directory
+        filenames = [fullpath(filename) for filename in filenames]
+        return self._stream('add_many', filenames, type=type.type,
+          batch_size=batch_size, workers=workers, pool=pool, mode=mode)
+
+    def add_stream(self, fileobj, type=NullType):
+        return self._send(fileobj, 'add_stream', type=type.type)
+
+    def add_bytes(self, data, type=NullType):
+        return self.add_stream(io.BytesIO(data), type=type)
+
+    def remove(self, sum):
+        return self._call('remove', sum)
+
+    def list(self, prefix=None, after=None, limit=None):
+        return self._stream('list', prefix, after, limit)
+
+    def resolve(self, prefix):
+        return self._call('resolve', prefix)
+
+    def path(self, sum):
+        return self._call('path', sum)
+
+    def has_sum(self, sum):
+        return self._call('has_sum', sum)
+
+    def read(self, sum, offset=0, length=None):
+        return ''.join(self.stream(sum, offset, length))
+
+    def stream(self, sum, offset=0, length=None, block_size=2**16):
+        return self._stream('stream', sum, offset, length, block_size)
+
+    def send(self, sum, out, offset=0, length=None):
+        written = 0
+        for data in self.stream(sum, offset, length):
+            out.write(data)
+            written += len(data)
+        return written
+
+    def meta(self):
+        return self._call('meta')
+
+    def equals(self, key, value):
+        return self._stream('equals', key, value)
+
+    def match(self, key, value_regex=None, prefix=None, start=None, stop=None):
+        return self._stream('match', key, value_regex, prefix, start, stop)
+
+    def values(self, key, prefix=None, start=None, stop=None):
+        return self._stream('values', key, prefix, start, stop)
+
+    def query(self, expression):
+        if not isinstance(expression, basestring):
+            raise TypeError('only query expression strings can be sent to a daemon')
+        return self._stream('query', expression)
+
+    def gc(self, full=False, batch_size=CAS_BATCH_SIZE, resume=True):
+        return self._call('gc', full, batch_size, resume)
+
+    def repack(self):
+        return self._call('repack')
+
+    def stats(self):
+        return self._call('stats')
+
+    def verify(self, workers=CAS_WORKERS, rate=CAS_VERIFY_RATE,
+               batch_size=CAS_BATCH_SIZE, resume=True, quarantine=False):
+        return (Problem(*problem) for problem in self._stream('verify', workers, rate,
+          batch_size, resume, quarantine))
+
+def connect(socketfile):
+    """
+    A ``RemoteCAS`` for the daemon listening on ``socketfile``, or ``None``
+    if there isn't one
+    """
+    if not os.path.exists(socketfile):
+        return None
+
+    remote = RemoteCAS(socketfile)
+    try:
+        remote._connect().close()
+    except socket.error, e:
+        if e.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            LOG.debug('no daemon listening on "%s"' % socketfile)
+            return None
+        raise
+    return remote
@@ -0,0 +1,34 @@
+"""
+The hash functions a store can name its objects by.
+
+Each store records the one it uses in its metadata. ``sha1`` is what
+every store used before this was configurable, so it remains the default,
+though on 64-bit machines ``sha512`` (and ``blake2b``, where available) hash
+faster per byte.
+"""
+
+import hashlib
+
+try:
+    from pyblake2 import blake2b, blake2s
+except ImportError:
+    blake2b = getattr(hashlib, 'blake2b', None)
+    blake2s = getattr(hashlib, 'blake2s', None)
+
+HASHES = dict((name, getattr(hashlib, name)) for name in
+  ['sha1', 'sha224', 'sha256', 'sha384', 'sha512'])
+
+if blake2b is not None:
+    HASHES['blake2b'] = blake2b
+    HASHES['blake2s'] = blake2s
+
+DEFAULT_HASH = 'sha1'
+
+def get_hash(name):
+    """
+    The constructor of the hash function called ``name``
+    """
+    if name not in HASHES:
+        raise ValueError('invalid hash "%s", must be one of: %s' %
+          (name, ', '.join(sorted(HASHES))))
+    return HASHES[name]
@@ -0,0 +1,625 @@
+"""
+Index backends.
+
+A CAS keeps two indices next to its ``storage/`` directory: the sum index
+(every stored sum) and the meta index (which sums carry which meta
+key/value pairs). An ``IndexBackend`` bundles an implementation of both;
+the original shelve-based one, and one backed by a single SQLite database
+in WAL mode.
+"""
+
+from cas.util import to_str, prefix_end, literal_prefix
+from cas.segments import SegmentedList
+import os
+import re
+import shelve
+import anydbm
+import sqlite3
+import urllib
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# files a dbm may create for a given shelf filename
+DBM_SUFFIXES = ('', '.db', '.dat', '.dir', '.bak', '.pag')
+
+def value_bounds(prefix=None, start=None, stop=None):
+    """
+    Combine a prefix and a ``start <= value < stop`` range into one range
+    """
+    if prefix is not None:
+        prefix = to_str(prefix)
+        end = prefix_end(prefix)
+        start = prefix if start is None else max(to_str(start), prefix)
+        if end is not None:
+            stop = end if stop is None else min(to_str(stop), end)
+
+    start = None if start is None else to_str(start)
+    stop = None if stop is None else to_str(stop)
+
+    return start, stop
+
+class MetaQueries(object):
+    """
+    Queries common to every meta index, built on the ``postings``,
+    ``_value_range`` and ``_fields`` of the implementation
+    """
+    def equals(self, key, value):
+        return list(self.postings(key, value))
+
+    def values(self, key, prefix=None, start=None, stop=None):
+        """
+        Lazily yield the values of ``key`` in sorted order, limited to
+        those starting with ``prefix`` and within ``start <= value < stop``
+        """
+        start, stop = value_bounds(prefix, start, stop)
+        return self._value_range(to_str(key), start, stop)
+
+    def match(self, key, value_regex=None, prefix=None, start=None, stop=None):
+        """
+        Sums having a value of ``key`` that matches ``value_regex``, starts
+        with ``prefix`` and falls within ``start <= value < stop``. Only
+        values in the range implied by the prefix (including the literal
+        prefix of an anchored regex) are visited.
+        """
+        key = to_str(key)
+        regex = None
+
+        if value_regex is not None:
+            regex = re.compile(str(value_regex))
+            literal = literal_prefix(regex)
+            if prefix is None or literal.startswith(to_str(prefix)):
+                prefix = literal or prefix
+            elif not to_str(prefix).startswith(literal):
+                return []
+
+        matches = set()
+        for value in self.values(key, prefix, start, stop):
+            if regex is None or regex.search(value):
+                matches.update(self.postings(key, value))
+        return sorted(list(matches))
+
+    def keyspace(self):
+        data = {}
+        for key in self._fields():
+            data[key] = list(self.values(key))
+        return data
+
+    def has_sum(self, sum):
+        return bool(self.pairs(sum))
+
+    def triples(self):
+        """
+        Yield every ``(key, value, sum)`` in the index
+        """
+        for key in self._fields():
+            for value in self.values(key):
+                for sum in self.postings(key, value):
+                    yield key, value, sum
+
+class SumIndex(shelve.DbfilenameShelf):
+    """
+    Every stored sum. The sums are also kept in order, as a
+    ``SegmentedList`` in the ``order`` shelf, so they can be walked in order
+    from any point without loading them all.
+    """
+    def __init__(self, filename, flag='c', order=None, *args, **kwargs):
+        shelve.DbfilenameShelf.__init__(self, filename, flag, *args, **kwargs)
+        self.order = order if order is not None else {}
+
+    def _sorted(self):
+        return SegmentedList(self.order, 's')
+
+    def sorted(self, start=None, stop=None):
+        """
+        Lazily yield the stored sums ``start <= sum < stop`` in sorted order
+        """
+        sums = self._sorted()
+        if not sums and len(self):
+            # a read-only store from before the order was kept
+            return (sum for sum in sorted(self.keys())
+              if (start is None or sum >= start) and (stop is None or sum < stop))
+        return sums.range(start, stop)
+
+    def add(self, sum):
+        LOG.debug('adding "%s" to sum index' % sum)
+        self[str(sum)] = None
+        self._sorted().add(str(sum))
+
+    def remove(self, sum):
+        LOG.debug('removing "%s" from sum index' % sum)
+        del self[str(sum)]
+        self._sorted().remove(str(sum))
+
+    def rebuild_order(self):
+        """
+        Regenerate the sorted sums from scratch
+        """
+        LOG.debug('rebuilding sorted sum index')
+        sums = self._sorted()
+        sums.clear()
+        for sum in self.keys():
+            sums.add(sum)
+
+class ReverseMetaIndex(shelve.DbfilenameShelf):
+    """
+    Maps a checksum to the list of (key, value) meta pairs it is filed
+    under in the ``MetaIndex``, so lookups by sum don't have to scan the
+    whole keyspace.
+    """
+    def add(self, sum, key, value):
+        pairs = self.get(str(sum), [])
+        if (key, value) not in pairs:
+            pairs.append((key, value))
+            self[str(sum)] = pairs
+
+    def remove(self, sum, key, value):
+        pairs = self.get(str(sum), [])
+        if (key, value) not in pairs:
+            return
+
+        pairs.remove((key, value))
+
+        if pairs:
+            self[str(sum)] = pairs
+        else:
+            del self[str(sum)]
+
+    def find(self, sum):
+        return list(self.get(str(sum), []))
+
+class MetaIndex(MetaQueries, shelve.DbfilenameShelf):
+    """
+    Maps meta (key, value) pairs to the sums carrying them.
+
+    Rather than one pickled dict per key, every key's values and every
+    (key, value) posting list is a ``SegmentedList`` of its own, so adding
+    or removing a sum only rewrites a couple of small records and nothing
+    is cached in memory between operations.
+    """
+    format = 2
+
+    # like the SegmentedList records, this can't collide with a legacy
+    # store's keys, which are meta keys
+    format_key = '\x00format'
+
+    def __init__(self, filename, reverse, flag='c', *args, **kwargs):
+        shelve.DbfilenameShelf.__init__(self, filename, flag, *args, **kwargs)
+        self.reverse = reverse
+
+        if self.format_key not in self and flag != 'r':
+            if self.get('format') == self.format:
+                # written before the format moved out of the way of meta keys
+                del self['format']
+            elif len(self) > 0:
+                self._upgrade()
+            self[self.format_key] = self.format
+
+    def _upgrade(self):
+        """
+        Convert a store from the original one-dict-per-key layout
+        """
+        LOG.debug('upgrading meta index to format %d' % self.format)
+        old = dict(self.iteritems())
+        self.clear()
+        for key, valuespace in old.iteritems():
+            for value, sums in valuespace.iteritems():
+                for sum in sums:
+                    self.add(key, value, sum)
+
+    def _keys(self):
+        return SegmentedList(self, 'k')
+
+    def _values(self, key):
+        return SegmentedList(self, 'v\x00%s' % key)
+
+    def _postings(self, key, value):
+        return SegmentedList(self, 'p\x00%s\x00%s' % (key, value))
+
+    def add(self, key, value, sum):
+        key, value, sum = to_str(key), to_str(value), str(sum)
+        LOG.debug('adding meta %s=%s for sum "%s"' % (key, value, sum))
+
+        if self._postings(key, value).add(sum):
+            self._values(key).add(value)
+            self._keys().add(key)
+
+        self.reverse.add(sum, key, value)
+
+    def remove(self, key, value, sum):
+        key, value, sum = to_str(key), to_str(value), str(sum)
+        LOG.debug('removing meta %s=%s for sum "%s"' % (key, value, sum))
+        postings = self._postings(key, value)
+
+        if not postings.remove(sum):
+            LOG.error('no such meta %s=%s for sum "%s"' % (key, value, sum))
+            return
+
+        self.reverse.remove(sum, key, value)
+
+        # garbage collection on valuespace
+        if not postings:
+            values = self._values(key)
+            values.remove(value)
+
+            # garbage collection on keyspace
+            if not values:
+                self._keys().remove(key)
+
+    def _find(self, sum):
+        return self.reverse.find(sum)
+
+    def rebuild_reverse(self):
+        """
+        Regenerate the reverse index from scratch using the forward index
+        """
+        LOG.debug('rebuilding reverse meta index')
+        self.reverse.clear()
+        for key in self._keys():
+            for value in self._values(key):
+                for sum in self._postings(key, value):
+                    self.reverse.add(sum, key, value)
+        self.reverse.sync()
+
+    def remove_all(self, sum):
+        for key, value in self._find(sum):
+            self.remove(key, value, sum)
+
+    def postings(self, key, value, start=None):
+        """
+        Lazily yield the sums having ``key=value`` that are ``>= start``
+        """
+        return self._postings(to_str(key), to_str(value)).range(start)
+
+    def count(self, key, value):
+        return len(self._postings(to_str(key), to_str(value)))
+
+    def pairs(self, sum):
+        return self._find(sum)
+
+    def _value_range(self, key, start, stop):
+        return self._values(key).range(start, stop)
+
+    def _fields(self):
+        return iter(self._keys())
+
+    def is_empty(self):
+        return not self._keys()
+
+class PackIndex(shelve.Shelf):
+    """
+    Maps the sum of each packed object to the ``(pack, offset, length)``
+    of its data
+    """
+    def add(self, sum, pack, offset, length):
+        LOG.debug('adding "%s" to pack index' % sum)
+        self[str(sum)] = (pack, offset, length)
+
+    def remove(self, sum):
+        LOG.debug('removing "%s" from pack index' % sum)
+        del self[str(sum)]
+
+    def find(self, sum):
+        return self.get(str(sum))
+
+class SqliteSumIndex(object):
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, sum):
+        LOG.debug('adding "%s" to sum index' % sum)
+        self.db.execute('INSERT OR IGNORE INTO sums (sum) VALUES (?)', (str(sum),))
+
+    def remove(self, sum):
+        LOG.debug('removing "%s" from sum index' % sum)
+        if not self.db.execute('DELETE FROM sums WHERE sum = ?', (str(sum),)).rowcount:
+            raise KeyError(sum)
+
+    def has_key(self, sum):
+        return self.db.execute('SELECT 1 FROM sums WHERE sum = ?',
+          (str(sum),)).fetchone() is not None
+
+    __contains__ = has_key
+
+    def sorted(self, start=None, stop=None):
+        """
+        Lazily yield the stored sums ``start <= sum < stop`` in sorted order
+        """
+        query, args = 'SELECT sum FROM sums WHERE sum >= ?', [start or '']
+        if stop is not None:
+            query += ' AND sum < ?'
+            args.append(stop)
+        for (sum,) in self.db.execute(query + ' ORDER BY sum', args):
+            yield sum
+
+    def keys(self):
+        return list(self.sorted())
+
+    def iteritems(self):
+        for sum in self.sorted():
+            yield sum, None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM sums').fetchone()[0]
+
+    def sync(self):
+        self.db.commit()
+
+class SqlitePackIndex(object):
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, sum, pack, offset, length):
+        LOG.debug('adding "%s" to pack index' % sum)
+        self.db.execute('INSERT OR REPLACE INTO packs (sum, pack, offset, length) '
+          'VALUES (?, ?, ?, ?)', (str(sum), pack, offset, length))
+
+    def remove(self, sum):
+        LOG.debug('removing "%s" from pack index' % sum)
+        if not self.db.execute('DELETE FROM packs WHERE sum = ?', (str(sum),)).rowcount:
+            raise KeyError(sum)
+
+    def find(self, sum):
+        return self.db.execute('SELECT pack, offset, length FROM packs WHERE sum = ?',
+          (str(sum),)).fetchone()
+
+    def iteritems(self):
+        for row in self.db.execute('SELECT sum, pack, offset, length FROM packs'):
+            yield row[0], tuple(row[1:])
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM packs').fetchone()[0]
+
+class SqliteMetaIndex(MetaQueries):
+    def __init__(self, db):
+        self.db = db
+
+    def add(self, key, value, sum):
+        key, value, sum = to_str(key), to_str(value), str(sum)
+        LOG.debug('adding meta %s=%s for sum "%s"' % (key, value, sum))
+        self.db.execute('INSERT OR IGNORE INTO meta (key, value, sum) VALUES (?, ?, ?)',
+          (key, value, sum))
+
+    def remove(self, key, value, sum):
+        key, value, sum = to_str(key), to_str(value), str(sum)
+        LOG.debug('removing meta %s=%s for sum "%s"' % (key, value, sum))
+        if not self.db.execute('DELETE FROM meta WHERE key = ? AND value = ? AND sum = ?',
+          (key, value, sum)).rowcount:
+            LOG.error('no such meta %s=%s for sum "%s"' % (key, value, sum))
+
+    def remove_all(self, sum):
+        self.db.execute('DELETE FROM meta WHERE sum = ?', (str(sum),))
+
+    def postings(self, key, value, start=None):
+        """
+        Lazily yield the sums having ``key=value`` that are ``>= start``
+        """
+        cursor = self.db.execute('SELECT sum FROM meta WHERE key = ? AND value = ? '
+          'AND sum >= ? ORDER BY sum', (to_str(key), to_str(value), start or ''))
+        for (sum,) in cursor:
+            yield sum
+
+    def count(self, key, value):
+        return self.db.execute('SELECT COUNT(*) FROM meta WHERE key = ? AND value = ?',
+          (to_str(key), to_str(value))).fetchone()[0]
+
+    def pairs(self, sum):
+        return self.db.execute('SELECT key, value FROM meta WHERE sum = ?',
+          (str(sum),)).fetchall()
+
+    def _value_range(self, key, start, stop):
+        query = 'SELECT DISTINCT value FROM meta WHERE key = ? AND value >= ?'
+        args = [key, start or '']
+        if stop is not None:
+            query += ' AND value < ?'
+            args.append(stop)
+        for (value,) in self.db.execute(query + ' ORDER BY value', args):
+            yield value
+
+    def _fields(self):
+        for (key,) in self.db.execute('SELECT DISTINCT key FROM meta ORDER BY key'):
+            yield key
+
+    def is_empty(self):
+        return self.db.execute('SELECT 1 FROM meta LIMIT 1').fetchone() is None
+
+    def sync(self):
+        self.db.commit()
+
+class IndexBackend(object):
+    """
+    The indices kept under a CAS root. Subclasses open ``sums`` (the sum
+    index), ``meta`` (the meta index) and ``packs`` (the pack index) for
+    ``root``, read-only if ``readonly`` is set, in which case nothing is
+    ever written back.
+    """
+    name = None
+
+    # whether readers can safely use the indices while a writer has them
+    # open, so they don't need to hold a shared lock on the store
+    concurrent_readers = False
+
+    def __init__(self, root, readonly=False):
+        self.root = root
+        self.readonly = readonly
+
+    @classmethod
+    def exists(cls, root):
+        """
+        Whether this backend's indices exist under ``root``
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+    def reindex(self):
+        """
+        Rebuild any derived indices from the primary ones
+        """
+        pass
+
+    def close(self):
+        raise NotImplementedError
+
+    def destroy(self):
+        """
+        Close and delete the indices
+        """
+        raise NotImplementedError
+
+class ShelveBackend(IndexBackend):
+    name = 'shelve'
+
+    def __init__(self, root, readonly=False):
+        super(ShelveBackend, self).__init__(root, readonly)
+        flag = readonly and 'r' or 'c'
+        order = self.filenames(root)[4]
+        if readonly and not any(os.path.isfile(order + s) for s in DBM_SUFFIXES):
+            # stores from before the sums were kept in order
+            self.order = {}
+        else:
+            self.order = shelve.open(order, flag)
+        self.sums = SumIndex(self.filenames(root)[0], flag, self.order)
+        self.reverse = ReverseMetaIndex(self.filenames(root)[2], flag)
+        self.meta = MetaIndex(self.filenames(root)[1], self.reverse, flag)
+
+        packs = self.filenames(root)[3]
+        if readonly and not any(os.path.isfile(packs + s) for s in DBM_SUFFIXES):
+            # stores from before packfiles have no pack index to read
+            self.packs = PackIndex({})
+        else:
+            self.packs = PackIndex(anydbm.open(packs, flag))
+
+        # stores created before the reverse index existed need it populated
+        if not readonly and not self.meta.is_empty() and not len(self.reverse):
+            self.meta.rebuild_reverse()
+        # likewise the sorted sums
+        if not readonly and len(self.sums) and not len(self.order):
+            self.sums.rebuild_order()
+
+    @classmethod
+    def filenames(cls, root):
+        return [os.path.join(root, name) for name in
+          ('.files', '.filemeta', '.filesums', '.packs', '.fileorder')]
+
+    @classmethod
+    def exists(cls, root):
+        sums = cls.filenames(root)[0]
+        return any(os.path.isfile(sums + suffix) for suffix in DBM_SUFFIXES)
+
+    def commit(self):
+        if self.readonly:
+            return
+        self.sums.sync()
+        self.order.sync()
+        self.meta.sync()
+        self.reverse.sync()
+        self.packs.sync()
+
+    def reindex(self):
+        self.meta.rebuild_reverse()
+        self.sums.rebuild_order()
+
+    def close(self):
+        self.sums.close()
+        if not isinstance(self.order, dict):
+            self.order.close()
+        self.meta.close()
+        self.reverse.close()
+        self.packs.close()
+
+    def destroy(self):
+        self.close()
+        for filename in self.filenames(self.root):
+            for suffix in DBM_SUFFIXES:
+                if os.path.isfile(filename + suffix):
+                    os.remove(filename + suffix)
+
+class SqliteBackend(IndexBackend):
+    """
+    Both indices in one SQLite database, in WAL mode so readers don't block
+    behind a writer
+    """
+    name = 'sqlite'
+    concurrent_readers = True
+
+    schema = [
+      'CREATE TABLE IF NOT EXISTS sums (sum TEXT PRIMARY KEY) WITHOUT ROWID',
+      'CREATE TABLE IF NOT EXISTS meta (key TEXT NOT NULL, value TEXT NOT NULL, '
+        'sum TEXT NOT NULL, PRIMARY KEY (key, value, sum)) WITHOUT ROWID',
+      'CREATE INDEX IF NOT EXISTS meta_sum ON meta (sum)',
+      'CREATE TABLE IF NOT EXISTS packs (sum TEXT PRIMARY KEY, pack INTEGER NOT NULL, '
+        'offset INTEGER NOT NULL, length INTEGER NOT NULL) WITHOUT ROWID',
+    ]
+
+    def __init__(self, root, readonly=False):
+        super(SqliteBackend, self).__init__(root, readonly)
+        self.db = self._connect(self.filename(root), readonly)
+        self.db.text_factory = str
+        if not readonly:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.schema:
+                self.db.execute(statement)
+            self.db.commit()
+
+        self.sums = SqliteSumIndex(self.db)
+        self.meta = SqliteMetaIndex(self.db)
+
+        if readonly and not self.db.execute("SELECT 1 FROM sqlite_master "
+          "WHERE type = 'table' AND name = 'packs'").fetchone():
+            # stores from before packfiles have no pack index to read
+            self.packs = PackIndex({})
+        else:
+            self.packs = SqlitePackIndex(self.db)
+
+    @classmethod
+    def _connect(cls, filename, readonly):
+        if not readonly:
+            return sqlite3.connect(filename)
+
+        try:
+            db = sqlite3.connect('file:%s?mode=ro' % urllib.pathname2url(filename),
+              uri=True)
+        except TypeError:
+            # this sqlite3 module can't open URIs, so rely on the pragma
+            db = sqlite3.connect(filename)
+        # refuse writes even if the file could be opened for them
+        db.execute('PRAGMA query_only = ON')
+        return db
+
+    @classmethod
+    def filename(cls, root):
+        return os.path.join(root, '.index.sqlite')
+
+    @classmethod
+    def exists(cls, root):
+        return os.path.isfile(cls.filename(root))
+
+    def commit(self):
+        if not self.readonly:
+            self.db.commit()
+
+    def reindex(self):
+        self.db.execute('REINDEX')
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def destroy(self):
+        self.db.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.isfile(self.filename(self.root) + suffix):
+                os.remove(self.filename(self.root) + suffix)
+
+BACKENDS = dict((cls.name, cls) for cls in [ShelveBackend, SqliteBackend])
+
+DEFAULT_BACKEND = ShelveBackend.name
+
+def get_backend(name):
+    if name not in BACKENDS:
+        raise ValueError('invalid index backend "%s", must be one of: %s' %
+          (name, ', '.join(sorted(BACKENDS))))
+    return BACKENDS[name]
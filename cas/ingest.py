@@ -0,0 +1,157 @@
+from cas.util import checksum, copy_checksum, shard, fullpath, stat_key, \
+  hardlink, reflink, kernel_copy
+from cas.files import get_type
+from cas.chunks import ChunkStore
+from cas.hashes import get_hash, DEFAULT_HASH
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from collections import namedtuple
+from itertools import imap
+import tempfile
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+POOLS = {
+  'thread': ThreadPool,
+  'process': Pool,
+}
+
+# ways of placing a file into the temporary directory without copying its
+# bytes through userspace, each falling back to a plain copy on failure
+MODES = {
+  'hardlink': hardlink,
+  'reflink': reflink,
+  'kernel': kernel_copy,
+}
+
+DEFAULT_MODE = 'copy'
+
+Inspected = namedtuple('Inspected', 'filename sum type meta tmpfile stat')
+
+# where a store keeps its objects, for workers to tell whether a sum is
+# already stored: the loose object directory and the ``suffixes`` its
+# compressed objects may have, the root of its ``ChunkStore`` (and how
+# large files must be to be chunked, and the average chunk size), and a
+# Bloom filter ``stored`` of sums kept elsewhere (packed objects), or of
+# every stored sum if ``complete``
+Layout = namedtuple('Layout', 'storagedir width depth suffixes chunkroot chunk_threshold '
+  'chunk_size stored complete')
+
+# a layout with nothing stored, and where nothing is chunked
+NO_LAYOUT = Layout(None, None, None, (), None, 0, None, None, False)
+
+def is_stored(sum, layout):
+    """
+    Whether ``sum`` looks to be stored in ``layout``. This may be wrong
+    either way if storage changes meanwhile (or is a Bloom filter's false
+    positive), so it's only good for skipping work.
+    """
+    if layout.storagedir is None:
+        return False
+    if layout.complete:
+        return sum in layout.stored
+    path = os.path.join(layout.storagedir, *shard(sum, layout.width, layout.depth))
+    for suffix in ('',) + layout.suffixes:
+        if os.path.isfile(path + suffix):
+            return True
+    if ChunkStore(layout.chunkroot, layout.width, layout.depth).has(sum):
+        return True
+    return layout.stored is not None and sum in layout.stored
+
+def ingest_mode(mode):
+    if mode != DEFAULT_MODE and mode not in MODES:
+        raise ValueError('invalid ingest mode "%s", must be one of: %s' %
+          (mode, ', '.join(sorted(MODES.keys() + [DEFAULT_MODE]))))
+    return mode
+
+def ingest_file(src, dst, mode=DEFAULT_MODE, hash=DEFAULT_HASH):
+    """
+    Place the contents of ``src`` at ``dst`` using the given ingest mode,
+    returning the checksum of the result under the hash function ``hash``
+    """
+    hash_func = get_hash(hash)
+    if mode != DEFAULT_MODE:
+        try:
+            MODES[mode](src, dst)
+            return checksum(dst, hash_func)
+        except (OSError, IOError), e:
+            LOG.debug('%s of "%s" failed (%s), falling back to copy' % (mode, src, e))
+
+    return copy_checksum(src, dst, hash_func)
+
+def inspect_file(job):
+    """
+    Ingest a file into the temporary directory while checksumming it and,
+    unless it is already in storage, verify its type and compute its
+    metadata.
+
+    This is the half of an add that doesn't touch the indices, so it is
+    safe to run many of these at once. It runs inside worker pools, so it
+    only takes and returns picklable values: ``job`` is a tuple of the
+    filename, the type name, the ingest mode, the temporary directory, the
+    storage ``Layout``, the file's sum if it is already known to be stored
+    (or ``None``) and the name of the store's hash function. If the
+    layout's ``storagedir`` is ``None`` the file is always verified.
+
+    Files at or above the layout's ``chunk_threshold`` are chunked here
+    too, and their ``tmpfile`` is the manifest ``ChunkStore.stage`` wrote.
+    The returned ``tmpfile`` is ``None`` if the file was already stored,
+    and ``stat`` is the file's ``stat_key`` from before it was read.
+    """
+    filename, type_name, mode, tmpdir, layout, known, hash = job
+
+    if known:
+        return Inspected(filename, known, None, None, None, None)
+
+    fdno, tmpfile = tempfile.mkstemp(dir=tmpdir)
+    os.close(fdno)
+
+    try:
+        full = fullpath(filename)
+        key = stat_key(full)
+        LOG.debug('ingesting "%s" to "%s" (%s)' % (full, tmpfile, mode))
+        sum = ingest_file(full, tmpfile, mode, hash)
+
+        if is_stored(sum, layout):
+            os.remove(tmpfile)
+            return Inspected(filename, sum, None, None, None, key)
+
+        typed = get_type(type_name)(filename)
+        typed.verify()
+        meta = typed.meta()
+
+        if layout.chunk_threshold and os.path.getsize(tmpfile) >= layout.chunk_threshold:
+            store = ChunkStore(layout.chunkroot, layout.width, layout.depth,
+              layout.chunk_size, get_hash(hash))
+            data, tmpfile = tmpfile, store.stage(tmpfile, tmpdir)
+            os.remove(data)
+
+        return Inspected(filename, sum, typed.type, meta, tmpfile, key)
+    except:
+        if os.path.isfile(tmpfile):
+            os.remove(tmpfile)
+        raise
+
+def inspect_files(jobs, workers=1, pool='thread', chunksize=16):
+    """
+    Lazily run ``inspect_file`` over ``jobs``, yielding results in input
+    order. With more than one worker, jobs are spread over a pool of
+    threads or processes.
+    """
+    if workers <= 1:
+        for inspected in imap(inspect_file, jobs):
+            yield inspected
+        return
+
+    if pool not in POOLS:
+        raise ValueError('invalid pool type "%s"' % pool)
+
+    LOG.debug('inspecting files using %d %s workers' % (workers, pool))
+    workers = POOLS[pool](workers)
+    try:
+        for inspected in workers.imap(inspect_file, jobs, chunksize):
+            yield inspected
+    finally:
+        workers.terminate()
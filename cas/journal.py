@@ -0,0 +1,51 @@
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+ADD = 'add'
+REMOVE = 'rm'
+
+class Journal(object):
+    """
+    An append-only log of in-flight add and remove intents.
+
+    Every sum is recorded here before the indices or ``storage/`` are
+    touched for it, and the journal is cleared once the operation has been
+    committed. Whatever is left in the journal when the store is next
+    opened is exactly the set of sums that may need reconciling, so that
+    doesn't require sweeping the whole store.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = open(filename, 'a')
+
+    def record(self, op, sum):
+        LOG.debug('journaling %s of "%s"' % (op, sum))
+        self._fd.write('%s %s\n' % (op, sum))
+        self._fd.flush()
+
+    def sync(self):
+        self._fd.flush()
+        os.fsync(self._fd.fileno())
+
+    def entries(self):
+        """
+        The ``(op, sum)`` intents currently in the journal, in order
+        """
+        entries = []
+        for line in open(self.filename):
+            # a torn final write has no newline, and nothing was done
+            # for it yet
+            if not line.endswith('\n'):
+                break
+            op, sum = line.split()
+            entries.append((op, sum))
+        return entries
+
+    def clear(self):
+        self._fd.truncate(0)
+        self.sync()
+
+    def close(self):
+        self._fd.close()
@@ -0,0 +1,78 @@
+import fcntl
+import errno
+import time
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+class FileLock(object):
+    """
+    A shared or exclusive ``flock(2)`` lock on a file.
+
+    The lock belongs to the open file, so the kernel releases it when the
+    holding process exits, crashed or not, and the lock file itself is
+    never removed.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._fd = None
+        self.shared = False
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self, shared=False, timeout=0, interval=0.05):
+        """
+        Take the lock, waiting up to ``timeout`` seconds for conflicting
+        holders to let go. Returns whether the lock was taken.
+        """
+        if self.held:
+            return False
+
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0644)
+        flags = (shared and fcntl.LOCK_SH or fcntl.LOCK_EX) | fcntl.LOCK_NB
+        deadline = time.time() + timeout
+
+        while True:
+            try:
+                fcntl.flock(fd, flags)
+                break
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    os.close(fd)
+                    raise
+                if time.time() >= deadline:
+                    os.close(fd)
+                    return False
+                time.sleep(interval)
+
+        LOG.debug('acquired %s lock on "%s"' %
+          (shared and 'shared' or 'exclusive', self.filename))
+        self._fd = fd
+        self.shared = shared
+        return True
+
+    def release(self):
+        if not self.held:
+            return
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        os.close(self._fd)
+        self._fd = None
+        LOG.debug('released lock on "%s"' % self.filename)
+
+    def is_locked(self):
+        """
+        Whether this or any other process holds the lock
+        """
+        if self.held:
+            return True
+        if not os.path.isfile(self.filename):
+            return False
+
+        probe = FileLock(self.filename)
+        if probe.acquire():
+            probe.release()
+            return False
+        return True
@@ -0,0 +1,264 @@
+"""
+Counters, gauges and latency histograms collected by the running process.
+
+Metrics live in a registry (by default the module's ``REGISTRY``) and are
+declared where they are recorded, getting the existing metric if another
+module declared it first:
+
+    ADDED = metrics.counter('cas_objects_added_total', 'Objects added')
+    ADDED.inc()
+
+Functions wrapped in ``cas.util.timeit`` report how long each call took to
+any hooks added with ``add_hook``, and to a histogram if they name one.
+
+A registry's ``snapshot`` is a plain dict that survives JSON (this is what
+the daemon sends back for ``stats``), and ``to_text`` and ``to_prometheus``
+render a snapshot for people and for Prometheus' text format (e.g. for the
+node exporter's textfile collector).
+"""
+
+from collections import OrderedDict
+import threading
+import bisect
+import json
+import time
+import os
+import logging
+
+LOG = logging.getLogger(__name__)
+
+# latency histogram bucket bounds, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+  2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+INF = '+Inf'
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {'type': self.type, 'help': self.help, 'value': self.value}
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def reset(self):
+        # gauges that were never measured aren't reported as zero
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+class Histogram(Counter):
+    """
+    Counts observations into cumulative buckets bounded by ``buckets``
+    """
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        Counter.__init__(self, name, help)
+
+    def reset(self):
+        self.count = 0
+        self.sum = 0.0
+        # the last bucket is +Inf
+        self._counts = [0] * (len(self.buckets) + 1)
+
+    def observe(self, value):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts, total = list(self._counts), self.sum
+        cumulative, buckets = 0, []
+        for bound, count in zip(self.buckets + (INF,), counts):
+            cumulative += count
+            buckets.append([bound, cumulative])
+        snapshot = {'type': self.type, 'help': self.help, 'count': cumulative,
+          'sum': total, 'buckets': buckets}
+        for pct in (50, 90, 99):
+            snapshot['p%d' % pct] = percentile(buckets, pct)
+        return snapshot
+
+def percentile(buckets, pct):
+    """
+    The upper bound of the bucket holding the ``pct`` percentile of a
+    histogram snapshot's ``buckets``, or ``None`` if it is empty
+    """
+    total = buckets and buckets[-1][1]
+    if not total:
+        return None
+    rank = pct / 100.0 * total
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            return bound
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _declare(self, cls, name, *args):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError('metric "%s" is already a %s' % (name, metric.type))
+            return metric
+
+    def counter(self, name, help=''):
+        return self._declare(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._declare(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=BUCKETS):
+        return self._declare(Histogram, name, help, buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+    def snapshot(self):
+        return OrderedDict((name, metric.snapshot())
+          for name, metric in self._metrics.items())
+
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+_hooks = []
+
+def add_hook(hook):
+    """
+    Call ``hook(hint, seconds)`` after every call to a ``timeit`` function,
+    e.g. to profile where time goes without turning on debug logging
+    """
+    _hooks.append(hook)
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+def record_call(hint, elapsed, metric=None):
+    """
+    Report a timed call to the hooks, and to the histogram ``metric``
+    """
+    if metric is not None:
+        REGISTRY.histogram(metric).observe(elapsed)
+    for hook in list(_hooks):
+        try:
+            hook(hint, elapsed)
+        except Exception:
+            LOG.exception('metrics hook %r failed' % hook)
+
+def timed_call(hint, metric, func, *args):
+    """
+    Call ``func(*args)`` and record how long it took. Lazy results are
+    timed until they are exhausted or closed, counting the time spent
+    producing their items but not consuming them.
+    """
+    start = time.time()
+    result = func(*args)
+    elapsed = time.time() - start
+    if isinstance(result, (list, tuple, set)):
+        record_call(hint, elapsed, metric)
+        return result
+    return _timed_iter(hint, metric, result, elapsed)
+
+def _timed_iter(hint, metric, iterable, elapsed=0.0):
+    iterator = iter(iterable)
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        record_call(hint, elapsed, metric)
+
+def to_text(snapshot):
+    """
+    A line per metric of a snapshot, for people
+    """
+    lines = []
+    # the daemon's snapshots lose their order on the way to the client
+    for name, metric in sorted(snapshot.items()):
+        if metric['type'] == 'histogram':
+            if not metric['count']:
+                lines.append('%s count=0' % name)
+                continue
+            lines.append('%s count=%d mean=%.6f p50<=%s p90<=%s p99<=%s' % (name,
+              metric['count'], metric['sum'] / metric['count'], metric['p50'],
+              metric['p90'], metric['p99']))
+        elif metric['value'] is not None:
+            lines.append('%s %s' % (name, metric['value']))
+    return '\n'.join(lines) + '\n'
+
+def _number(value):
+    # repr keeps a float's precision, but would add an L to longs
+    return isinstance(value, float) and repr(value) or str(value)
+
+def to_prometheus(snapshot):
+    """
+    A snapshot in the Prometheus text exposition format
+    """
+    lines = []
+    for name, metric in sorted(snapshot.items()):
+        if metric.get('value', 0) is None:
+            continue
+        if metric['help']:
+            lines.append('# HELP %s %s' % (name, metric['help']))
+        lines.append('# TYPE %s %s' % (name, metric['type']))
+        if metric['type'] == 'histogram':
+            for bound, count in metric['buckets']:
+                lines.append('%s_bucket{le="%s"} %d' % (name, _number(bound), count))
+            lines.append('%s_sum %r' % (name, metric['sum']))
+            lines.append('%s_count %d' % (name, metric['count']))
+        else:
+            lines.append('%s %s' % (name, _number(metric['value'])))
+    return '\n'.join(lines) + '\n'
+
+def write(filename, snapshot=None):
+    """
+    Atomically write a snapshot (by default of ``REGISTRY``) to
+    ``filename``, in Prometheus' format if it ends in ``.prom`` and as JSON
+    otherwise
+    """
+    if snapshot is None:
+        snapshot = REGISTRY.snapshot()
+    if filename.endswith('.prom'):
+        data = to_prometheus(snapshot)
+    else:
+        data = json.dumps(snapshot, indent=2) + '\n'
+
+    tmpfile = filename + '.new'
+    with open(tmpfile, 'w') as fd:
+        fd.write(data)
+    os.rename(tmpfile, filename)
@@ -0,0 +1,208 @@
+"""
+Packfiles, the storage tier for small objects.
+
+Storing every object as a file of its own costs an inode and a directory
+entry each, which adds up over millions of small objects. Objects under the
+storage's pack threshold are instead appended to numbered, append-only
+packfiles, and the pack index maps each one's sum to where its data is.
+Every object is preceded by a ``<sum> <length>\\n`` header, so a pack can be
+understood without the index.
+
+Removing a packed object only drops it from the index. ``repack`` rewrites
+the packs that contain removed objects and deletes the originals once the
+index points at the copies.
+"""
+
+from cas.config import CAS_PACK_SIZE
+from cas.util import mkdir_p, RangeReader
+from collections import defaultdict
+import mmap
+import os
+import re
+import shutil
+import logging
+
+LOG = logging.getLogger(__name__)
+
+PACK_RE = re.compile(r'^pack-(\d+)\.pack$')
+
+HEADER = '%s %d\n'
+
+class PackStore(object):
+    """
+    The packfiles under ``directory``, indexed by the pack index ``index``.
+    Packs are closed to new objects once they reach ``max_size`` bytes.
+    """
+    def __init__(self, directory, index, max_size=CAS_PACK_SIZE):
+        self.directory = directory
+        self.index = index
+        self.max_size = max_size
+        self._writer = None
+        self._maps = {}
+
+    def filename(self, pack):
+        return os.path.join(self.directory, 'pack-%06d.pack' % pack)
+
+    def packs(self):
+        """
+        The ids of the packs on disk, in order
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        matches = [PACK_RE.match(name) for name in os.listdir(self.directory)]
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    def has(self, sum):
+        return self.index.find(sum) is not None
+
+    def append(self, sum, filename):
+        """
+        Append the contents of ``filename`` to a pack as the object ``sum``
+        """
+        with open(filename, 'rb') as fd:
+            self._write(sum, fd, os.path.getsize(filename))
+
+    def _write(self, sum, fileobj, length):
+        header = HEADER % (sum, length)
+        pack, fd = self._writable(len(header) + length)
+        fd.write(header)
+        offset = fd.tell()
+        shutil.copyfileobj(fileobj, fd)
+        LOG.debug('packed "%s" into pack %d at %d' % (sum, pack, offset))
+        self.index.add(sum, pack, offset, length)
+
+    def _writable(self, size, fresh=False):
+        """
+        The ``(pack, file)`` to append ``size`` more bytes to, starting a new
+        pack if the current one is full (or if ``fresh`` is set)
+        """
+        if self._writer is not None:
+            pack, fd = self._writer
+            if fd.tell() == 0 or fd.tell() + size <= self.max_size:
+                return self._writer
+            self._close_writer()
+        elif not fresh and self.packs():
+            pack = self.packs()[-1]
+            if os.path.getsize(self.filename(pack)) + size <= self.max_size:
+                return self._open_writer(pack)
+
+        packs = self.packs()
+        return self._open_writer(packs and packs[-1] + 1 or 0)
+
+    def _open_writer(self, pack):
+        mkdir_p(self.directory)
+        fd = open(self.filename(pack), 'ab')
+        fd.seek(0, os.SEEK_END)
+        self._writer = (pack, fd)
+        return self._writer
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self.sync()
+            self._writer[1].close()
+            self._writer = None
+
+    def sync(self):
+        """
+        Flush appended objects to disk, which must happen before the pack
+        index entries for them are committed
+        """
+        if self._writer is not None:
+            fd = self._writer[1]
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def _map(self, pack, end):
+        mapped = self._maps.get(pack)
+        if mapped is None or len(mapped) < end:
+            if self._writer is not None and self._writer[0] == pack:
+                self._writer[1].flush()
+            if mapped is not None:
+                mapped.close()
+            with open(self.filename(pack), 'rb') as fd:
+                mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[pack] = mapped
+        return mapped
+
+    def read(self, sum, offset=0, length=None):
+        """
+        The data of a packed object, or ``length`` bytes of it from ``offset``
+        """
+        entry = self.index.find(sum)
+        if entry is None:
+            raise KeyError(sum)
+        pack, start, size = entry
+        end = start + size
+        start = min(start + offset, end)
+        if length is not None:
+            end = min(start + length, end)
+        return self._map(pack, end)[start:end]
+
+    def open(self, sum):
+        """
+        A file object over a packed object's data
+        """
+        entry = self.index.find(sum)
+        if entry is None:
+            raise KeyError(sum)
+        pack, offset, length = entry
+        if self._writer is not None and self._writer[0] == pack:
+            self._writer[1].flush()
+        return RangeReader(open(self.filename(pack), 'rb'), offset, length)
+
+    def remove(self, sum):
+        self.index.remove(sum)
+
+    def repack(self, full=False):
+        """
+        Copy the objects still in the index out of every pack holding removed
+        objects (or garbage left by an interrupted append) into new packs.
+        With ``full``, every pack is rewritten, e.g. so that the headers name
+        objects by the sums the index now has for them.
+
+        Returns the ids of the packs that are no longer needed. They may
+        only be deleted (see ``delete``) once the index is committed.
+        """
+        # copies always go to packs newer than any being repacked
+        self._close_writer()
+
+        live = defaultdict(list)
+        for s, (pack, offset, length) in self.index.iteritems():
+            live[pack].append((offset, length, s))
+
+        obsolete = []
+        for pack in self.packs():
+            entries = sorted(live.get(pack, []))
+            used = sum(len(HEADER % (s, length)) + length for _, length, s in entries)
+            if not full and used == os.path.getsize(self.filename(pack)):
+                continue
+
+            LOG.debug('repacking %d objects from pack %d' % (len(entries), pack))
+            for offset, length, s in entries:
+                self._repack_entry(s, pack, offset, length)
+            obsolete.append(pack)
+
+        self.sync()
+        return obsolete
+
+    def _repack_entry(self, sum, pack, offset, length):
+        data = self._map(pack, offset + length)[offset:offset + length]
+        header = HEADER % (sum, length)
+        new, fd = self._writable(len(header) + length, fresh=True)
+        fd.write(header)
+        self.index.add(sum, new, fd.tell(), length)
+        fd.write(data)
+
+    def delete(self, packs):
+        for pack in packs:
+            mapped = self._maps.pop(pack, None)
+            if mapped is not None:
+                mapped.close()
+            LOG.debug('deleting pack %d' % pack)
+            os.remove(self.filename(pack))
+
+    def close(self):
+        self._close_writer()
+        for mapped in self._maps.values():
+            mapped.close()
+        self._maps = {}
@@ -1,39 +1,207 @@
+"""
+RPM packages, described by the tags in their header.
+
+Only the lead and the signature and main headers at the front of a package
+are read, never the payload, so this is a few KB of I/O per package. The
+main header is checked against the digests of it in the signature, like
+librpm does. The headers are parsed here rather than by librpm, which is
+only used (if its bindings are installed) for packages this parser can't
+make sense of.
+"""
+
 from cas.files import CASFileType, register_type, InvalidFileType
-import rpm
+import hashlib
+import struct
 import logging
 
+try:
+    import rpm
+except ImportError:
+    rpm = None
+
 LOG = logging.getLogger(__name__)
 
 __name__ = 'rpm'
 
+LEAD_MAGIC = '\xed\xab\xee\xdb'
+LEAD_SIZE = 96
+
+HEADER_MAGIC = '\x8e\xad\xe8\x01'
+HEADER_INTRO = struct.Struct('>4s4xII')
+HEADER_ENTRY = struct.Struct('>iIiI')
+
+# librpm's own limits, anything bigger isn't a real package
+MAX_ENTRIES = 0xffff
+MAX_STORE = 256 * 2**20
+
+# tag types
+INT8, INT16, INT32, INT64, STRING, BIN, STRING_ARRAY, I18NSTRING = range(2, 10)
+
+INT_FORMATS = {INT8: 'B', INT16: 'H', INT32: 'I', INT64: 'Q'}
+
+# signature tags holding a hex digest of the main header
+DIGESTS = {
+  269: 'sha1',
+  273: 'sha256',
+}
+
+# the header tags kept as meta, with the value used when a package doesn't
+# have one
+TAGS = {
+  1000: ('name', None),
+  1001: ('version', None),
+  1002: ('release', None),
+  1003: ('epoch', 0),
+  1004: ('summary', None),
+  1005: ('description', None),
+  1011: ('vendor', None),
+  1014: ('license', None),
+  1016: ('group', None),
+  1022: ('arch', None),
+}
+
+class RpmError(ValueError): pass
+
+def _read(fd, size):
+    data = fd.read(size)
+    if len(data) != size:
+        raise RpmError('truncated package')
+    return data
+
+def read_section(fd):
+    """
+    Read a header structure (the signature or the main header) from ``fd``,
+    returning ``(entries, store, data)``, where ``entries`` maps each tag to
+    its ``(type, offset, count)`` in the data ``store``, and ``data`` is the
+    whole structure as read
+    """
+    intro = _read(fd, HEADER_INTRO.size)
+    magic, count, size = HEADER_INTRO.unpack(intro)
+    if magic != HEADER_MAGIC:
+        raise RpmError('bad header magic')
+    if count > MAX_ENTRIES or size > MAX_STORE:
+        raise RpmError('header is too big')
+
+    index = _read(fd, count * HEADER_ENTRY.size)
+    entries = {}
+    for i in xrange(count):
+        tag, type, offset, n = HEADER_ENTRY.unpack_from(index, i * HEADER_ENTRY.size)
+        if not 0 <= offset <= size:
+            raise RpmError('tag %d is outside the header' % tag)
+        entries[tag] = (type, offset, n)
+    store = _read(fd, size)
+    return entries, store, intro + index + store
+
+def tag_value(store, type, offset, count):
+    """
+    Decode a tag's value from a header's data store. Strings are byte
+    strings, and arrays (including translated strings, the C locale's
+    first) are lists.
+    """
+    if type == STRING:
+        return store[offset:store.index('\0', offset)]
+    elif type in (STRING_ARRAY, I18NSTRING):
+        values = []
+        for _ in xrange(count):
+            end = store.index('\0', offset)
+            values.append(store[offset:end])
+            offset = end + 1
+        return values
+    elif type in INT_FORMATS:
+        fmt = '>%d%s' % (count, INT_FORMATS[type])
+        return list(struct.unpack_from(fmt, store, offset))
+    elif type == BIN:
+        return store[offset:offset + count]
+    raise RpmError('unknown tag type %d' % type)
+
+def check_digests(entries, store, data):
+    """
+    Check the main header's ``data`` against the digests of it among the
+    signature's ``entries``
+    """
+    for tag, name in DIGESTS.iteritems():
+        if tag not in entries:
+            continue
+        try:
+            expected = tag_value(store, *entries[tag])
+        except (ValueError, IndexError, struct.error), e:
+            raise RpmError('corrupt signature: %s' % e)
+        if hashlib.new(name, data).hexdigest() != expected:
+            raise RpmError('header %s digest mismatch' % name)
+
+def read_header(fd):
+    """
+    The meta of the package read from ``fd``, parsed from its header
+    """
+    lead = _read(fd, LEAD_SIZE)
+    if not lead.startswith(LEAD_MAGIC):
+        raise RpmError('not an RPM package')
+
+    # the signature is padded to a multiple of 8 bytes
+    signature, signature_store, _ = read_section(fd)
+    _read(fd, -len(signature_store) % 8)
+
+    entries, store, data = read_section(fd)
+    check_digests(signature, signature_store, data)
+    header = {}
+    try:
+        for tag, (name, default) in TAGS.iteritems():
+            if tag not in entries:
+                header[name] = default
+                continue
+            value = tag_value(store, *entries[tag])
+            if isinstance(value, list):
+                value = value[0]
+            header[name] = value
+    except (ValueError, IndexError, struct.error), e:
+        raise RpmError('corrupt header: %s' % e)
+    return header
+
+_ts = None
+
+def librpm_header(filename):
+    """
+    The same as ``read_header``, but parsed by librpm
+    """
+    global _ts
+    if _ts is None:
+        _ts = rpm.TransactionSet()
+        _ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+
+    with open(filename, 'rb') as fd:
+        raw = _ts.hdrFromFdno(fd)
+    header = {}
+    for name, default in TAGS.itervalues():
+        header[name] = raw[name] if raw[name] is not None else default
+    return header
+
 class Rpm(object):
     def __init__(self, filename):
         self.filename = filename
-        self._ts = rpm.TransactionSet()
-        self._ts.setVSFlags(rpm._RPMVSF_NOSIGNATURES)
+        self._header = None
 
     @property
     def header(self):
-        fd = open(self.filename)
-        raw = self._ts.hdrFromFdno(fd)
-        fd.close()
-        return {
-          'name': raw['name'],
-          'version': raw['version'],
-          'release': raw['release'],
-          'arch': raw['arch'],
-          'epoch': raw['epoch'] or 0,
-          'group': raw['group'],
-          'license': raw['license'],
-          'vendor': raw['vendor'],
-          'summary': raw['summary'],
-          'description': raw['description'],
-        }
+        # parsed once, for both verify and meta
+        if self._header is None:
+            self._header = self._parse()
+        return self._header
+
+    def _parse(self):
+        try:
+            with open(self.filename, 'rb') as fd:
+                return read_header(fd)
+        except RpmError, e:
+            if rpm is None:
+                raise
+            LOG.debug('cannot parse "%s" (%s), trying librpm' % (self.filename, e))
+            return librpm_header(self.filename)
 
     def verify(self):
+        errors = rpm and (RpmError, rpm.error) or RpmError
         try:
             self.header
-        except rpm.error, e:
+        except errors, e:
             LOG.exception('failed to parse "%s" as an RPM, exception was:' % self.filename)
             raise InvalidFileType(self.filename, RpmType.type, e)
 
@@ -49,12 +217,6 @@ class RpmType(CASFileType):
         self._rpm.verify()
 
     def meta(self):
-        keys = (
-          'name', 'version', 'release',
-          'arch', 'epoch', 'group', 'license', 
-          'vendor', 'description', 'summary'
-        )
-
         return dict(("rpm.%s" % k, v) for k, v in self._rpm.header.iteritems())
 
 register_type(RpmType)
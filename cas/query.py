@@ -0,0 +1,308 @@
+"""
+Compound metadata queries.
+
+A query is a tree of predicates (``Equals``, ``Match``, ``And``, ``Or`` and
+``Not``) that lazily yields matching sums in sorted order. ``And`` streams
+its most selective child and checks each candidate against the others by
+seeking into their sorted posting lists (or, for regex matches, looking
+the sum up in the reverse index), so the large children are never scanned
+and no intermediate result sets are built. ``Or`` merges its children's
+sorted streams.
+"""
+
+from cas.util import to_str, literal_prefix
+from heapq import merge
+from itertools import islice
+import re
+
+# Match estimates read the counts of this many candidate values, and
+# extrapolate to at most this many more
+ESTIMATE_SAMPLE = 16
+ESTIMATE_VALUES = 1000
+
+class QuerySyntaxError(ValueError): pass
+
+class Context(object):
+    """
+    What predicates are evaluated against: the ``MetaIndex``, a function
+    yielding every stored sum in sorted order from a start sum, and the
+    number of stored sums
+    """
+    def __init__(self, index, universe, total):
+        self.index = index
+        self.universe = universe
+        self.total = total
+
+def _first(iterable):
+    for item in iterable:
+        return item
+    return None
+
+def _difference(sums, excluded):
+    """
+    The sorted ``sums`` that aren't among the sorted ``excluded`` sums
+    """
+    excluded = iter(excluded)
+    other = next(excluded, None)
+    for sum in sums:
+        while other is not None and other < sum:
+            other = next(excluded, None)
+        if sum != other:
+            yield sum
+
+def _unique(sums):
+    last = None
+    for sum in sums:
+        if sum != last:
+            yield sum
+        last = sum
+
+class Predicate(object):
+    def estimate(self, ctx):
+        """
+        An upper bound on the number of sums this predicate yields
+        """
+        raise NotImplementedError
+
+    def sums(self, ctx, start=None):
+        """
+        Lazily yield the matching sums ``>= start`` in sorted order
+        """
+        raise NotImplementedError
+
+    def contains(self, ctx, sum):
+        return _first(self.sums(ctx, sum)) == sum
+
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+class Equals(Predicate):
+    def __init__(self, key, value):
+        self.key = to_str(key)
+        self.value = to_str(value)
+
+    def estimate(self, ctx):
+        return ctx.index.count(self.key, self.value)
+
+    def sums(self, ctx, start=None):
+        return ctx.index.postings(self.key, self.value, start)
+
+    def __repr__(self):
+        return 'Equals(%r, %r)' % (self.key, self.value)
+
+class Match(Predicate):
+    """
+    Values of ``key`` matching a regex, starting with a prefix and/or
+    within ``start <= value < stop``
+    """
+    def __init__(self, key, regex=None, prefix=None, start=None, stop=None):
+        self.key = to_str(key)
+        self.regex = regex is not None and re.compile(str(regex)) or None
+        self.prefix = prefix is not None and to_str(prefix) or None
+        self.start = start is not None and to_str(start) or None
+        self.stop = stop is not None and to_str(stop) or None
+
+        if self.regex is not None:
+            literal = literal_prefix(self.regex)
+            if self.prefix is None or literal.startswith(self.prefix):
+                self.prefix = literal or self.prefix
+
+    def _accepts(self, value):
+        if self.prefix is not None and not value.startswith(self.prefix):
+            return False
+        if self.start is not None and value < self.start:
+            return False
+        if self.stop is not None and value >= self.stop:
+            return False
+        return self.regex is None or bool(self.regex.search(value))
+
+    def _candidate_values(self, ctx):
+        return ctx.index.values(self.key, self.prefix, self.start, self.stop)
+
+    def estimate(self, ctx):
+        # counting the postings of every candidate value would cost as much
+        # as running an unanchored match, so extrapolate from a sample
+        values = list(islice(self._candidate_values(ctx), ESTIMATE_VALUES))
+        if not values:
+            return 0
+        sample = values[:ESTIMATE_SAMPLE]
+        counted = sum(ctx.index.count(self.key, value) for value in sample)
+        estimate = counted * len(values) // len(sample)
+        if len(values) == ESTIMATE_VALUES:
+            # there may be many more
+            return max(estimate, ctx.total)
+        return min(estimate, ctx.total)
+
+    def sums(self, ctx, start=None):
+        postings = [ctx.index.postings(self.key, value, start)
+          for value in self._candidate_values(ctx) if self._accepts(value)]
+        return _unique(merge(*postings))
+
+    def contains(self, ctx, sum):
+        return any(key == self.key and self._accepts(value)
+          for key, value in ctx.index.pairs(sum))
+
+    def __repr__(self):
+        return 'Match(%r, regex=%r, prefix=%r, start=%r, stop=%r)' % (self.key,
+          self.regex and self.regex.pattern, self.prefix, self.start, self.stop)
+
+class Not(Predicate):
+    def __init__(self, child):
+        self.child = child
+
+    def estimate(self, ctx):
+        return ctx.total
+
+    def sums(self, ctx, start=None):
+        # one pass over both sorted streams, rather than a lookup per sum
+        return _difference(ctx.universe(start), self.child.sums(ctx, start))
+
+    def contains(self, ctx, sum):
+        return not self.child.contains(ctx, sum)
+
+    def __repr__(self):
+        return 'Not(%r)' % self.child
+
+class And(Predicate):
+    def __init__(self, *children):
+        self.children = children
+
+    def estimate(self, ctx):
+        return min(child.estimate(ctx) for child in self.children)
+
+    def plan(self, ctx):
+        """
+        Order the positive children from most to least selective, returning
+        them along with the negated children, which can only filter
+        """
+        positive = [c for c in self.children if not isinstance(c, Not)]
+        negative = [c for c in self.children if isinstance(c, Not)]
+        positive.sort(key=lambda child: child.estimate(ctx))
+        return positive, negative
+
+    def sums(self, ctx, start=None):
+        positive, negative = self.plan(ctx)
+
+        if not positive:
+            # nothing to seek from, so take the union of the negations away
+            # from every sum in one pass
+            candidates = Not(Or(*[child.child for child in negative])).sums(ctx, start)
+            others, negative = [], []
+        else:
+            candidates, others = positive[0].sums(ctx, start), positive[1:]
+
+        for sum in candidates:
+            if all(child.contains(ctx, sum) for child in others) and \
+              all(child.contains(ctx, sum) for child in negative):
+                yield sum
+
+    def __repr__(self):
+        return 'And(%s)' % ', '.join(map(repr, self.children))
+
+class Or(Predicate):
+    def __init__(self, *children):
+        self.children = children
+
+    def estimate(self, ctx):
+        return sum(child.estimate(ctx) for child in self.children)
+
+    def sums(self, ctx, start=None):
+        return _unique(merge(*[child.sums(ctx, start) for child in self.children]))
+
+    def contains(self, ctx, sum):
+        return any(child.contains(ctx, sum) for child in self.children)
+
+    def __repr__(self):
+        return 'Or(%s)' % ', '.join(map(repr, self.children))
+
+TOKEN_RE = re.compile(r'''\s*(\(|\)|(?:[^\s()"']+|"[^"]*"|'[^']*')+)''')
+TERM_RE = re.compile(r'^([^=~^<>]+)(\^=|>=|=|~|<)(.*)$')
+
+def _unquote(value):
+    if len(value) > 1 and value[0] == value[-1] and value[0] in '"\'':
+        return value[1:-1]
+    return value
+
+def _tokenize(expression):
+    tokens, pos = [], 0
+    expression = expression.rstrip()
+    while pos < len(expression):
+        m = TOKEN_RE.match(expression, pos)
+        if not m:
+            raise QuerySyntaxError('unexpected input at "%s"' % expression[pos:])
+        tokens.append(m.group(1))
+        pos = m.end()
+    return tokens
+
+def _term(token):
+    m = TERM_RE.match(token)
+    if not m:
+        raise QuerySyntaxError('invalid term "%s"' % token)
+    key, op, value = m.group(1), m.group(2), _unquote(m.group(3))
+
+    if op == '=':
+        return Equals(key, value)
+    elif op == '~':
+        return Match(key, regex=value)
+    elif op == '^=':
+        return Match(key, prefix=value)
+    elif op == '>=':
+        return Match(key, start=value)
+    return Match(key, stop=value)
+
+def parse(expression):
+    """
+    Parse a query expression into a predicate tree.
+
+    Terms are ``key=value`` (exact), ``key~regex``, ``key^=prefix``,
+    ``key>=value`` and ``key<value``, combined with ``and``, ``or``,
+    ``not`` and parentheses. Values containing spaces may be quoted.
+    """
+    tokens = _tokenize(expression)
+    pos = [0]
+
+    def peek():
+        return pos[0] < len(tokens) and tokens[pos[0]] or None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise QuerySyntaxError('unexpected end of query')
+        pos[0] += 1
+        return token
+
+    def expr():
+        children = [conjunction()]
+        while peek() == 'or':
+            take()
+            children.append(conjunction())
+        return len(children) > 1 and Or(*children) or children[0]
+
+    def conjunction():
+        children = [factor()]
+        while peek() == 'and':
+            take()
+            children.append(factor())
+        return len(children) > 1 and And(*children) or children[0]
+
+    def factor():
+        token = take()
+        if token == 'not':
+            return Not(factor())
+        elif token == '(':
+            inner = expr()
+            if take() != ')':
+                raise QuerySyntaxError('expected ")"')
+            return inner
+        return _term(token)
+
+    predicate = expr()
+    if peek() is not None:
+        raise QuerySyntaxError('unexpected "%s"' % peek())
+    return predicate
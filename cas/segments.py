@@ -0,0 +1,149 @@
+from bisect import bisect_left, bisect_right, insort
+import logging
+
+LOG = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 512
+
+class SegmentedList(object):
+    """
+    A sorted set of strings persisted inside a shelf.
+
+    The set is stored as a small directory record (the first item and id of
+    each segment) plus a number of segment records, each holding at most
+    ``segment_size`` sorted items. Adding or removing an item only reads
+    and rewrites the directory and the one segment it falls into, so the
+    cost of an update doesn't grow with the size of the set.
+    """
+    def __init__(self, shelf, name, segment_size=SEGMENT_SIZE):
+        self.shelf = shelf
+        self.name = name
+        self.segment_size = segment_size
+
+    def _segment_key(self, id):
+        return '%s\x00#%d' % (self.name, id)
+
+    def _directory(self):
+        return self.shelf.get(self.name) or \
+          {'firsts': [], 'ids': [], 'next': 0, 'count': 0}
+
+    def _locate(self, directory, item):
+        return max(bisect_right(directory['firsts'], item) - 1, 0)
+
+    def __len__(self):
+        return self._directory()['count']
+
+    def __nonzero__(self):
+        return bool(len(self))
+
+    def __contains__(self, item):
+        directory = self._directory()
+        if not directory['ids']:
+            return False
+        i = self._locate(directory, item)
+        segment = self.shelf[self._segment_key(directory['ids'][i])]
+        j = bisect_left(segment, item)
+        return j < len(segment) and segment[j] == item
+
+    def __iter__(self):
+        return self.range()
+
+    def add(self, item):
+        """
+        Insert ``item``, returning ``False`` if it was already present
+        """
+        directory = self._directory()
+
+        if not directory['ids']:
+            id = directory['next']
+            directory['next'] += 1
+            directory['firsts'].append(item)
+            directory['ids'].append(id)
+            directory['count'] = 1
+            self.shelf[self._segment_key(id)] = [item]
+            self.shelf[self.name] = directory
+            return True
+
+        i = self._locate(directory, item)
+        key = self._segment_key(directory['ids'][i])
+        segment = self.shelf[key]
+
+        j = bisect_left(segment, item)
+        if j < len(segment) and segment[j] == item:
+            return False
+
+        segment.insert(j, item)
+        directory['firsts'][i] = segment[0]
+        directory['count'] += 1
+
+        if len(segment) > self.segment_size:
+            half = len(segment) // 2
+            id = directory['next']
+            directory['next'] += 1
+            self.shelf[self._segment_key(id)] = segment[half:]
+            directory['firsts'].insert(i + 1, segment[half])
+            directory['ids'].insert(i + 1, id)
+            segment = segment[:half]
+
+        self.shelf[key] = segment
+        self.shelf[self.name] = directory
+        return True
+
+    def remove(self, item):
+        """
+        Remove ``item``, returning ``False`` if it wasn't present
+        """
+        directory = self._directory()
+        if not directory['ids']:
+            return False
+
+        i = self._locate(directory, item)
+        key = self._segment_key(directory['ids'][i])
+        segment = self.shelf[key]
+
+        j = bisect_left(segment, item)
+        if j >= len(segment) or segment[j] != item:
+            return False
+
+        del segment[j]
+        directory['count'] -= 1
+
+        if not directory['count']:
+            del self.shelf[key]
+            del self.shelf[self.name]
+            return True
+
+        if segment:
+            self.shelf[key] = segment
+            directory['firsts'][i] = segment[0]
+        else:
+            del self.shelf[key]
+            del directory['firsts'][i]
+            del directory['ids'][i]
+
+        self.shelf[self.name] = directory
+        return True
+
+    def range(self, start=None, stop=None):
+        """
+        Lazily yield items ``start <= item < stop``, in sorted order.
+        Either bound may be ``None`` to leave that side open.
+        """
+        directory = self._directory()
+        ids = directory['ids']
+        first = 0 if start is None else self._locate(directory, start)
+
+        for id in ids[first:]:
+            segment = self.shelf[self._segment_key(id)]
+            lo = 0 if start is None else bisect_left(segment, start)
+            for item in segment[lo:]:
+                if stop is not None and item >= stop:
+                    return
+                yield item
+
+    def clear(self):
+        directory = self._directory()
+        for id in directory['ids']:
+            del self.shelf[self._segment_key(id)]
+        if self.name in self.shelf:
+            del self.shelf[self.name]
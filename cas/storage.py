@@ -1,106 +1,150 @@
-from cas.util import shard, get_uuid, mkdir_p, fullpath, checksum, timeit
-from cas.config import CAS_ROOT
+from cas.util import shard, get_uuid, mkdir_p, fullpath, checksum, timeit, stat_key, \
+  stream_checksum, send_range, RangeReader, read_checksums, RateLimiter, get_umask
+from cas.cache import ChecksumCache
+from cas.config import CAS_ROOT, CAS_BATCH_SIZE, CAS_WORKERS, CAS_POOL, \
+  CAS_CHECKSUM_CACHE, CAS_INDEX_BACKEND, CAS_LOCK_TIMEOUT, CAS_PACK_THRESHOLD, \
+  CAS_CHUNK_THRESHOLD, CAS_COMPRESSION, CAS_COMPRESSION_THRESHOLD, CAS_VERIFY_RATE, \
+  CAS_BLOOM_FILTER, CAS_HASH
+from cas.index import BACKENDS, get_backend, value_bounds, SumIndex, MetaIndex, \
+  ReverseMetaIndex
+from cas.ingest import inspect_file, inspect_files, ingest_mode, DEFAULT_MODE, Inspected, \
+  Layout, NO_LAYOUT
 from cas.files import NullType
+from cas.journal import Journal, ADD, REMOVE
+from cas.lock import FileLock
+from cas.pack import PackStore
+from cas.chunks import ChunkStore, MANIFEST_SUFFIX
+from cas.bloom import BloomFilter
+from cas.hashes import get_hash
+from cas.compression import CODECS, get_codec, compress_file, DecompressingReader
+from cas.query import Context, parse
+import cas.metrics
 import os
 import json
 import datetime
 import errno
 import shutil
-import shelve
+import tempfile
+import stat
+import io
+import time
 import logging
-import re
+from itertools import islice
+from collections import namedtuple, deque
+from multiprocessing.pool import ThreadPool
 
 LOG = logging.getLogger(__name__)
 
-class CASLocked(RuntimeError): pass
-
-class SumIndex(shelve.DbfilenameShelf):
-    def add(self, sum):
-        LOG.debug('adding "%s" to sum index' % sum)
-        self[str(sum)] = None
-
-    def remove(self, sum):
-        LOG.debug('removing "%s" from sum index' % sum)
-        del self[str(sum)]
-
-class MetaIndex(shelve.DbfilenameShelf):
-    def __init__(self, *args, **kwargs):
-        shelve.DbfilenameShelf.__init__(self, writeback=True, *args, **kwargs)
-
-    def add(self, key, value, sum):
-        LOG.debug('adding meta %s=%s for sum "%s"' % (key, value, sum))
-        self.setdefault(key, {}).setdefault(value, {})
-
-        self[key][value][str(sum)] = None
-
-        self.sync()
-
-    def remove(self, key, value, sum):
-        LOG.debug('removing meta %s=%s for sum "%s"' % (key, value, sum))
-        data_value = self.get(key, {}).get(value, None)
-
-        if data_value is None:
-            LOG.error('no such meta %s=%s for sum "%s"' % (key, value, sum))
-            return
-
-        del self[key][value][str(sum)]
-
-        # garbage collection on valuespace
-        if not self[key][value]:
-            del self[key][value]
+ADDED = cas.metrics.counter('cas_objects_added_total', 'Objects added to storage')
+DEDUPED = cas.metrics.counter('cas_objects_deduped_total',
+  'Objects not added because storage already had them')
+REMOVED = cas.metrics.counter('cas_objects_removed_total', 'Objects removed from storage')
+cas.metrics.histogram('cas_add_seconds', 'Seconds taken by single adds')
+ADD_BATCH_SECONDS = cas.metrics.histogram('cas_add_batch_seconds',
+  'Seconds taken to inspect, index and store each batch of add_many')
+cas.metrics.histogram('cas_index_sync_seconds', 'Seconds taken to commit the indices')
+cas.metrics.histogram('cas_gc_seconds', 'Seconds taken by garbage collection')
+cas.metrics.histogram('cas_match_seconds', 'Seconds spent finding the sums matching meta')
+OBJECTS = cas.metrics.gauge('cas_objects', 'Objects in storage')
+STORE_BYTES = cas.metrics.gauge('cas_store_bytes', 'Bytes of objects on disk')
 
-        # garbage collection on keyspace
-        if not self[key]:
-            del self[key]
-
-        self.sync()
-
-    def _find(self, sum):
-        locations = []
-        for key, valuespace in self.iteritems():
-            for value, items in valuespace.iteritems():
-                if sum in items:
-                    locations.append((key, value))
-        return locations
-
-    def remove_all(self, sum):
-        for key, value in self._find(sum):
-            self.remove(key, value, sum)
-
-    def equals(self, key, value):
-        return sorted(self.get(str(key), {}).get(str(value), {}).keys())
-
-    def match(self, key, value_regex):
-        matches = set()
-        for value, sums in self.get(str(key), {}).iteritems():
-            if re.search(str(value_regex), value):
-                map(matches.add, sums.keys())
-        return sorted(list(matches))
-
-    def keyspace(self):
-        data = {}
-        for key, valuespace in self.iteritems():
-            data[key] = sorted(valuespace.keys())
-        return data
+class CASLocked(RuntimeError): pass
 
-    def has_sum(self, sum):
-        return bool(self._find(sum))
+class CASReadOnly(RuntimeError): pass
+
+class AmbiguousSum(KeyError):
+    """
+    More than one stored sum starts with an abbreviated one
+    """
+    def __init__(self, prefix, candidates):
+        KeyError.__init__(self, prefix, candidates)
+        self.prefix = prefix
+        self.candidates = candidates
+
+    def __str__(self):
+        return 'checksum "%s" is ambiguous, it could be %s' % (self.prefix,
+          ', '.join(self.candidates))
+
+# the kinds of problem ``CAS.verify`` reports
+CORRUPT = 'corrupt'
+MISSING = 'missing'
+UNINDEXED = 'unindexed'
+ORPHANED = 'orphaned'
+
+Problem = namedtuple('Problem', 'kind sum detail')
+
+def _scrub(job):
+    """
+    Hash an open object in a worker, returning its checksums under each of
+    the hash functions and ``None``, or ``None`` and why it couldn't be read
+    """
+    reader, hash_funcs, limiter = job
+    try:
+        with reader:
+            return read_checksums(reader, hash_funcs, limiter=limiter), None
+    except Exception, e:
+        # truncated chunks, corrupt compressed streams, I/O errors, ...
+        return None, str(e) or type(e).__name__
 
 class CAS(object):
-    def __init__(self, root=None, sharding=(2, 2), autoload=True):
+    """
+    A content-addressable store rooted at ``root``.
+
+    Opening a store for writing takes an exclusive lock on it. A store
+    opened ``readonly`` takes a shared lock instead (or none at all, if its
+    index backend supports reading alongside a writer), so any number of
+    readers can use it at once, and it never collects garbage or writes
+    anything back. Either waits up to ``lock_timeout`` seconds for a
+    conflicting lock to be released before raising ``CASLocked``.
+    """
+    def __init__(self, root=None, sharding=(2, 2), autoload=True, mode=DEFAULT_MODE,
+                 checksum_cache=CAS_CHECKSUM_CACHE, index=CAS_INDEX_BACKEND,
+                 readonly=False, lock_timeout=CAS_LOCK_TIMEOUT,
+                 pack_threshold=CAS_PACK_THRESHOLD, chunk_threshold=CAS_CHUNK_THRESHOLD,
+                 compression=CAS_COMPRESSION, compression_threshold=CAS_COMPRESSION_THRESHOLD,
+                 bloom_filter=CAS_BLOOM_FILTER, hash=CAS_HASH):
         root = root or CAS_ROOT
         if not root:
             raise TypeError('CAS requires a root directory')
 
         self.root = fullpath(root)
         self.shard_width, self.shard_depth = sharding
+        self.mode = ingest_mode(mode)
+        self.checksum_cache_size = checksum_cache
+        # only used for new stores, existing ones record their backend
+        self.index_backend = get_backend(index).name
+        # like the index backend, existing stores record their own
+        get_hash(hash)
+        self.hash = hash
+        get_codec(compression)
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.readonly = readonly
+        self.lock_timeout = lock_timeout
+        # objects smaller than this go into packfiles, see ``cas.pack``
+        self.pack_threshold = pack_threshold
+        # objects at least this big are chunked, see ``cas.chunks``
+        self.chunk_threshold = chunk_threshold
+        # answer has_sum misses from memory, see ``cas.bloom``
+        self.bloom_filter = bloom_filter
 
         self.uuid = None
         self.created = None
         self.updated = None
 
+        self._index = None
         self._sum_index = None
         self._meta_index = None
+        self._packs = None
+        self._chunks = None
+        self._checksum_cache = None
+        self._journal = None
+        self._bloom = None
+        # whether the filter on disk holds every sum the in-memory one does
+        self._bloom_saved = False
+        # the packed sums, for workers to check without the pack index
+        self._packed_bloom = None
+        self._lock = FileLock(self.lockfile)
     
         if autoload:
             self._initialize()
@@ -124,22 +168,131 @@ class CAS(object):
             if not os.path.isdir(dir):
                 return False    
 
-        for file in [cas.metafile, cas.sum_indexfile]:
-            if not os.path.isfile(file):
-                return False
+        if not os.path.isfile(cas.metafile):
+            return False
 
-        return True
+        return any(backend.exists(cas.root) for backend in BACKENDS.values())
 
     def _initialize(self):
+        if self.readonly:
+            self._initialize_reader()
+            return
+
         self._initialize_dirs()
         self.lock()
         self._initialize_meta()
         self._initialize_indices()
+        self._chunks = ChunkStore(self.root, self.shard_width, self.shard_depth,
+          hash_func=self.hash_func)
+        self._journal = Journal(self.journalfile)
         self.gc()
+        if os.path.isfile(self.rehashfile):
+            # finish moving objects to their new sums
+            self._apply_rehash()
+
+    def _initialize_reader(self):
+        if not CAS.check(self.root):
+            raise OSError(errno.ENOENT, 'no storage at "%s"' % self.root)
+
+        # the backend is only known once the metadata is read, and the
+        # metadata file is only ever replaced atomically
+        self._load_meta()
+        if not get_backend(self.index_backend).concurrent_readers:
+            self.lock(shared=True)
+        self._initialize_indices()
+        self._chunks = ChunkStore(self.root, self.shard_width, self.shard_depth,
+          hash_func=self.hash_func)
 
     def _initialize_indices(self):
-        self._sum_index = SumIndex(self.sum_indexfile)
-        self._meta_index = MetaIndex(self.meta_indexfile)
+        self._open_index(get_backend(self.index_backend)(self.root, self.readonly))
+
+        if self.checksum_cache_size and not self.readonly:
+            self._checksum_cache = ChecksumCache(self.checksum_cachefile,
+              self.checksum_cache_size)
+
+        self._initialize_bloom()
+
+    def _initialize_bloom(self):
+        if self.readonly:
+            # a reader running alongside a writer would miss its new objects
+            if self.bloom_filter and not get_backend(self.index_backend).concurrent_readers:
+                self._bloom = BloomFilter.load(self.bloomfile)
+            return
+
+        if not self.bloom_filter:
+            # objects added without the filter would be missing from it
+            if os.path.isfile(self.bloomfile):
+                os.remove(self.bloomfile)
+            return
+
+        self._bloom = BloomFilter.load(self.bloomfile)
+        self._bloom_saved = self._bloom is not None
+        if self._bloom is None:
+            self._rebuild_bloom()
+
+    def _rebuild_bloom(self):
+        LOG.debug('building bloom filter over %d sums' % len(self._sum_index))
+        self._forget_bloom()
+        self._bloom = BloomFilter.from_sums(self._sum_index.keys(), len(self._sum_index))
+
+    def _forget_bloom(self):
+        # the filter is only saved on unlock, so until then the one on disk
+        # may be missing sums, and a crash mustn't leave it behind
+        if os.path.isfile(self.bloomfile):
+            os.remove(self.bloomfile)
+        self._bloom_saved = False
+
+    def _bloom_add(self, sum):
+        if self._bloom is None:
+            return
+        if self._bloom_saved:
+            self._forget_bloom()
+        if self._bloom.full:
+            # the sum index already has the new sum
+            self._rebuild_bloom()
+        else:
+            self._bloom.add(sum)
+
+    def _open_index(self, index):
+        if self._packs is not None:
+            self._packs.close()
+
+        self._index = index
+        self._sum_index = index.sums
+        self._meta_index = index.meta
+        self._packs = PackStore(self.packdir, index.packs)
+        self._packed_bloom = None
+
+    def reindex(self):
+        """
+        Rebuild any derived indices from the primary ones
+        """
+        self._check_writable()
+        self._index.reindex()
+
+    def migrate_index(self, backend):
+        """
+        Copy the indices into a different backend, and switch to it
+        """
+        self._check_writable()
+        backend = get_backend(backend)
+        if backend.name == self.index_backend:
+            return
+
+        LOG.debug('migrating indices from %s to %s' % (self.index_backend, backend.name))
+        index = backend(self.root)
+        for sum in self._sum_index.keys():
+            index.sums.add(sum)
+        for key, value, sum in self._meta_index.triples():
+            index.meta.add(key, value, sum)
+        for sum, entry in self._index.packs.iteritems():
+            index.packs.add(sum, *entry)
+        index.commit()
+
+        self._index.destroy()
+        self._open_index(index)
+        self.index_backend = backend.name
+        self._write_meta()
 
     def _initialize_dirs(self):
         map(mkdir_p, [self.tmpdir, self.storagedir])
@@ -168,6 +321,13 @@ class CAS(object):
         self.updated = meta['updated']
         self.shard_width = meta['shard']['width']
         self.shard_depth = meta['shard']['depth']
+        # stores from before index backends were pluggable are shelves
+        self.index_backend = meta.get('index', 'shelve')
+        compression = meta.get('compression', {})
+        self.compression = compression.get('codec', 'none')
+        self.compression_threshold = compression.get('threshold', 0)
+        # every store was sha1 until the hash was configurable
+        self.hash = meta.get('hash', 'sha1')
 
     def meta(self):
         return {
@@ -178,38 +338,119 @@ class CAS(object):
             'width': self.shard_width,
             'depth': self.shard_depth,
           },
+          'index': self.index_backend,
+          'hash': self.hash,
+          'compression': {
+            'codec': self.compression,
+            'threshold': self.compression_threshold,
+          },
         }
 
+    def stats(self):
+        """
+        Update the storage gauges and return a snapshot of every metric this
+        process has collected (see ``cas.metrics``). Measuring the size of
+        the store walks all of it.
+        """
+        OBJECTS.set(len(self._sum_index))
+        STORE_BYTES.set(self._disk_usage())
+        return cas.metrics.REGISTRY.snapshot()
+
+    def _disk_usage(self):
+        total = 0
+        for top in (self.storagedir, self.packdir, self._chunks.chunkdir,
+                    self._chunks.manifestdir):
+            for dirpath, dirnames, filenames in os.walk(top):
+                for filename in filenames:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+        return total
+
     def _write_meta(self):
         LOG.debug('writing storage metadata')
-        json.dump(self.meta(), open(self.metafile, 'w'))
+        # replace the file atomically, since readers don't lock against us
+        tmpfile = self.metafile + '.new'
+        with open(tmpfile, 'w') as fd:
+            json.dump(self.meta(), fd)
+        os.rename(tmpfile, self.metafile)
 
     def _read_meta(self):
         return json.load(open(self.metafile)) 
 
-    def lock(self):
-        if self.locked:
+    def lock(self, shared=False):
+        if not self._lock.acquire(shared, self.lock_timeout):
             raise CASLocked(self.root)
 
-        open(self.lockfile, 'a').close()
-
     def unlock(self):
-        if self.locked:
-            self._sum_index.sync()
-            self._meta_index.sync()
-            os.remove(self.lockfile)
+        # stores opened without autoload never took the lock
+        lock = getattr(self, '_lock', None)
+        if lock is None or not lock.held:
+            return
+
+        if self._index is not None and not self.readonly:
+            self._commit()
+            if self._bloom is not None and not self._bloom_saved:
+                self._bloom.save(self.bloomfile)
+                self._bloom_saved = True
+        if self._packs is not None:
+            self._packs.close()
+        lock.release()
+
+    def _check_writable(self):
+        if self.readonly:
+            raise CASReadOnly(self.root)
+
+    @timeit('cas.storage.CAS._commit', 'cas_index_sync_seconds')
+    def _commit(self):
+        """
+        Flush pending index writes to disk
+        """
+        LOG.debug('committing indices')
+        self._index.commit()
+        if self._checksum_cache is not None:
+            self._checksum_cache.sync()
+
+    @property
+    def checksum_cachefile(self):
+        return os.path.join(self.root, '.checksums')
+
+    @property
+    def journalfile(self):
+        return os.path.join(self.root, '.journal')
+
+    @property
+    def socketfile(self):
+        return os.path.join(self.root, '.sock')
 
     @property
-    def sum_indexfile(self):
-        return os.path.join(self.root, '.files')
+    def gc_checkpointfile(self):
+        return os.path.join(self.root, '.gc')
 
     @property
-    def meta_indexfile(self):
-        return os.path.join(self.root, '.filemeta')
+    def hash_func(self):
+        return get_hash(self.hash)
+
+    @property
+    def rehashfile(self):
+        return os.path.join(self.root, '.rehash')
+
+    @property
+    def bloomfile(self):
+        return os.path.join(self.root, '.bloom')
+
+    @property
+    def verify_checkpointfile(self):
+        return os.path.join(self.root, '.fsck')
+
+    @property
+    def quarantinedir(self):
+        return os.path.join(self.root, 'quarantine')
 
     @property
     def locked(self):
-        return os.path.isfile(self.lockfile)
+        """
+        Whether this or any other process holds a lock on the storage
+        """
+        return self._lock.is_locked()
 
     @property
     def metafile(self):
@@ -227,97 +468,801 @@ class CAS(object):
     def storagedir(self):
         return os.path.join(self.root, 'storage')
 
+    @property
+    def packdir(self):
+        return os.path.join(self.root, 'packs')
+
     def has_sum(self, sum):
-        return os.path.isfile(self.path(sum))
+        if self._bloom is not None and sum not in self._bloom:
+            return False
+        return self._has_data(sum)
+
+    def _has_data(self, sum):
+        """
+        Whether an object's data is stored. Unlike ``has_sum`` this doesn't
+        ask the bloom filter, which only knows the indexed sums, so it also
+        finds orphaned and half-removed objects.
+        """
+        return os.path.isfile(self.path(sum)) or self._is_compressed(sum) or \
+          (self._packs is not None and self._packs.has(sum)) or \
+          (self._chunks is not None and self._chunks.has(sum))
+
+    def open(self, sum):
+        """
+        A read-only file object over a stored object's contents, however it
+        is stored. Loose (uncompressed) and packed objects are read straight
+        from the underlying file, which ``fileno`` returns.
+        """
+        path = self.path(sum)
+        if os.path.isfile(path):
+            return RangeReader(open(path, 'rb'), 0, os.path.getsize(path))
+
+        if self._is_compressed(sum):
+            codec = get_codec(self.compression)
+            return DecompressingReader(open(path + codec.suffix, 'rb'), codec)
+
+        if self._chunks.has(sum):
+            return self._chunks.open(sum)
+
+        try:
+            return self._packs.open(sum)
+        except KeyError:
+            raise OSError(errno.ENOENT, sum)
+
+    def read(self, sum, offset=0, length=None):
+        """
+        The contents of a stored object, or ``length`` bytes of it from
+        ``offset``
+        """
+        if not os.path.isfile(self.path(sum)) and self._packs.has(sum):
+            # straight out of the mmapped pack
+            return self._packs.read(sum, offset, length)
+
+        with self.open(sum) as fd:
+            if offset:
+                fd.seek(offset)
+            return fd.read(length is None and -1 or length)
+
+    def stream(self, sum, offset=0, length=None, block_size=2**20):
+        """
+        Lazily yield the contents of a stored object (or ``length`` bytes of
+        it from ``offset``) in blocks of up to ``block_size`` bytes
+        """
+        with self.open(sum) as fd:
+            if offset:
+                fd.seek(offset)
+            remaining = length
+            while remaining is None or remaining > 0:
+                size = remaining is None and block_size or min(block_size, remaining)
+                data = fd.read(size)
+                if not data:
+                    break
+                if remaining is not None:
+                    remaining -= len(data)
+                yield data
+
+    def send(self, sum, out, offset=0, length=None):
+        """
+        Write a stored object (or ``length`` bytes of it from ``offset``) to
+        the file object ``out``, returning how many bytes were written.
+
+        When both the object and ``out`` are backed by files (or ``out`` is
+        a pipe or socket), the data is copied by the kernel with
+        ``sendfile`` without passing through userspace.
+        """
+        with self.open(sum) as fd:
+            if isinstance(fd, RangeReader):
+                start = min(offset, fd.length)
+                count = fd.length - start
+                if length is not None:
+                    count = min(count, length)
+                try:
+                    fdout = out.fileno()
+                    out.flush()
+                    return send_range(fd.fileno(), fdout, fd.offset + start, count)
+                except (AttributeError, IOError, ValueError), e:
+                    LOG.debug('cannot sendfile to %r (%s), copying' % (out, e))
+                except OSError, e:
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                        raise
+                    LOG.debug('sendfile failed (%s), copying' % e)
+
+        written = 0
+        for data in self.stream(sum, offset, length):
+            out.write(data)
+            written += len(data)
+        return written
 
     def has_file(self, filename):
         return self.has_sum(self.checksum(filename))
 
     def equals(self, key, value):
-        return self._meta_index.equals(key, value)
+        return cas.metrics.timed_call('cas.storage.CAS.equals', 'cas_match_seconds',
+          self._meta_index.equals, key, value)
 
-    def match(self, key, value_regex):
-        return self._meta_index.match(key, value_regex)
+    def match(self, key, value_regex=None, prefix=None, start=None, stop=None):
+        return cas.metrics.timed_call('cas.storage.CAS.match', 'cas_match_seconds',
+          self._meta_index.match, key, value_regex, prefix, start, stop)
 
-    @timeit('cas.storage.CAS.gc')
-    def gc(self, full=False):
+    def values(self, key, prefix=None, start=None, stop=None):
+        return self._meta_index.values(key, prefix, start, stop)
+
+    def query(self, predicate):
+        """
+        Lazily yield the sorted sums matching a ``cas.query`` predicate tree
+        (or a query expression string, see ``cas.query.parse``)
+        """
+        if isinstance(predicate, basestring):
+            predicate = parse(predicate)
+        ctx = Context(self._meta_index, self._sorted_sums, len(self._sum_index))
+        return cas.metrics.timed_call('cas.storage.CAS.query', 'cas_match_seconds',
+          predicate.sums, ctx)
+
+    def _sorted_sums(self, start=None):
+        return self._sum_index.sorted(start)
+
+    @timeit('cas.storage.CAS.gc', 'cas_gc_seconds')
+    def gc(self, full=False, batch_size=CAS_BATCH_SIZE, resume=True):
         """
         Perform garbage collection
+
+        By default this only reconciles the operations left in the journal
+        by an interrupted add or remove, which is cheap enough to do every
+        time the store is opened. A ``full`` sweep also checks every sum in
+        the sum index against ``storage/``, committing and checkpointing
+        its progress every ``batch_size`` sums so that an interrupted sweep
+        can ``resume`` where it left off.
         """
+        self._check_writable()
         LOG.debug('performing garbage collection')
-        
+
         LOG.debug('removing temporary files')
         for file in os.listdir(self.tmpdir):
             os.remove(os.path.join(self.tmpdir, file))
 
+        self._reconcile()
+
+        if full:
+            self._sweep(batch_size, resume)
+            if self._bloom is not None:
+                # forget the removed sums
+                self._rebuild_bloom()
+
+    def _reconcile(self):
+        entries = self._journal.entries()
+        if not entries:
+            return
+
+        LOG.debug('reconciling %d journaled operations' % len(entries))
+        for op, sum in entries:
+            if op == REMOVE and self._has_data(sum):
+                self._delete(sum)
+            self._unindex_missing(sum)
+
+        self._commit()
+        self._journal.clear()
+
+    def _unindex_missing(self, sum):
+        if not self._has_data(sum):
+            self._meta_index.remove_all(sum)
+            if self._sum_index.has_key(sum):
+                self._sum_index.remove(sum)
+
+    def _sweep(self, batch_size, resume):
         LOG.debug('cleaning up file checksum index')
-        for sum in self._sum_index.keys():
-            if not self.has_sum(sum):
-                self._meta_index.remove_all(sum)
+        cursor = None
+        if resume and os.path.isfile(self.gc_checkpointfile):
+            cursor = open(self.gc_checkpointfile).read().strip()
+            LOG.debug('resuming sweep after "%s"' % cursor)
+
+        while True:
+            # re-query each batch, since committing may invalidate an
+            # open iteration over the index
+            start = cursor is not None and cursor + '\x00' or None
+            batch = list(islice(self._sum_index.sorted(start), batch_size))
+            if not batch:
+                break
+
+            for sum in batch:
+                self._unindex_missing(sum)
+
+            cursor = batch[-1]
+            self._commit()
+            with open(self.gc_checkpointfile, 'w') as fd:
+                fd.write(cursor)
+
+        if os.path.isfile(self.gc_checkpointfile):
+            os.remove(self.gc_checkpointfile)
+
+    def verify(self, workers=CAS_WORKERS, rate=CAS_VERIFY_RATE,
+               batch_size=CAS_BATCH_SIZE, resume=True, quarantine=False):
+        """
+        Check the storage against its indices, yielding a ``Problem`` for
+        every object in the sum index that is corrupt (its data no longer
+        hashes to its sum), missing, or unindexed (not filed in the meta
+        index), followed by every orphaned object (stored, but not in the
+        sum index).
+
+        Objects are re-hashed by ``workers`` threads, which read no more
+        than ``rate`` bytes per second between them (0 for no limit), so a
+        check can run alongside other work. Progress is checkpointed every
+        ``batch_size`` sums, so that an interrupted check can ``resume``
+        where it left off.
+
+        With ``quarantine``, the data of corrupt and orphaned objects is
+        moved to ``quarantine/`` and corrupt and missing objects are dropped
+        from the indices, which needs a writable store.
+        """
+        if quarantine:
+            self._check_writable()
+        limiter = rate and RateLimiter(rate) or None
+
+        cursor = None
+        if resume and os.path.isfile(self.verify_checkpointfile):
+            cursor = open(self.verify_checkpointfile).read().strip()
+            LOG.debug('resuming verify after "%s"' % cursor)
+
+        LOG.debug('verifying objects using %d workers' % workers)
+        workers = max(workers, 1)
+        pool = ThreadPool(workers)
+        try:
+            while True:
+                # re-query each batch, since quarantining may invalidate an
+                # open iteration over the index
+                start = cursor is not None and cursor + '\x00' or None
+                batch = list(islice(self._sum_index.sorted(start), batch_size))
+                if not batch:
+                    break
+
+                problems = [self._verified(*hashed) for hashed in self._hash_objects(
+                  batch, pool, workers * 2, [self.hash_func], limiter)]
+                problems = [problem for problem in problems if problem is not None]
+                if quarantine:
+                    self._quarantine(problems)
+                for problem in problems:
+                    yield problem
+
+                cursor = batch[-1]
+                with open(self.verify_checkpointfile, 'w') as fd:
+                    fd.write(cursor)
+        finally:
+            pool.terminate()
+
+        problems = [Problem(ORPHANED, sum, 'not in the sum index')
+          for sum in self._orphans()]
+        if quarantine:
+            self._quarantine(problems)
+        for problem in problems:
+            yield problem
+
+        if os.path.isfile(self.verify_checkpointfile):
+            os.remove(self.verify_checkpointfile)
+
+    def _hash_objects(self, sums, pool, window, hash_funcs, limiter=None):
+        """
+        Lazily yield ``(sum, digests, error)`` for each of ``sums`` in order,
+        with the checksums of its data under each of ``hash_funcs``, or why
+        it couldn't be read
+        """
+        # objects are opened here, since the indices may only be used from
+        # this thread, and only hashed by the pool. At most ``window`` are
+        # in flight at once, which bounds the open files.
+        pending = deque()
+        for sum in sums:
+            if len(pending) >= window:
+                yield self._hashed(*pending.popleft())
+
+            try:
+                result = pool.apply_async(_scrub, [(self.open(sum), hash_funcs, limiter)])
+            except (OSError, IOError), e:
+                result = e
+            pending.append((sum, result))
+
+        while pending:
+            yield self._hashed(*pending.popleft())
+
+    def _hashed(self, sum, result):
+        if isinstance(result, EnvironmentError):
+            return sum, None, result
+        return (sum,) + result.get()
+
+    def _verified(self, sum, digests, error):
+        if isinstance(error, EnvironmentError) and error.errno == errno.ENOENT:
+            return Problem(MISSING, sum, 'no data in storage')
+        elif error is not None:
+            return Problem(CORRUPT, sum, str(error))
+        elif digests[0] != sum:
+            return Problem(CORRUPT, sum, 'data hashes to %s' % digests[0])
+        elif not self._meta_index.has_sum(sum):
+            return Problem(UNINDEXED, sum, 'not in the meta index')
+
+    def _orphans(self):
+        """
+        The sums of the objects in storage, in any form, that aren't in the
+        sum index
+        """
+        suffixes = tuple(codec.suffix for codec in CODECS.values())
+        stored = set()
+        for dirpath, dirnames, filenames in os.walk(self.storagedir):
+            for filename in filenames:
+                sum = os.path.relpath(os.path.join(dirpath, filename),
+                  self.storagedir).replace(os.path.sep, '')
+                if sum.endswith(suffixes):
+                    sum = os.path.splitext(sum)[0]
+                stored.add(sum)
+        stored.update(self._chunks.sums())
+        stored.update(sum for sum, _ in self._packs.index.iteritems())
+
+        return sorted(sum for sum in stored if not self._sum_index.has_key(sum))
+
+    def _quarantine(self, problems):
+        """
+        Move the data of corrupt and orphaned objects out of storage, and
+        drop corrupt and missing objects from the indices
+        """
+        bad = [p.sum for p in problems if p.kind in (CORRUPT, MISSING)]
+        for sum in bad:
+            self._journal.record(REMOVE, sum)
+        self._journal.sync()
+
+        for problem in problems:
+            if problem.kind in (CORRUPT, ORPHANED) and self._has_data(problem.sum):
+                LOG.warn('quarantining %s object "%s"' % (problem.kind, problem.sum))
+                self._move_to_quarantine(problem.sum)
+
+        # like remove, the journal finishes the job if this is interrupted
+        for sum in bad:
+            self._meta_index.remove_all(sum)
+            if self._sum_index.has_key(sum):
                 self._sum_index.remove(sum)
+        self._commit()
+        self._journal.clear()
+
+    def _move_to_quarantine(self, sum):
+        mkdir_p(self.quarantinedir)
+        dst = os.path.join(self.quarantinedir, sum)
+
+        path = self.path(sum)
+        if self._is_compressed(sum):
+            suffix = get_codec(self.compression).suffix
+            path, dst = path + suffix, dst + suffix
+
+        if os.path.isfile(path):
+            os.rename(path, dst)
+            self._clean_dir(os.path.dirname(path))
+        elif self._chunks.has(sum):
+            self._chunks.remove(sum, dst + '.manifest')
+        else:
+            with open(dst, 'wb') as fd:
+                fd.write(self._packs.read(sum))
+            self._packs.remove(sum)
+
+    @timeit('cas.storage.CAS.rehash')
+    def rehash(self, hash, workers=CAS_WORKERS, batch_size=CAS_BATCH_SIZE):
+        """
+        Rename every object by its checksum under the hash function ``hash``,
+        and have the store use it from then on.
+
+        First every object is hashed again by ``workers`` threads, checking
+        it against its current sum, and the new sums are written to a plan
+        without changing anything else. Then the objects and their index
+        entries are moved to their new sums, committing every
+        ``batch_size`` objects, and the packs are rewritten so that their
+        headers have the new sums too. An interrupted plan is resumed by calling
+        this again, and an interrupted move is finished the next time the
+        store is opened for writing.
+        """
+        self._check_writable()
+        get_hash(hash)
+        if os.path.isfile(self.rehashfile):
+            self._apply_rehash()
+        if hash == self.hash:
+            return
+
+        self._plan_rehash(hash, workers, batch_size)
+        os.rename(self.rehashfile + '.plan', self.rehashfile)
+        self._apply_rehash(batch_size)
+
+    def _plan_rehash(self, hash, workers, batch_size):
+        planfile = self.rehashfile + '.plan'
+        cursor, end = None, 0
+        if os.path.isfile(planfile):
+            with open(planfile) as fd:
+                if fd.readline().strip() == hash:
+                    end = fd.tell()
+                    for line in iter(fd.readline, ''):
+                        # a torn final write has no newline
+                        if not line.endswith('\n'):
+                            break
+                        cursor, end = line.split()[0], fd.tell()
+
+        with open(planfile, end and 'r+' or 'w') as plan:
+            if end:
+                LOG.debug('resuming rehash plan after "%s"' % cursor)
+                plan.seek(end)
+                plan.truncate()
+            else:
+                plan.write('%s\n' % hash)
+
+            hash_funcs = [self.hash_func, get_hash(hash)]
+            workers = max(workers, 1)
+            pool = ThreadPool(workers)
+            try:
+                while True:
+                    start = cursor is not None and cursor + '\x00' or None
+                    batch = list(islice(self._sum_index.sorted(start), batch_size))
+                    if not batch:
+                        break
+
+                    for sum, digests, error in self._hash_objects(batch, pool,
+                                                                  workers * 2, hash_funcs):
+                        problem = self._verified(sum, digests, error)
+                        if problem is not None and problem.kind != UNINDEXED:
+                            raise ValueError('cannot rehash %s object "%s" (%s), '
+                              'run cas fsck first' % problem)
+                        plan.write('%s %s\n' % (sum, digests[1]))
+
+                    cursor = batch[-1]
+                    plan.flush()
+                    os.fsync(plan.fileno())
+            finally:
+                pool.terminate()
+
+    def _apply_rehash(self, batch_size=CAS_BATCH_SIZE):
+        """
+        Move every object in the rehash plan to its new sum
+        """
+        # the filters and the checksum cache only know the old sums
+        self._forget_bloom()
+        self._packed_bloom = None
+        if self._checksum_cache is not None:
+            self._checksum_cache.clear()
+
+        with open(self.rehashfile) as plan:
+            hash = plan.readline().strip()
+            LOG.debug('moving objects to their %s sums' % hash)
+            moved = 0
+            for line in plan:
+                sum, new = line.split()
+                # objects moved before an interruption are only missing
+                # from the indices, if anything
+                if not self._sum_index.has_key(sum):
+                    continue
+                self._rename(sum, new)
+                moved += 1
+                if not moved % batch_size:
+                    self._commit()
+
+        self.hash = hash
+        self._chunks.hash_func = self.hash_func
+        self._commit()
+        self._update()
+        self._write_meta()
+        if self._bloom is not None:
+            self._rebuild_bloom()
+
+        # the headers in the packs still name the old sums
+        obsolete = self._packs.repack(full=True)
+        self._commit()
+        self._packs.delete(obsolete)
+        os.remove(self.rehashfile)
+
+    def _rename(self, sum, new):
+        """
+        Move an object's data and index entries to the sum ``new``
+        """
+        path, dst = self.path(sum), self.path(new)
+        if self._is_compressed(sum):
+            suffix = get_codec(self.compression).suffix
+            path, dst = path + suffix, dst + suffix
+
+        if os.path.isfile(path):
+            self._publish(path, dst)
+            self._clean_dir(os.path.dirname(path))
+        elif self._chunks.has(sum):
+            self._chunks.rename(sum, new)
+        else:
+            entry = self._packs.index.find(sum)
+            if entry is not None:
+                self._packs.index.add(new, *entry)
+                self._packs.remove(sum)
+
+        for key, value in list(self._meta_index.pairs(sum)):
+            self._meta_index.add(key, value, new)
+        self._meta_index.remove_all(sum)
+        self._sum_index.add(new)
+        self._sum_index.remove(sum)
 
-    @timeit('cas.storage.CAS.add')
+    @timeit('cas.storage.CAS.add', 'cas_add_seconds')
     def add(self, filename, type=NullType):
         """
         Atomically add a file to storage
         """
-        sum = self.checksum(filename)
-        
-        if self.has_sum(sum):
-            LOG.warn('skipping, storage already has checksum "%s"' % sum)
-            # don't re-add a file that already exists
-            return sum
+        return list(self.add_many([filename], type=type))[0]
 
-        typed = type(filename)
-        typed.verify()
+    @timeit('cas.storage.CAS.add_stream', 'cas_add_seconds')
+    def add_stream(self, fileobj, type=NullType):
+        """
+        Atomically add everything read from a file object (a pipe, socket,
+        download, ...) to storage.
 
-        meta = typed.meta()
-        type_str = typed.type
+        The data is checksummed as it is spooled into the temporary
+        directory, and that spooled file is what gets verified against
+        ``type`` and renamed into place, so it is written exactly once.
+        """
+        self._check_writable()
+
+        fdno, tmpfile = tempfile.mkstemp(dir=self.tmpdir)
+        try:
+            with os.fdopen(fdno, 'wb') as fd:
+                sum = stream_checksum(fileobj, fd, self.hash_func)
+            # mkstemp files are private, but stored objects are as readable
+            # as any other file the user creates
+            os.chmod(tmpfile, 0666 & ~get_umask())
+
+            if self.has_sum(sum):
+                LOG.warn('skipping, storage already has checksum "%s"' % sum)
+                DEDUPED.inc()
+                os.remove(tmpfile)
+                return sum
+
+            typed = type(tmpfile)
+            typed.verify()
+            inspected = Inspected(tmpfile, sum, typed.type, typed.meta(), tmpfile, None)
+        except:
+            if os.path.isfile(tmpfile):
+                os.remove(tmpfile)
+            raise
+
+        self._flush([self._stage(inspected, type, self.mode)])
+        return sum
 
-        path = self.path(sum)
-        destfile = os.path.basename(path)
-        tmpfile = os.path.join(self.tmpdir, destfile)
-        full = fullpath(filename)
+    def add_bytes(self, data, type=NullType):
+        """
+        Atomically add a byte string to storage
+        """
+        return self.add_stream(io.BytesIO(data), type=type)
+
+    def add_many(self, filenames, type=NullType, batch_size=CAS_BATCH_SIZE,
+                 workers=CAS_WORKERS, pool=CAS_POOL, mode=None):
+        """
+        Add an iterable of files to storage, yielding each file's checksum
+        (in input order) as its batch is committed.
+
+        Checksumming, type verification, metadata extraction and chunking
+        are spread over ``workers`` threads or processes (``pool``), while
+        index writes and moves into ``storage/`` stay in the calling thread. Index writes,
+        the storage timestamp and the moves are done once per ``batch_size``
+        files rather than once per file.
+
+        ``mode`` overrides the storage's ingest mode for these files.
+        """
+        self._check_writable()
+        mode = ingest_mode(mode or self.mode)
+        layout = self._layout(pickled=workers > 1 and pool != 'thread')
+        jobs = ((filename, type.type, mode, self.tmpdir, layout, self._known_sum(filename),
+          self.hash) for filename in filenames)
+
+        pending, staged = [], set()
+        started = time.time()
+        try:
+            for inspected in inspect_files(jobs, workers, pool):
+                sum, tmpfile = self._stage(inspected, type, mode, staged)
+                pending.append((sum, tmpfile))
+                staged.add(sum)
+                if len(pending) >= batch_size:
+                    batch, pending, staged = pending, [], set()
+                    sums = self._flush(batch)
+                    ADD_BATCH_SECONDS.observe(time.time() - started)
+                    for sum in sums:
+                        yield sum
+                    started = time.time()
+            batch, pending = pending, []
+            sums = self._flush(batch)
+            if sums:
+                ADD_BATCH_SECONDS.observe(time.time() - started)
+            for sum in sums:
+                yield sum
+        finally:
+            # don't lose already-staged files if a later one fails, or if
+            # the caller stops iterating early
+            batch, pending = pending, []
+            self._flush(batch)
+
+    def _stage(self, inspected, type, mode, staged=()):
+        """
+        Add an inspected file to the (uncommitted) indices. Returns a
+        ``(sum, tmpfile)`` pair, where ``tmpfile`` is ``None`` if storage
+        already has the sum or it is among the ``staged`` sums of the
+        current batch.
+        """
+        if inspected.stat and self._checksum_cache is not None:
+            self._checksum_cache.store(fullpath(inspected.filename),
+              inspected.stat, inspected.sum)
+
+        if self.has_sum(inspected.sum) or inspected.sum in staged:
+            LOG.warn('skipping, storage already has checksum "%s"' % inspected.sum)
+            DEDUPED.inc()
+            # don't re-add a file that already exists
+            if inspected.tmpfile:
+                os.remove(inspected.tmpfile)
+            return inspected.sum, None
 
-        LOG.debug('copying "%s" to "%s"' % (full, tmpfile))
-        shutil.copy2(full, tmpfile)
-      
-        destdir = os.path.dirname(path)
+        if inspected.tmpfile is None:
+            # the sum was removed after it was inspected, so the file was
+            # never copied or verified
+            inspected = inspect_file((inspected.filename, type.type, mode,
+              self.tmpdir, NO_LAYOUT, None, self.hash))
 
-        mkdir_p(destdir)
+        filename, sum, type_str, meta, tmpfile, key = inspected
 
-        # add sum to indices before moving file in place, because this is easier
-        # to clean up if the add operation fails here
+        self._journal.record(ADD, sum)
         self._sum_index.add(sum)
+        self._bloom_add(sum)
         self._meta_index.add('type', type_str, sum)
         for key, val in meta.iteritems():
             self._meta_index.add(key, val, sum)
 
-        LOG.debug('moving "%s" to "%s"' % (tmpfile, destdir))
-        shutil.move(tmpfile, destdir)
+        return sum, tmpfile
+
+    def _flush(self, pending):
+        """
+        Commit a batch of staged files, returning their checksums
+        """
+        if not pending:
+            return []
+
+        # commit sums to indices before moving files in place, because this
+        # is easier to clean up if the add operation fails here
+        self._journal.sync()
+        self._commit()
+
+        packed = False
+        for sum, tmpfile in pending:
+            if tmpfile is None:
+                continue
+
+            ADDED.inc()
+            if tmpfile.endswith(MANIFEST_SUFFIX):
+                # already chunked by a worker
+                self._chunks.publish(sum, tmpfile)
+                continue
+
+            size = os.path.getsize(tmpfile)
+            if self.chunk_threshold and size >= self.chunk_threshold:
+                self._chunks.store(sum, tmpfile, self.tmpdir)
+                os.remove(tmpfile)
+            elif size < self.pack_threshold:
+                self._packs.append(sum, tmpfile)
+                os.remove(tmpfile)
+                packed = True
+                if self._packed_bloom is not None:
+                    if self._packed_bloom.full:
+                        self._packed_bloom = None
+                    else:
+                        self._packed_bloom.add(sum)
+            else:
+                self._publish_loose(sum, tmpfile, size)
+
+        if packed:
+            # pack index entries only get committed once their data is on
+            # disk, until then the journal cleans up after them
+            self._packs.sync()
+            self._commit()
 
         self._update()
         self._write_meta()
+        self._journal.clear()
 
-        return sum
+        return [sum for sum, _ in pending]
+
+    def _publish_loose(self, sum, tmpfile, size):
+        """
+        Move a staged file into storage, compressed if that makes it smaller
+        """
+        codec = get_codec(self.compression)
+        if codec is not None and size >= self.compression_threshold:
+            compressed = tmpfile + codec.suffix
+            if compress_file(tmpfile, compressed, codec) < size:
+                os.remove(tmpfile)
+                self._publish(compressed, self.path(sum) + codec.suffix)
+                return
+            LOG.debug('not compressing "%s", it would not get smaller' % sum)
+            os.remove(compressed)
+
+        st = os.stat(tmpfile)
+        if st.st_nlink > 1:
+            # a hardlinked file becomes the stored object itself, so editing
+            # the original in place would change the object under its sum
+            os.chmod(tmpfile, stat.S_IMODE(st.st_mode) & ~0222)
+        self._publish(tmpfile, self.path(sum))
+
+    def _layout(self, pickled=False):
+        """
+        The ``Layout`` workers check for already stored files. Filters are
+        left out if ``pickled`` (i.e. sent to other processes with every
+        job), and then only the files on disk are checked.
+        """
+        codec = get_codec(self.compression)
+        suffixes = codec and (codec.suffix,) or ()
+        stored, complete = None, False
+        if not pickled and self._bloom is not None:
+            stored, complete = self._bloom, True
+        elif not pickled:
+            if self._packed_bloom is None and len(self._index.packs):
+                self._packed_bloom = BloomFilter.from_sums(
+                  (sum for sum, _ in self._index.packs.iteritems()), len(self._index.packs))
+            stored = self._packed_bloom
+        return Layout(self.storagedir, self.shard_width, self.shard_depth, suffixes,
+          self._chunks.root, self.chunk_threshold, self._chunks.avg_size, stored, complete)
+
+    def _is_compressed(self, sum):
+        # no stat at all for stores without compression
+        codec = get_codec(self.compression)
+        return codec is not None and os.path.isfile(self.path(sum) + codec.suffix)
+
+    def _publish(self, tmpfile, path):
+        """
+        Atomically move a staged file into its sharded path
+        """
+        mkdir_p(os.path.dirname(path))
+
+        LOG.debug('renaming "%s" to "%s"' % (tmpfile, path))
+        os.rename(tmpfile, path)
 
     @timeit('cas.storage.CAS.remove')
     def remove(self, sum):
+        self._check_writable()
         if not self.has_sum(sum):
             raise OSError(errno.ENOENT, sum)
 
-        path = self.path(sum)
-        os.remove(path)
+        self._journal.record(REMOVE, sum)
+        self._journal.sync()
+
+        self._delete(sum)
 
         # the reverse of add, if the remove fails, the indices never get
-        # updated, so nothing to clean up
+        # updated, and the journal finishes the job on the next open
         self._meta_index.remove_all(sum)
         self._sum_index.remove(sum)
-
-        self._clean_dir(os.path.dirname(path))
+        self._commit()
+        REMOVED.inc()
 
         self._update()
         self._write_meta()
+        self._journal.clear()
+
+    def _delete(self, sum):
+        """
+        Delete an object's data. Packed objects are only dropped from the
+        pack index, and chunked objects only lose their manifest. The space
+        they held is reclaimed by ``repack``.
+        """
+        path = self.path(sum)
+        if self._is_compressed(sum):
+            path += get_codec(self.compression).suffix
+
+        if os.path.isfile(path):
+            os.remove(path)
+            self._clean_dir(os.path.dirname(path))
+        elif self._chunks.has(sum):
+            self._chunks.remove(sum)
+        else:
+            self._packs.remove(sum)
+
+    @timeit('cas.storage.CAS.repack')
+    def repack(self):
+        """
+        Rewrite the packfiles holding removed objects and delete the chunks
+        no object uses any more, returning the ids of the packs that were
+        replaced
+        """
+        self._check_writable()
+        obsolete = self._packs.repack()
+        self._commit()
+        self._packs.delete(obsolete)
+        self._chunks.sweep()
+        return obsolete
 
     def _clean_dir(self, dir):
         if os.path.isdir(dir) and not os.listdir(dir):
@@ -333,8 +1278,57 @@ class CAS(object):
         return os.path.sep.join(self._shard(sum))
 
     def checksum(self, filename):
-        return checksum(filename)
+        if self._checksum_cache is None:
+            return checksum(filename, self.hash_func)
+
+        full = fullpath(filename)
+        key = stat_key(full)
+        sum = self._checksum_cache.lookup(full, key)
+        if sum is None:
+            sum = checksum(full, self.hash_func)
+            self._checksum_cache.store(full, key, sum)
+        return sum
+
+    def _known_sum(self, filename):
+        """
+        The cached checksum of a file, if it is cached and already stored
+        """
+        if self._checksum_cache is None:
+            return None
+
+        try:
+            sum = self._checksum_cache.lookup(fullpath(filename))
+        except OSError:
+            # let the add itself report the missing file
+            return None
 
-    def list(self):
-        for key, val in self._sum_index.iteritems():
-            yield key
+        if sum is not None and self.has_sum(sum):
+            return sum
+
+    def list(self, prefix=None, after=None, limit=None):
+        """
+        Lazily yield the stored sums in sorted order, optionally only those
+        starting with ``prefix``, and only those after the sum ``after`` and
+        up to ``limit`` of them, to page through them
+        """
+        start, stop = value_bounds(prefix)
+        if after is not None:
+            after = str(after) + '\x00'
+            start = after if start is None else max(start, after)
+        sums = self._sum_index.sorted(start, stop)
+        if limit is not None:
+            sums = islice(sums, limit)
+        return sums
+
+    def resolve(self, prefix):
+        """
+        The stored sum that an abbreviated sum (any unique prefix, like git
+        object names) stands for. Raises ``KeyError`` if no sum starts with
+        it, or ``AmbiguousSum`` if several do.
+        """
+        candidates = list(self.list(prefix=prefix, limit=10))
+        if not candidates:
+            raise KeyError(prefix)
+        elif len(candidates) > 1:
+            raise AmbiguousSum(prefix, candidates)
+        return candidates[0]
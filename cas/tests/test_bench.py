@@ -0,0 +1,72 @@
+import unittest
+import tempfile
+import shutil
+import os
+from cas.bench import Corpus, BenchType, percentile, summarize, compare, run, SCENARIOS
+
+class TestBench(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(percentile(values, 50), 50)
+        self.assertEquals(percentile(values, 99), 99)
+        self.assertEquals(percentile(values, 100), 100)
+        self.assertEquals(percentile([3], 90), 3)
+        self.assertEquals(percentile([], 50), None)
+
+    def test_summarize(self):
+        result = summarize([0.5, 0.25, 0.25], size=100)
+        self.assertEquals(result['ops'], 3)
+        self.assertEquals(result['seconds'], 1.0)
+        self.assertEquals(result['ops_per_second'], 3.0)
+        self.assertEquals(result['bytes_per_second'], 100.0)
+        self.assertEquals(result['latency']['p50'], 0.25)
+        self.assertEquals(result['latency']['max'], 0.5)
+
+    def test_corpus(self):
+        corpus = Corpus(20, size=100, keys=2, cardinality=3, seed=1)
+        objects = list(corpus.objects())
+        self.assertEquals(len(set(objects)), 20)
+        self.assertEquals(objects, list(Corpus(20, 100, keys=2, cardinality=3, seed=1).objects()))
+        self.assertNotEquals(objects, list(Corpus(20, 100, keys=2, cardinality=3, seed=2).objects()))
+
+        paths, size = corpus.write(self.dir)
+        self.assertEquals(size, sum(len(data) for data in objects))
+        meta = BenchType(paths[0]).meta()
+        self.assertEquals(sorted(meta), ['k0', 'k1'])
+        self.assertTrue(meta['k0'] in ['v0', 'v1', 'v2'])
+
+    def test_corpus_fixed_size(self):
+        corpus = Corpus(10, size=200, distribution='fixed')
+        self.assertTrue(all(len(data) == 200 for data in corpus.objects()))
+        self.assertRaises(ValueError, Corpus, 10, distribution='bogus')
+
+    def test_run(self):
+        report = run(Corpus(50, size=256), workdir=self.dir, sample=10)
+        self.assertEquals(sorted(report['scenarios']), sorted(SCENARIOS))
+        self.assertEquals(report['params']['corpus']['count'], 50)
+        self.assertEquals(report['scenarios']['add_many']['ops'], 50)
+        self.assertEquals(report['scenarios']['has_sum']['ops'], 10)
+        self.assertEquals(report['scenarios']['list']['full']['items'], 60)
+        self.assertTrue(report['scenarios']['add_many']['bytes_per_second'] > 0)
+        # the store is cleaned up
+        self.assertEquals(os.listdir(self.dir), [])
+
+    def test_run_some(self):
+        report = run(Corpus(20, size=64), ['match'], workdir=self.dir, sample=5)
+        self.assertEquals(report['scenarios'].keys(), ['match'])
+
+    def test_compare(self):
+        def report(ops, p99):
+            return {'scenarios': {'add': summarize([p99] * 10, 10.0 / ops)}}
+        rows = compare(report(100, 0.01), report(80, 0.01))
+        self.assertEquals([(m, worse) for _, m, _, _, _, worse in rows],
+          [('ops_per_second', True), ('latency.p50', False), ('latency.p90', False),
+           ('latency.p99', False)])
+        rows = compare(report(100, 0.01), report(120, 0.02), threshold=0.5)
+        self.assertEquals([worse for _, _, _, _, _, worse in rows], [False, True, True, True])
@@ -0,0 +1,51 @@
+import unittest
+import tempfile
+import hashlib
+import shutil
+import os
+from cas.bloom import BloomFilter
+
+def sums(start, stop):
+    return [hashlib.sha1(str(i)).hexdigest() for i in xrange(start, stop)]
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'bloom')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_no_false_negatives(self):
+        bloom = BloomFilter(1000)
+        for sum in sums(0, 1000):
+            bloom.add(sum)
+        self.assertTrue(all(sum in bloom for sum in sums(0, 1000)))
+        self.assertEquals(len(bloom), 1000)
+        self.assertTrue(bloom.full)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter.from_sums(sums(0, 1000), 1000)
+        false_positives = sum(1 for s in sums(1000, 11000) if s in bloom)
+        # sized for 2000 at 1%, so well under that
+        self.assertTrue(false_positives < 100, false_positives)
+        self.assertFalse(bloom.full)
+
+    def test_save_load(self):
+        bloom = BloomFilter.from_sums(sums(0, 100), 100)
+        bloom.save(self.filename)
+
+        loaded = BloomFilter.load(self.filename)
+        self.assertEquals(len(loaded), 100)
+        self.assertEquals(loaded.capacity, bloom.capacity)
+        self.assertTrue(all(sum in loaded for sum in sums(0, 100)))
+
+    def test_load_invalid(self):
+        self.assertEquals(BloomFilter.load(self.filename), None)
+        open(self.filename, 'w').write('junk')
+        self.assertEquals(BloomFilter.load(self.filename), None)
+
+        BloomFilter(100).save(self.filename)
+        data = open(self.filename).read()
+        open(self.filename, 'w').write(data[:-1])
+        self.assertEquals(BloomFilter.load(self.filename), None)
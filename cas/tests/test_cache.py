@@ -0,0 +1,65 @@
+import unittest
+import tempfile
+import shutil
+import os
+import time
+from cas.cache import ChecksumCache
+from cas.util import stat_key
+
+class TestChecksumCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache = ChecksumCache(os.path.join(self.dir, 'cache'), 3)
+        self.file = os.path.join(self.dir, 'file')
+        open(self.file, 'w').write('foo')
+        # files modified just now aren't cached
+        os.utime(self.file, (time.time() - 10, time.time() - 10))
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.dir)
+
+    def test_hit(self):
+        self.cache.store(self.file, stat_key(self.file), 'sum')
+        self.assertEquals(self.cache.lookup(self.file), 'sum')
+
+    def test_miss_on_change(self):
+        self.cache.store(self.file, stat_key(self.file), 'sum')
+        open(self.file, 'w').write('foobar')
+        self.assertEquals(self.cache.lookup(self.file), None)
+
+    def test_lru_eviction(self):
+        key = stat_key(self.file)
+        for path in ['a', 'b', 'c']:
+            self.cache.store(path, key, path)
+            time.sleep(0.01)
+        self.cache.lookup('a', key)
+        self.cache.store('d', key, 'd')
+        self.assertEquals(sorted(self.cache.keys()), ['a', 'c', 'd'])
+
+    def test_recency_synced(self):
+        key = stat_key(self.file)
+        self.cache.store('a', key, 'a')
+        stored = self.cache['a'][2]
+        time.sleep(0.01)
+        self.cache.lookup('a', key)
+        # hits aren't written until the cache is synced
+        self.assertEquals(self.cache['a'][2], stored)
+        self.cache.sync()
+        self.assertTrue(self.cache['a'][2] > stored)
+
+    def test_count(self):
+        key = stat_key(self.file)
+        self.cache.store('a', key, 'a')
+        self.cache.store('a', key, 'a')
+        self.cache.store('b', key, 'b')
+        self.cache.close()
+        self.cache = ChecksumCache(os.path.join(self.dir, 'cache'), 3)
+        self.assertEquals(self.cache._count, 2)
+        del self.cache['a']
+        self.assertEquals(self.cache._count, 1)
+
+    def test_racy_mtime(self):
+        open(self.file, 'w').write('bar')
+        self.cache.store(self.file, stat_key(self.file), 'sum')
+        self.assertEquals(self.cache.lookup(self.file), None)
@@ -0,0 +1,111 @@
+import unittest
+import tempfile
+import hashlib
+import shutil
+import io
+import os
+from mock import patch
+from cas.chunks import chunks, ChunkStore, GEAR
+
+try:
+    import numpy
+    from cas.chunks import _gear_hashes
+except ImportError:
+    numpy = None
+
+def data(size, seed):
+    out, block = [], hashlib.sha1(seed).digest()
+    while len(out) * len(block) < size:
+        block = hashlib.sha1(block).digest()
+        out.append(block)
+    return ''.join(out)[:size]
+
+class TestChunks(unittest.TestCase):
+    def test_sizes(self):
+        pieces = list(chunks(io.BytesIO(data(200000, 'a')), avg_size=4096))
+        self.assertEquals(''.join(pieces), data(200000, 'a'))
+        for piece in pieces[:-1]:
+            self.assertTrue(1024 <= len(piece) <= 16384)
+
+    def test_empty(self):
+        self.assertEquals(list(chunks(io.BytesIO(''), avg_size=4096)), [])
+
+    def test_fixed_size(self):
+        with patch('cas.chunks.numpy', None):
+            pieces = list(chunks(io.BytesIO(data(10000, 'a')), avg_size=4096))
+        self.assertEquals(map(len, pieces), [4096, 4096, 1808])
+        self.assertEquals(''.join(pieces), data(10000, 'a'))
+
+    @unittest.skipIf(numpy is None, 'content-defined chunking needs numpy')
+    def test_gear_hashes(self):
+        content, h, expected = data(1000, 'a'), 0, []
+        for byte in bytearray(content[100:]):
+            h = ((h << 1) + GEAR[byte]) & 0xffffffff
+            expected.append(h)
+        self.assertEquals(list(_gear_hashes(content, 100, 1000)), expected)
+
+    @unittest.skipIf(numpy is None, 'content-defined chunking needs numpy')
+    def test_insert_shares_chunks(self):
+        original = data(200000, 'a')
+        edited = original[:100000] + 'inserted' + original[100000:]
+        before = list(chunks(io.BytesIO(original), avg_size=4096))
+        after = list(chunks(io.BytesIO(edited), avg_size=4096))
+        self.assertTrue(len(set(before) & set(after)) >= len(before) - 3)
+
+class TestChunkStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tmpdir = os.path.join(self.dir, 'tmp')
+        os.mkdir(self.tmpdir)
+        self.store = ChunkStore(self.dir, 2, 2, avg_size=4096)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def add(self, content):
+        filename = os.path.join(self.dir, 'staged')
+        with open(filename, 'wb') as fd:
+            fd.write(content)
+        sum = hashlib.sha1(content).hexdigest()
+        self.store.store(sum, filename, self.tmpdir)
+        return sum
+
+    def chunk_count(self):
+        return sum(len(files) for _, _, files in os.walk(self.store.chunkdir))
+
+    def test_store(self):
+        content = data(50000, 'a')
+        sum = self.add(content)
+        self.assertTrue(self.store.has(sum))
+        self.assertEquals(self.store.open(sum).read(), content)
+        self.assertEquals(os.listdir(self.tmpdir), [])
+
+        reader = self.store.open(sum)
+        self.assertEquals(reader.size, len(content))
+        self.assertEquals(reader.read(10) + reader.read(20000) + reader.read(), content)
+
+        reader.seek(30000)
+        self.assertEquals(reader.read(100), content[30000:30100])
+        reader.seek(-10, os.SEEK_END)
+        self.assertEquals(reader.read(), content[-10:])
+        reader.seek(5)
+        self.assertEquals(reader.tell(), 5)
+        self.assertEquals(reader.read(), content[5:])
+
+    @unittest.skipIf(numpy is None, 'content-defined chunking needs numpy')
+    def test_sweep(self):
+        original = data(50000, 'a')
+        first = self.add(original)
+        count = self.chunk_count()
+        second = self.add(original[:100] + 'x' + original[100:])
+        self.assertTrue(self.chunk_count() < 2 * count)
+
+        self.store.remove(first)
+        self.assertFalse(self.store.has(first))
+        self.assertTrue(self.store.sweep() > 0)
+        self.assertEquals(self.store.sweep(), 0)
+        self.assertEquals(self.store.open(second).read(), original[:100] + 'x' + original[100:])
+
+        self.store.remove(second)
+        self.store.sweep()
+        self.assertEquals(self.chunk_count(), 0)
@@ -0,0 +1,41 @@
+import unittest
+import tempfile
+import shutil
+import os
+from cas.compression import CODECS, get_codec, compress_file, DecompressingReader
+
+class TestCompression(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.data = ''.join('line %d\n' % i for i in range(20000))
+        with open(self.src, 'wb') as fd:
+            fd.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_get_codec(self):
+        self.assertEquals(get_codec('none'), None)
+        self.assertEquals(get_codec('zlib').suffix, '.zlib')
+        self.assertRaises(ValueError, get_codec, 'rot13')
+
+    def test_round_trip(self):
+        for name, codec in CODECS.items():
+            dst = os.path.join(self.dir, name)
+            size = compress_file(self.src, dst, codec)
+            self.assertEquals(size, os.path.getsize(dst))
+            self.assertTrue(size < len(self.data))
+
+            reader = DecompressingReader(open(dst, 'rb'), codec, block_size=1024)
+            self.assertEquals(reader.read(5), 'line ')
+            self.assertEquals(reader.read(5000) + reader.read(), self.data[5:])
+            self.assertEquals(reader.read(), '')
+            reader.close()
+
+            reader = DecompressingReader(open(dst, 'rb'), codec, block_size=1024)
+            reader.seek(10000)
+            self.assertEquals(reader.tell(), 10000)
+            self.assertEquals(reader.read(10), self.data[10000:10010])
+            self.assertRaises(IOError, reader.seek, 0)
+            reader.close()
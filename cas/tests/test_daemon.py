@@ -0,0 +1,160 @@
+import unittest
+import tempfile
+import threading
+import shutil
+import time
+import os
+from StringIO import StringIO
+from cas import CAS, AmbiguousSum
+from cas.daemon import Daemon, RemoteCAS, connect
+from cas.files import NullType, InvalidFileType, register_type, TYPE_MAP
+from cas.query import QuerySyntaxError
+
+class NeverType(NullType):
+    type = 'never'
+
+    def verify(self):
+        raise InvalidFileType(self.filename, self.type)
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.storage_dir = tempfile.mkdtemp()
+        self.storage = CAS(self.storage_dir)
+        self.daemon = Daemon(self.storage)
+        self.thread = threading.Thread(target=self.daemon.serve_forever,
+          kwargs={'poll_interval': 0.01})
+        self.thread.start()
+        self.remote = connect(self.storage.socketfile)
+
+        fdno, self.testfile = tempfile.mkstemp()
+        os.write(fdno, 'foo\xff')
+        os.close(fdno)
+
+    def tearDown(self):
+        self.stop()
+        shutil.rmtree(self.storage_dir)
+        os.remove(self.testfile)
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.daemon.shutdown()
+            self.thread.join()
+            self.daemon.server_close()
+
+    def test_connect(self):
+        self.assertTrue(isinstance(self.remote, RemoteCAS))
+        self.assertEquals(connect(os.path.join(self.storage_dir, 'nothing')), None)
+
+    def test_connect_stale(self):
+        self.stop()
+        self.assertTrue(os.path.exists(self.storage.socketfile))
+        self.assertEquals(connect(self.storage.socketfile), None)
+
+    def test_add(self):
+        sum = self.remote.add(self.testfile)
+        self.assertEquals(sum, self.storage.checksum(self.testfile))
+        self.assertTrue(self.remote.has_sum(sum))
+        self.assertEquals(list(self.remote.list()), [sum])
+        self.assertEquals(self.remote.path(sum), self.storage.path(sum))
+        self.assertEquals(list(self.remote.equals('type', 'none')), [sum])
+        self.assertEquals(list(self.remote.match('type', '^no')), [sum])
+        self.assertEquals(list(self.remote.query('type=none')), [sum])
+
+    def test_add_stream(self):
+        sum = self.remote.add_stream(open(self.testfile, 'rb'))
+        self.assertEquals(sum, self.storage.checksum(self.testfile))
+        self.assertEquals(self.remote.add_bytes('foo\xff'), sum)
+        self.assertEquals(open(self.storage.path(sum)).read(), 'foo\xff')
+
+    def test_list_resolve(self):
+        sums = sorted(self.remote.add_bytes(str(i)) for i in range(10))
+        self.assertEquals(list(self.remote.list(after=sums[2], limit=3)), sums[3:6])
+        self.assertEquals(self.remote.resolve(sums[4][:10]), sums[4])
+        self.assertRaises(AmbiguousSum, self.remote.resolve, '')
+
+    def test_read(self):
+        data = ''.join(chr(i) for i in range(256)) * 10
+        sum = self.remote.add_bytes(data)
+        self.assertEquals(self.remote.read(sum), data)
+        self.assertEquals(self.remote.read(sum, 300, 20), data[300:320])
+        out = StringIO()
+        self.assertEquals(self.remote.send(sum, out, 10), len(data) - 10)
+        self.assertEquals(out.getvalue(), data[10:])
+
+    def test_stats(self):
+        self.remote.add_bytes('foo')
+        stats = self.remote.stats()
+        self.assertEquals(stats['cas_objects']['value'], 1)
+        self.assertEquals(stats['cas_store_bytes']['value'], 3)
+        self.assertTrue(stats['cas_add_seconds']['count'] > 0)
+
+    def serve(self, **kwargs):
+        self.stop()
+        self.daemon = Daemon(self.storage, **kwargs)
+        self.thread = threading.Thread(target=self.daemon.serve_forever,
+          kwargs={'poll_interval': 0.01})
+        self.thread.start()
+
+    def test_metrics_file(self):
+        metrics_file = os.path.join(self.storage_dir, 'metrics.prom')
+        self.serve(metrics_file=metrics_file, metrics_interval=60)
+        self.remote.add_bytes('foo')
+        # not after every request, but when the daemon stops
+        self.assertFalse(os.path.exists(metrics_file))
+        self.stop()
+        with open(metrics_file) as fd:
+            self.assertTrue('# TYPE cas_add_seconds histogram' in fd.read())
+
+        os.remove(metrics_file)
+        self.serve(metrics_file=metrics_file, metrics_interval=0.01)
+        for _ in xrange(500):
+            if os.path.exists(metrics_file):
+                break
+            time.sleep(0.01)
+        self.assertTrue(os.path.exists(metrics_file))
+
+    def test_verify(self):
+        sum = self.remote.add_bytes('foo')
+        self.assertEquals(list(self.remote.verify()), [])
+        os.remove(self.storage.path(sum))
+        problems = list(self.remote.verify(quarantine=True))
+        self.assertEquals([(p.kind, p.sum) for p in problems], [('missing', sum)])
+        self.assertFalse(self.remote.has_sum(sum))
+
+    def test_add_relative(self):
+        cwd = os.getcwd()
+        os.chdir(os.path.dirname(self.testfile))
+        try:
+            sum = self.remote.add(os.path.basename(self.testfile))
+        finally:
+            os.chdir(cwd)
+        self.assertTrue(self.storage.has_sum(sum))
+
+    def test_binary_filename(self):
+        filename = os.path.join(self.storage_dir, 'caf\xe9')
+        shutil.copy(self.testfile, filename)
+        sum = self.remote.add(filename)
+        self.assertTrue(self.storage.has_sum(sum))
+
+    def test_remove(self):
+        sum = self.remote.add(self.testfile)
+        self.remote.remove(sum)
+        self.assertFalse(self.remote.has_sum(sum))
+        self.assertRaises(OSError, self.remote.remove, sum)
+
+    def test_meta(self):
+        self.assertEquals(self.remote.meta()['uuid'], self.storage.uuid)
+
+    def test_errors(self):
+        self.assertRaises(QuerySyntaxError, list, self.remote.query('type=none and'))
+        self.assertRaises(ValueError, list, self.remote.add_many([self.testfile],
+          type=type('Missing', (NullType,), {'type': 'missing'})))
+
+        register_type(NeverType)
+        try:
+            self.assertRaises(InvalidFileType, self.remote.add, self.testfile,
+              type=NeverType)
+        finally:
+            del TYPE_MAP[NeverType.type]
+
+        self.assertTrue(self.remote.has_sum('0' * 40) is False)
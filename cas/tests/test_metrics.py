@@ -0,0 +1,101 @@
+import unittest
+import tempfile
+import shutil
+import json
+import os
+from cas.metrics import Registry, Histogram, percentile, to_text, to_prometheus, \
+  add_hook, remove_hook, record_call, timed_call, write, REGISTRY
+from cas.util import timeit
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('things_total', 'Things')
+        counter.inc()
+        counter.inc(2)
+        self.assertTrue(self.registry.counter('things_total') is counter)
+        self.assertEquals(self.registry.snapshot()['things_total'],
+          {'type': 'counter', 'help': 'Things', 'value': 3})
+        self.assertRaises(ValueError, self.registry.gauge, 'things_total')
+        self.registry.reset()
+        self.assertEquals(counter.value, 0)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('size')
+        self.assertEquals(to_prometheus(self.registry.snapshot()), '\n')
+        gauge.set(10)
+        self.assertEquals(to_text(self.registry.snapshot()), 'size 10\n')
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('latency', buckets=(1, 2, 5))
+        for value in [0.5, 1, 1.5, 3, 10]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEquals(snapshot['buckets'], [[1, 2], [2, 3], [5, 4], ['+Inf', 5]])
+        self.assertEquals(snapshot['count'], 5)
+        self.assertEquals(snapshot['sum'], 16.0)
+        self.assertEquals(snapshot['p50'], 2)
+        self.assertEquals(snapshot['p99'], '+Inf')
+
+    def test_percentile(self):
+        self.assertEquals(percentile([[1, 0], ['+Inf', 0]], 50), None)
+        self.assertEquals(percentile([[1, 9], [2, 10], ['+Inf', 10]], 90), 1)
+        self.assertEquals(percentile([[1, 9], [2, 10], ['+Inf', 10]], 99), 2)
+
+    def test_prometheus(self):
+        self.registry.counter('things_total', 'Things').inc(2)
+        self.registry.histogram('latency', buckets=(1,)).observe(0.5)
+        self.assertEquals(to_prometheus(self.registry.snapshot()), '\n'.join([
+          '# TYPE latency histogram',
+          'latency_bucket{le="1"} 1',
+          'latency_bucket{le="+Inf"} 1',
+          'latency_sum 0.5',
+          'latency_count 1',
+          '# HELP things_total Things',
+          '# TYPE things_total counter',
+          'things_total 2',
+        ]) + '\n')
+
+    def test_hooks(self):
+        calls = []
+        hook = lambda hint, elapsed: calls.append(hint)
+        add_hook(hook)
+        try:
+            timeit('test.double')(lambda x: x * 2)(2)
+            record_call('test.other', 0.1)
+        finally:
+            remove_hook(hook)
+        self.assertEquals(calls, ['test.double', 'test.other'])
+
+    def test_timeit_histogram(self):
+        histogram = REGISTRY.histogram('test_seconds')
+        self.assertEquals(timeit('test.double', 'test_seconds')(lambda x: x * 2)(2), 4)
+        self.assertEquals(histogram.count, 1)
+
+    def test_timed_call(self):
+        histogram = REGISTRY.histogram('test_timed_seconds')
+        self.assertEquals(timed_call('test', 'test_timed_seconds', lambda: [1, 2]), [1, 2])
+        self.assertEquals(histogram.count, 1)
+
+        # lazy results are recorded once they are finished with
+        items = timed_call('test', 'test_timed_seconds', iter, [1, 2, 3])
+        self.assertEquals(next(items), 1)
+        self.assertEquals(histogram.count, 1)
+        items.close()
+        self.assertEquals(histogram.count, 2)
+
+    def test_write(self):
+        dir = tempfile.mkdtemp()
+        try:
+            self.registry.counter('things_total').inc()
+            write(os.path.join(dir, 'metrics.json'), self.registry.snapshot())
+            with open(os.path.join(dir, 'metrics.json')) as fd:
+                self.assertEquals(json.load(fd)['things_total']['value'], 1)
+            write(os.path.join(dir, 'metrics.prom'), self.registry.snapshot())
+            with open(os.path.join(dir, 'metrics.prom')) as fd:
+                self.assertTrue('things_total 1\n' in fd.read())
+            self.assertEquals(sorted(os.listdir(dir)), ['metrics.json', 'metrics.prom'])
+        finally:
+            shutil.rmtree(dir)
@@ -0,0 +1,75 @@
+import unittest
+import tempfile
+import shutil
+import os
+from cas.index import PackIndex
+from cas.pack import PackStore
+
+class TestPackStore(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = PackIndex({})
+        self.packs = PackStore(self.dir, self.index, max_size=64)
+
+    def tearDown(self):
+        self.packs.close()
+        shutil.rmtree(self.dir)
+
+    def add(self, sum, data):
+        filename = os.path.join(self.dir, 'staged')
+        with open(filename, 'wb') as fd:
+            fd.write(data)
+        self.packs.append(sum, filename)
+        os.remove(filename)
+
+    def test_read(self):
+        self.add('a', 'foo')
+        self.add('b', 'bar\x00baz')
+        self.assertEquals(self.packs.read('a'), 'foo')
+        self.assertEquals(self.packs.read('b'), 'bar\x00baz')
+        self.assertTrue(self.packs.has('a'))
+        self.assertFalse(self.packs.has('c'))
+        self.assertRaises(KeyError, self.packs.read, 'c')
+
+    def test_pack_rollover(self):
+        for i in range(10):
+            self.add('%02d' % i, 'x' * 20)
+        self.assertTrue(len(self.packs.packs()) > 1)
+        for pack in self.packs.packs():
+            self.assertTrue(os.path.getsize(self.packs.filename(pack)) <= 64)
+        for i in range(10):
+            self.assertEquals(self.packs.read('%02d' % i), 'x' * 20)
+
+    def test_reopen(self):
+        self.add('a', 'foo')
+        self.packs.close()
+        packs = PackStore(self.dir, self.index, max_size=64)
+        self.assertEquals(packs.read('a'), 'foo')
+        self.assertEquals(packs.packs(), [0])
+
+    def test_repack(self):
+        for i in range(10):
+            self.add('%02d' % i, str(i) * 20)
+        before = self.packs.packs()
+        for i in range(0, 10, 2):
+            self.packs.remove('%02d' % i)
+
+        obsolete = self.packs.repack()
+        self.assertEquals(obsolete, before)
+        self.packs.delete(obsolete)
+
+        self.assertFalse(set(before) & set(self.packs.packs()))
+        for i in range(1, 10, 2):
+            self.assertEquals(self.packs.read('%02d' % i), str(i) * 20)
+
+        # nothing left to compact
+        self.assertEquals(self.packs.repack(), [])
+
+    def test_repack_garbage(self):
+        self.add('a', 'foo')
+        self.packs.close()
+        with open(self.packs.filename(0), 'ab') as fd:
+            fd.write('b 3\nba')
+        self.assertEquals(self.packs.repack(), [0])
+        self.packs.delete([0])
+        self.assertEquals(self.packs.read('a'), 'foo')
@@ -0,0 +1,103 @@
+import unittest
+import tempfile
+import shutil
+import os
+from mock import patch
+from cas.storage import MetaIndex, ReverseMetaIndex
+from cas.index import SqliteBackend
+from cas.query import Context, Equals, Match, And, Or, Not, parse, QuerySyntaxError
+
+PACKAGES = {
+  'a': {'type': 'rpm', 'rpm.name': 'kernel', 'rpm.arch': 'x86_64'},
+  'b': {'type': 'rpm', 'rpm.name': 'kernel', 'rpm.arch': 'i686'},
+  'c': {'type': 'rpm', 'rpm.name': 'bash', 'rpm.arch': 'x86_64'},
+  'd': {'type': 'none'},
+}
+
+class TestQuery(unittest.TestCase):
+    def open_index(self):
+        self.reverse = ReverseMetaIndex(os.path.join(self.dir, 'reverse'))
+        return MetaIndex(os.path.join(self.dir, 'forward'), self.reverse)
+
+    def close_index(self):
+        self.index.close()
+        self.reverse.close()
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.index = self.open_index()
+        for sum, meta in PACKAGES.iteritems():
+            for key, value in meta.iteritems():
+                self.index.add(key, value, sum)
+        universe = lambda start=None: iter(s for s in sorted(PACKAGES) if s >= start)
+        self.ctx = Context(self.index, universe, len(PACKAGES))
+
+    def tearDown(self):
+        self.close_index()
+        shutil.rmtree(self.dir)
+
+    def query(self, predicate):
+        return list(predicate.sums(self.ctx))
+
+    def test_equals(self):
+        self.assertEquals(self.query(Equals('rpm.name', 'kernel')), ['a', 'b'])
+
+    def test_and(self):
+        predicate = Equals('rpm.name', 'kernel') & Equals('rpm.arch', 'x86_64')
+        self.assertEquals(self.query(predicate), ['a'])
+
+    def test_or(self):
+        predicate = Equals('rpm.name', 'bash') | Equals('type', 'none')
+        self.assertEquals(self.query(predicate), ['c', 'd'])
+
+    def test_not(self):
+        self.assertEquals(self.query(~Equals('type', 'rpm')), ['d'])
+        predicate = Equals('type', 'rpm') & ~Match('rpm.name', '^ker')
+        self.assertEquals(self.query(predicate), ['c'])
+
+    def test_not_only(self):
+        predicate = ~Equals('rpm.arch', 'x86_64') & ~Equals('type', 'none')
+        self.assertEquals(self.query(predicate), ['b'])
+        self.assertEquals(list(Not(Equals('type', 'rpm')).sums(self.ctx, 'b')), ['d'])
+
+    def test_not_streams_child_once(self):
+        child = Equals('rpm.arch', 'x86_64')
+        with patch.object(Equals, 'contains') as contains:
+            self.assertEquals(self.query(~child), ['b', 'd'])
+            self.assertFalse(contains.called)
+
+    def test_match_estimate(self):
+        self.assertEquals(Match('rpm.name', 'e').estimate(self.ctx), 3)
+        self.assertEquals(Match('rpm.name', prefix='z').estimate(self.ctx), 0)
+        with patch('cas.query.ESTIMATE_SAMPLE', 1):
+            # extrapolated from the first value, bash
+            self.assertEquals(Match('rpm.name', 'e').estimate(self.ctx), 2)
+
+    def test_match(self):
+        self.assertEquals(self.query(Match('rpm.arch', prefix='x86')), ['a', 'c'])
+        self.assertEquals(self.query(Match('rpm.name', 'sh$') | Match('rpm.arch', '86$')),
+          ['b', 'c'])
+
+    def test_plan_most_selective_first(self):
+        predicate = And(Equals('type', 'rpm'), Equals('rpm.name', 'bash'),
+          Not(Equals('type', 'none')))
+        positive, negative = predicate.plan(self.ctx)
+        self.assertEquals([p.value for p in positive], ['bash', 'rpm'])
+        self.assertEquals(len(negative), 1)
+
+    def test_parse(self):
+        predicate = parse('type=rpm and (rpm.name="kernel" or rpm.name^=ba) '
+          'and not rpm.arch~\'^i[0-9]86$\'')
+        self.assertEquals(self.query(predicate), ['a', 'c'])
+
+    def test_parse_errors(self):
+        for expression in ['type', 'type=rpm and', '(type=rpm', 'type=rpm )']:
+            self.assertRaises(QuerySyntaxError, lambda: parse(expression))
+
+class TestSqliteQuery(TestQuery):
+    def open_index(self):
+        self.backend = SqliteBackend(self.dir)
+        return self.backend.meta
+
+    def close_index(self):
+        self.backend.close()
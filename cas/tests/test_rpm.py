@@ -0,0 +1,105 @@
+import unittest
+import tempfile
+import struct
+import hashlib
+import imp
+import os
+from StringIO import StringIO
+from cas.files import InvalidFileType
+
+plugin = imp.load_source('cas_rpm_plugin',
+  os.path.join(os.path.dirname(os.path.dirname(__file__)), 'plugins', 'rpm.py'))
+
+def section(tags):
+    """
+    A header structure holding ``(tag, type, count, data)`` entries
+    """
+    index, store = '', ''
+    for tag, type, count, data in tags:
+        index += struct.pack('>iIiI', tag, type, len(store), count)
+        store += data
+    return plugin.HEADER_MAGIC + '\0' * 4 + struct.pack('>II', len(tags), len(store)) + \
+      index + store
+
+def package(tags, payload='payload', digests=True):
+    lead = plugin.LEAD_MAGIC + '\x03\x00' + '\0' * (plugin.LEAD_SIZE - 6)
+    header = section(tags)
+    signature = [(1000, plugin.INT32, 1, '\0\0\0\x05'), (1007, plugin.BIN, 1, 'x')]
+    if digests:
+        signature += [(269, plugin.STRING, 1, hashlib.sha1(header).hexdigest() + '\0'),
+          (273, plugin.STRING, 1, hashlib.sha256(header).hexdigest() + '\0')]
+    # the signature is padded to a multiple of 8 bytes
+    size = sum(len(data) for _, _, _, data in signature)
+    return lead + section(signature) + '\0' * (-size % 8) + header + payload
+
+TAGS = [
+  (1000, plugin.STRING, 1, 'bash\0'),
+  (1001, plugin.STRING, 1, '4.2.46\0'),
+  (1002, plugin.STRING, 1, '34.el7\0'),
+  (1003, plugin.INT32, 1, struct.pack('>I', 2)),
+  (1004, plugin.I18NSTRING, 2, 'The shell\0Die Shell\0'),
+  (1016, plugin.I18NSTRING, 1, 'System Environment/Shells\0'),
+  (1022, plugin.STRING, 1, 'x86_64\0'),
+]
+
+class TestRpm(unittest.TestCase):
+    def setUp(self):
+        fdno, self.filename = tempfile.mkstemp()
+        os.close(fdno)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def write(self, data):
+        with open(self.filename, 'wb') as fd:
+            fd.write(data)
+
+    def test_read_header(self):
+        header = plugin.read_header(StringIO(package(TAGS)))
+        self.assertEquals(header['name'], 'bash')
+        self.assertEquals(header['version'], '4.2.46')
+        self.assertEquals(header['release'], '34.el7')
+        self.assertEquals(header['epoch'], 2)
+        self.assertEquals(header['summary'], 'The shell')
+        self.assertEquals(header['group'], 'System Environment/Shells')
+        self.assertEquals(header['arch'], 'x86_64')
+        self.assertEquals(header['vendor'], None)
+
+    def test_no_digests(self):
+        header = plugin.read_header(StringIO(package(TAGS, digests=False)))
+        self.assertEquals(header['name'], 'bash')
+
+    def test_tampered_header(self):
+        data = package(TAGS).replace('4.2.46', '4.2.47')
+        self.assertRaises(plugin.RpmError, plugin.read_header, StringIO(data))
+        self.write(data)
+        self.assertRaises(InvalidFileType, plugin.RpmType(self.filename).verify)
+
+    def test_no_epoch(self):
+        header = plugin.read_header(StringIO(package([TAGS[0]])))
+        self.assertEquals(header['epoch'], 0)
+
+    def test_payload_not_read(self):
+        fd = StringIO(package(TAGS, 'x' * 10000))
+        plugin.read_header(fd)
+        self.assertEquals(len(fd.read()), 10000)
+
+    def test_invalid(self):
+        for data in ['not an rpm' * 20, package(TAGS)[:200],
+                     package([(1000, plugin.STRING, 1, 'bash')])]:
+            self.assertRaises(plugin.RpmError, plugin.read_header, StringIO(data))
+
+    def test_type(self):
+        self.write(package(TAGS))
+        typed = plugin.RpmType(self.filename)
+        typed.verify()
+        with open(self.filename, 'wb'):
+            # parsed once, by verify
+            pass
+        meta = typed.meta()
+        self.assertEquals(meta['rpm.name'], 'bash')
+        self.assertEquals(meta['rpm.epoch'], 2)
+
+    def test_type_invalid(self):
+        self.write('not an rpm')
+        self.assertRaises(InvalidFileType, plugin.RpmType(self.filename).verify)
@@ -0,0 +1,57 @@
+import unittest
+import tempfile
+import shutil
+import shelve
+import os
+from cas.segments import SegmentedList
+
+class TestSegmentedList(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.shelf = shelve.open(os.path.join(self.dir, 'shelf'))
+        self.list = SegmentedList(self.shelf, 'test', segment_size=4)
+
+    def tearDown(self):
+        self.shelf.close()
+        shutil.rmtree(self.dir)
+
+    def test_sorted_and_unique(self):
+        items = ['%02d' % i for i in [5, 3, 9, 1, 7, 3, 11, 0, 2, 8]]
+        for item in items:
+            self.list.add(item)
+        self.assertEquals(list(self.list), sorted(set(items)))
+        self.assertEquals(len(self.list), len(set(items)))
+        self.assertTrue(len(self.shelf['test']['ids']) > 1)
+
+    def test_segments_bounded(self):
+        for i in xrange(50):
+            self.list.add('%03d' % i)
+        for id in self.shelf['test']['ids']:
+            self.assertTrue(len(self.shelf['test\x00#%d' % id]) <= 4)
+
+    def test_contains(self):
+        self.list.add('foo')
+        self.assertTrue('foo' in self.list)
+        self.assertFalse('bar' in self.list)
+        self.assertFalse('bar' in SegmentedList(self.shelf, 'other'))
+
+    def test_remove(self):
+        for i in xrange(20):
+            self.list.add('%02d' % i)
+        for i in xrange(0, 20, 2):
+            self.assertTrue(self.list.remove('%02d' % i))
+        self.assertFalse(self.list.remove('00'))
+        self.assertEquals(list(self.list), ['%02d' % i for i in xrange(1, 20, 2)])
+
+        for i in xrange(1, 20, 2):
+            self.list.remove('%02d' % i)
+        self.assertFalse(self.list)
+        self.assertEquals(self.shelf.keys(), [])
+
+    def test_range(self):
+        for i in xrange(20):
+            self.list.add('%02d' % i)
+        self.assertEquals(list(self.list.range('05', '09')),
+          ['05', '06', '07', '08'])
+        self.assertEquals(list(self.list.range('17')), ['17', '18', '19'])
+        self.assertEquals(list(self.list.range(stop='02')), ['00', '01'])
@@ -1,16 +1,30 @@
 import unittest
 import tempfile
-from cas import CAS, CASLocked
-from cas.storage import SumIndex
+from cas import CAS, CASLocked, CASReadOnly, AmbiguousSum
+from cas.storage import SumIndex, MetaIndex, ReverseMetaIndex
+from cas.index import get_backend, DBM_SUFFIXES
+from cas.bloom import BloomFilter
+from cas.metrics import REGISTRY
+from cas.util import get_umask
+from cas.files import NullType, InvalidFileType
 import shutil
 import os
 import json
+import shelve
+import sqlite3
+import hashlib
+import subprocess
+from StringIO import StringIO
+import sys
+import time
 from mock import patch
 
 class TestStorage(unittest.TestCase):
+    index = 'shelve'
+
     def setUp(self):
         self.storage_dir = tempfile.mkdtemp()
-        self.storage = CAS(self.storage_dir)
+        self.storage = CAS(self.storage_dir, index=self.index)
         fdno, self.testfile = tempfile.mkstemp()
         self.checksum = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
 
@@ -30,6 +44,215 @@ class TestStorage(unittest.TestCase):
         self.storage.lock()
         self.test_locked()
 
+    def test_add_stream(self):
+        sum = self.storage.add_stream(open(self.testfile, 'rb'))
+        self.assertEquals(sum, self.checksum)
+        self.assertEquals(os.stat(self.storage.path(sum)).st_mode & 0777,
+          0666 & ~get_umask())
+        self.assertTrue(self.storage.has_sum(sum))
+        self.assertEquals(self.storage.equals('type', 'none'), [sum])
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+        # already stored
+        self.assertEquals(self.storage.add_bytes(''), sum)
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    def test_add_bytes(self):
+        sum = self.storage.add_bytes('foo')
+        self.assertEquals(sum, '0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33')
+        self.assertEquals(open(self.storage.path(sum)).read(), 'foo')
+
+    def test_add_stream_invalid_type(self):
+        class NeverType(NullType):
+            type = 'never'
+            def verify(self):
+                raise InvalidFileType(self.filename, self.type)
+
+        self.assertRaises(InvalidFileType, self.storage.add_bytes, 'foo', type=NeverType)
+        self.assertFalse(self.storage.has_sum('0beec7b5ea3f0fdbc95d0dd47f3c5bc275da8a33'))
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    def test_packed(self):
+        self.storage.pack_threshold = 16
+        small = self.storage.add_bytes('foo')
+        big = self.storage.add_bytes('x' * 16)
+
+        self.assertFalse(os.path.exists(self.storage.path(small)))
+        self.assertTrue(os.path.isfile(self.storage.path(big)))
+        for sum, data in [(small, 'foo'), (big, 'x' * 16)]:
+            self.assertTrue(self.storage.has_sum(sum))
+            self.assertEquals(self.storage.read(sum), data)
+        self.assertEquals(sorted(self.storage.list()), sorted([small, big]))
+
+        self.storage.unlock()
+        reader = CAS(self.storage_dir, readonly=True)
+        self.assertEquals(reader.read(small), 'foo')
+
+    def test_remove_packed(self):
+        self.storage.pack_threshold = 16
+        sums = [self.storage.add_bytes(data) for data in ['foo', 'bar', 'baz']]
+        pack = self.storage._packs.filename(0)
+        size = os.path.getsize(pack)
+
+        self.storage.remove(sums[1])
+        self.assertFalse(self.storage.has_sum(sums[1]))
+        self.assertRaises(OSError, self.storage.read, sums[1])
+        self.assertEquals(os.path.getsize(pack), size)
+
+        self.assertEquals(self.storage.repack(), [0])
+        self.assertFalse(os.path.exists(pack))
+        self.assertEquals(self.storage.read(sums[0]), 'foo')
+        self.assertEquals(self.storage.read(sums[2]), 'baz')
+
+        self.storage.unlock()
+        storage = CAS(self.storage_dir)
+        self.assertEquals(storage.read(sums[2]), 'baz')
+        self.assertEquals(storage.repack(), [])
+
+    def test_unpacked_add_reconciled(self):
+        self.storage.pack_threshold = 16
+        with patch('cas.pack.PackStore.append', side_effect=OSError):
+            self.assertRaises(OSError, self.storage.add_bytes, 'foo')
+        self.storage.unlock()
+        storage = CAS(self.storage_dir)
+        self.assertEquals(list(storage.list()), [])
+
+    def test_chunked(self):
+        self.storage.chunk_threshold = 64
+        content = ''.join(str(i) for i in range(20000))
+        sum = self.storage.add_bytes(content)
+        self.assertTrue(self.storage.has_sum(sum))
+        self.assertFalse(os.path.exists(self.storage.path(sum)))
+        self.assertEquals(self.storage.read(sum), content)
+
+        other = self.storage.add_bytes(content + 'more')
+        self.storage.remove(sum)
+        self.assertFalse(self.storage.has_sum(sum))
+        self.storage.repack()
+        self.assertEquals(self.storage.read(other), content + 'more')
+
+    @patch('cas.chunks.ChunkStore.store')
+    def test_chunked_in_workers(self, store):
+        self.storage.chunk_threshold = 64
+        content = ''.join(str(i) for i in range(20000))
+        open(self.testfile, 'w').write(content)
+        for pool in ['thread', 'process']:
+            sum = list(self.storage.add_many([self.testfile], workers=2, pool=pool))[0]
+            self.assertEquals(self.storage.read(sum), content)
+            self.storage.remove(sum)
+        self.assertFalse(store.called)
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    def test_has_sum_uncompressed_stats(self):
+        sum = '0' * 40
+        self.assertEquals(self.storage.compression, 'none')
+        with patch('os.path.isfile', return_value=False) as isfile:
+            self.assertFalse(self.storage.has_sum(sum))
+        self.assertEquals([args[0] for args, _ in isfile.call_args_list],
+          [self.storage.path(sum), self.storage._chunks.manifest_path(sum)])
+
+    def test_compressed(self):
+        self.storage.compression = 'zlib'
+        self.storage.compression_threshold = 16
+        content = 'compressible ' * 100
+        sum = self.storage.add_bytes(content)
+        self.assertFalse(os.path.exists(self.storage.path(sum)))
+        self.assertTrue(os.path.isfile(self.storage.path(sum) + '.zlib'))
+        self.assertTrue(self.storage.has_sum(sum))
+        self.assertEquals(self.storage.read(sum), content)
+
+        # not worth compressing, or too small to bother
+        for data in [os.urandom(1024), 'tiny']:
+            other = self.storage.add_bytes(data)
+            self.assertTrue(os.path.isfile(self.storage.path(other)))
+            self.assertEquals(self.storage.read(other), data)
+
+        self.storage.unlock()
+        storage = CAS(self.storage_dir)
+        self.assertEquals(storage.meta()['compression'], {'codec': 'zlib', 'threshold': 16})
+        self.assertEquals(storage.read(sum), content)
+        storage.remove(sum)
+        self.assertFalse(storage.has_sum(sum))
+        self.assertFalse(os.path.exists(storage.path(sum) + '.zlib'))
+
+    def test_read_ranges(self):
+        content = ''.join(str(i) for i in range(5000))
+        stored = {}
+        for name, attr, value in [('loose', None, None), ('packed', 'pack_threshold', 2**20),
+                                  ('chunked', 'chunk_threshold', 1024),
+                                  ('compressed', 'compression', 'zlib')]:
+            if attr:
+                setattr(self.storage, attr, value)
+            data = name + content
+            stored[name] = (self.storage.add_bytes(data), data)
+            if attr:
+                setattr(self.storage, attr, attr == 'compression' and 'none' or 0)
+        self.storage.compression = 'zlib'
+
+        for name, (sum, data) in stored.items():
+            self.assertEquals(self.storage.read(sum), data, name)
+            self.assertEquals(self.storage.read(sum, 100, 50), data[100:150], name)
+            self.assertEquals(self.storage.read(sum, len(data) - 3), data[-3:], name)
+            self.assertEquals(''.join(self.storage.stream(sum, 10, block_size=7)),
+              data[10:], name)
+
+            with self.storage.open(sum) as fd:
+                self.assertEquals(fd.read(5), data[:5], name)
+                fd.seek(1000)
+                self.assertEquals(fd.read(5), data[1000:1005], name)
+
+            out = tempfile.TemporaryFile()
+            self.assertEquals(self.storage.send(sum, out, 5, 10), 10)
+            out.seek(0)
+            self.assertEquals(out.read(), data[5:15], name)
+
+            out = StringIO()
+            self.storage.send(sum, out, 5)
+            self.assertEquals(out.getvalue(), data[5:], name)
+
+        self.assertRaises(OSError, self.storage.open, '0' * 40)
+
+    def test_readers_share_lock(self):
+        sum = self.storage.add(self.testfile)
+        self.storage.unlock()
+
+        readers = [CAS(self.storage_dir, readonly=True) for i in range(2)]
+        for reader in readers:
+            self.assertEquals(list(reader.list()), [sum])
+            self.assertTrue(reader.has_sum(sum))
+
+        if get_backend(self.index).concurrent_readers:
+            CAS(self.storage_dir).unlock()
+        else:
+            self.assertRaises(CASLocked, CAS, self.storage_dir)
+
+    def test_reader_blocked_by_writer(self):
+        if get_backend(self.index).concurrent_readers:
+            CAS(self.storage_dir, readonly=True)
+        else:
+            self.assertRaises(CASLocked, CAS, self.storage_dir, readonly=True)
+
+    def test_readonly(self):
+        sum = self.storage.add(self.testfile)
+        self.storage.unlock()
+
+        reader = CAS(self.storage_dir, readonly=True)
+        updated = open(self.storage.metafile).read()
+        self.assertRaises(CASReadOnly, reader.remove, sum)
+        self.assertRaises(CASReadOnly, reader.gc)
+        self.assertRaises(CASReadOnly, reader.add, self.testfile)
+        reader.unlock()
+        self.assertEquals(open(self.storage.metafile).read(), updated)
+
+    def test_lock_released_when_holder_dies(self):
+        self.storage.unlock()
+        script = 'import os; from cas.lock import FileLock; ' \
+          'FileLock(%r).acquire(); os._exit(1)' % self.storage.lockfile
+        root = os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
+        subprocess.call([sys.executable, '-c', script], cwd=root)
+        self.storage.lock()
+        self.assertTrue(self.storage.locked)
+
     def test_meta_loaded(self, storage=None):
         sto = storage or self.storage
         for meta in ['uuid', 'created', 'updated']:
@@ -69,6 +292,127 @@ class TestStorage(unittest.TestCase):
 
         self.assertEquals(mtime, os.stat(path).st_mtime)
 
+    def test_add_many(self):
+        files = []
+        for content in ['foo', 'bar', 'foo']:
+            fdno, filename = tempfile.mkstemp()
+            os.write(fdno, content)
+            os.close(fdno)
+            files.append(filename)
+
+        try:
+            sums = list(self.storage.add_many(files, batch_size=2))
+        finally:
+            map(os.remove, files)
+
+        self.assertEquals(len(sums), 3)
+        self.assertEquals(sums[0], sums[2])
+        for sum in sums:
+            self.assertTrue(self.storage.has_sum(sum))
+            self.assertTrue(self.storage._sum_index.has_key(sum))
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    def test_add_many_parallel(self):
+        files = []
+        for i in xrange(10):
+            fdno, filename = tempfile.mkstemp()
+            os.write(fdno, str(i))
+            os.close(fdno)
+            files.append(filename)
+
+        try:
+            for pool in ['thread', 'process']:
+                sums = list(self.storage.add_many(files, workers=3, pool=pool))
+                self.assertEquals(sums, map(self.storage.checksum, files))
+        finally:
+            map(os.remove, files)
+
+        for sum in sums:
+            self.assertTrue(self.storage.has_sum(sum))
+            self.assertEquals(self.storage._meta_index.equals('type', 'none').count(sum), 1)
+
+    def test_add_many_skips_stored(self):
+        content = ''.join(str(i) for i in range(5000))
+        for name, attr, value in [('loose', None, None), ('packed', 'pack_threshold', 2**20),
+                                  ('chunked', 'chunk_threshold', 1024),
+                                  ('compressed', 'compression', 'zlib')]:
+            if attr:
+                setattr(self.storage, attr, value)
+            sum = self.storage.add_bytes(name + content)
+            if attr:
+                setattr(self.storage, attr, attr == 'compression' and 'none' or 0)
+            self.storage.compression = 'zlib'
+
+            open(self.testfile, 'w').write(name + content)
+            with patch('cas.files.NullType.verify') as verify:
+                self.assertEquals(list(self.storage.add_many([self.testfile])), [sum])
+            self.assertFalse(verify.called, name)
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    @patch('cas.storage.CAS._commit')
+    def test_add_many_batches_commits(self, commit):
+        list(self.storage.add_many([self.testfile] * 5, batch_size=2))
+        self.assertEquals(commit.call_count, 3)
+
+    def test_add_modes(self):
+        open(self.testfile, 'w').write('foo')
+        for mode in ['copy', 'hardlink', 'reflink', 'kernel']:
+            sum = list(self.storage.add_many([self.testfile], mode=mode))[0]
+            self.assertEquals(open(self.storage.path(sum)).read(), 'foo')
+            if mode == 'hardlink':
+                self.assertEquals(os.stat(self.storage.path(sum)).st_ino,
+                  os.stat(self.testfile).st_ino)
+                self.assertFalse(os.stat(self.testfile).st_mode & 0222)
+            self.storage.remove(sum)
+        self.assertEquals(open(self.testfile).read(), 'foo')
+
+    def test_add_hardlink_not_stored(self):
+        # files that end up deduplicated or packed aren't linked into storage
+        self.storage.add_bytes('foo')
+        self.storage.pack_threshold = 16
+        for content in ['foo', 'bar']:
+            open(self.testfile, 'w').write(content)
+            os.chmod(self.testfile, 0644)
+            sum = list(self.storage.add_many([self.testfile], mode='hardlink'))[0]
+            self.assertEquals(self.storage.read(sum), content)
+            self.assertEquals(os.stat(self.testfile).st_mode & 0777, 0644)
+            self.assertEquals(os.stat(self.testfile).st_nlink, 1)
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError,
+          lambda: CAS(os.path.join(self.storage_dir, 'other'), mode='foo'))
+
+    @patch('cas.storage.checksum')
+    @patch('cas.ingest.ingest_file')
+    def test_checksum_cache(self, ingest_file, checksum):
+        checksum.return_value = self.checksum
+        # files modified just now aren't cached
+        os.utime(self.testfile, (time.time() - 10, time.time() - 10))
+        self.storage.unlock()
+        storage = CAS(self.storage_dir, checksum_cache=10)
+
+        self.assertEquals(storage.checksum(self.testfile), self.checksum)
+        self.assertEquals(storage.checksum(self.testfile), self.checksum)
+        self.assertEquals(checksum.call_count, 1)
+
+        # once stored, re-adding an unchanged file doesn't read it
+        ingest_file.return_value = self.checksum
+        storage.add(self.testfile)
+        storage.add(self.testfile)
+        self.assertEquals(ingest_file.call_count, 1)
+        self.assertTrue(storage.has_file(self.testfile))
+        self.assertEquals(checksum.call_count, 1)
+
+    def test_add_dedup_cleans_tmp(self):
+        self.storage.add(self.testfile)
+        self.storage.add(self.testfile)
+        self.assertEquals(os.listdir(self.storage.tmpdir), [])
+
+    def test_query(self):
+        sum = self.storage.add(self.testfile)
+        self.assertEquals(list(self.storage.query('type=none')), [sum])
+        self.assertEquals(list(self.storage.query('not type=none')), [])
+
     def test_remove_miss(self):
         previous_updated = self.storage.updated
         self.assertRaises(OSError, lambda: self.storage.remove(self.testfile))
@@ -85,17 +429,341 @@ class TestStorage(unittest.TestCase):
         self.assertFalse(os.path.isfile(path))
         self.assertFalse(os.path.isdir(os.path.dirname(path)))
 
-    @patch('shutil.move')
-    def test_add_failure(self, move):
-        sum = self.storage.add(self.testfile)
+    @patch('cas.storage.CAS._publish')
+    def test_add_failure(self, publish):
+        publish.side_effect = OSError
+        self.assertRaises(OSError, lambda: self.storage.add(self.testfile))
+        sum = self.checksum
         self.assertFalse(self.storage.has_sum(sum))
         self.storage.unlock()
         cas = CAS(self.storage_dir)
 
         # gc should've cleaned up this failed add
-        self.assertFalse(bool(cas._sum_index.get(sum)))
+        self.assertFalse(sum in cas._sum_index)
         self.assertFalse(bool(cas._meta_index.has_sum(sum)))
 
+    def test_gc_only_reconciles_journal(self):
+        sum = self.storage.add(self.testfile)
+        os.remove(self.storage.path(sum))
+
+        self.storage.gc()
+        self.assertTrue(self.storage._sum_index.has_key(sum))
+
+        self.storage.gc(full=True)
+        self.assertFalse(self.storage._sum_index.has_key(sum))
+        self.assertFalse(self.storage._meta_index.has_sum(sum))
+
+    def test_gc_finishes_interrupted_remove(self):
+        sum = self.storage.add(self.testfile)
+        self.storage._journal.record('rm', sum)
+
+        self.storage.gc()
+        self.assertFalse(self.storage.has_sum(sum))
+        self.assertFalse(self.storage._sum_index.has_key(sum))
+        self.assertEquals(self.storage._journal.entries(), [])
+
+    def test_gc_resume(self):
+        for sum in ['a', 'b', 'c', 'd']:
+            self.storage._sum_index.add(sum)
+        open(self.storage.gc_checkpointfile, 'w').write('b')
+
+        self.storage.gc(full=True, batch_size=1)
+        self.assertEquals(sorted(self.storage._sum_index.keys()), ['a', 'b'])
+        self.assertFalse(os.path.isfile(self.storage.gc_checkpointfile))
+
+    def _problems(self, **kwargs):
+        return sorted((p.kind, p.sum) for p in self.storage.verify(**kwargs))
+
+    def test_verify(self):
+        self.storage.add(self.testfile)
+        self.storage.pack_threshold = 16
+        self.storage.add_bytes('packed')
+        self.storage.pack_threshold = 0
+        self.storage.chunk_threshold = 1024
+        self.storage.add_bytes('chunked' * 1000)
+        self.storage.chunk_threshold = 0
+        self.storage.compression = 'zlib'
+        self.storage.add_bytes('compressed' * 1000)
+
+        self.assertEquals(self._problems(workers=2), [])
+        self.assertFalse(os.path.isfile(self.storage.verify_checkpointfile))
+
+    def test_verify_problems(self):
+        corrupt = self.storage.add_bytes('corrupt')
+        with open(self.storage.path(corrupt), 'w') as fd:
+            fd.write('rot')
+        missing = self.storage.add_bytes('missing')
+        os.remove(self.storage.path(missing))
+        unindexed = self.storage.add_bytes('unindexed')
+        self.storage._meta_index.remove_all(unindexed)
+        orphaned = self.storage.add_bytes('orphaned')
+        self.storage._sum_index.remove(orphaned)
+        self.storage.pack_threshold = 16
+        packed = self.storage.add_bytes('packed orphan')
+        self.storage._sum_index.remove(packed)
+
+        self.assertEquals(self._problems(batch_size=2), sorted([
+          ('corrupt', corrupt), ('missing', missing), ('unindexed', unindexed),
+          ('orphaned', orphaned), ('orphaned', packed)]))
+
+        self.assertEquals(self._problems(quarantine=True), sorted([
+          ('corrupt', corrupt), ('missing', missing), ('unindexed', unindexed),
+          ('orphaned', orphaned), ('orphaned', packed)]))
+        self.assertEquals(sorted(os.listdir(self.storage.quarantinedir)),
+          sorted([corrupt, orphaned, packed]))
+        self.assertEquals(open(os.path.join(self.storage.quarantinedir, packed)).read(),
+          'packed orphan')
+        for sum in [corrupt, missing, orphaned, packed]:
+            self.assertFalse(self.storage.has_sum(sum))
+            self.assertFalse(self.storage._sum_index.has_key(sum))
+        self.assertEquals(self._problems(), [('unindexed', unindexed)])
+
+    def test_verify_quarantines_with_bloom_filter(self):
+        orphaned = self.storage.add_bytes('orphaned')
+        self.storage._sum_index.remove(orphaned)
+        self.storage.unlock()
+
+        storage = CAS(self.storage_dir, bloom_filter=True)
+        self.assertFalse(storage.has_sum(orphaned))
+        self.assertEquals([(p.kind, p.sum) for p in storage.verify(quarantine=True)],
+          [('orphaned', orphaned)])
+        self.assertEquals(os.listdir(storage.quarantinedir), [orphaned])
+        self.assertFalse(os.path.isfile(storage.path(orphaned)))
+        storage.unlock()
+
+    def test_verify_resume(self):
+        sums = sorted(self.storage.add_bytes(data) for data in 'abcd')
+        for sum in sums:
+            os.remove(self.storage.path(sum))
+        open(self.storage.verify_checkpointfile, 'w').write(sums[1])
+
+        self.assertEquals(self._problems(batch_size=1),
+          [('missing', sum) for sum in sums[2:]])
+        self.assertFalse(os.path.isfile(self.storage.verify_checkpointfile))
+        self.assertEquals(len(self._problems(resume=False)), 4)
+
+    def test_verify_readonly(self):
+        sum = self.storage.add_bytes('foo')
+        self.storage.unlock()
+        reader = CAS(self.storage_dir, readonly=True)
+        self.assertEquals(list(reader.verify()), [])
+        self.assertRaises(CASReadOnly, list, reader.verify(quarantine=True))
+        reader.unlock()
+
+    def test_bloom_filter(self):
+        sum = self.storage.add(self.testfile)
+        self.storage.unlock()
+
+        storage = CAS(self.storage_dir, bloom_filter=True)
+        self.assertTrue(storage.has_sum(sum))
+        with patch('os.path.isfile') as isfile:
+            self.assertFalse(storage.has_sum('0' * 40))
+            self.assertFalse(isfile.called)
+
+        added = storage.add_bytes('foo')
+        self.assertFalse(os.path.isfile(storage.bloomfile))
+        storage.unlock()
+        self.assertTrue(os.path.isfile(storage.bloomfile))
+
+        reader = CAS(self.storage_dir, bloom_filter=True, readonly=True)
+        self.assertTrue(reader.has_sum(added))
+        self.assertEquals(reader._bloom is not None, self.index == 'shelve')
+        reader.unlock()
+
+        # writers without the filter don't keep it up to date
+        storage = CAS(self.storage_dir)
+        self.assertFalse(os.path.isfile(storage.bloomfile))
+        added = storage.add_bytes('bar')
+        storage.unlock()
+        storage = CAS(self.storage_dir, bloom_filter=True)
+        self.assertTrue(storage.has_sum(added))
+
+    def test_bloom_filter_grows(self):
+        self.storage.unlock()
+        storage = CAS(self.storage_dir, bloom_filter=True)
+        storage._bloom = BloomFilter(4)
+        added = [storage.add_bytes(str(i)) for i in range(5)]
+        self.assertTrue(storage._bloom.capacity > 4)
+        self.assertTrue(all(storage.has_sum(sum) for sum in added))
+
+    def test_stats(self):
+        REGISTRY.reset()
+        sum = self.storage.add_bytes('foo')
+        self.storage.add_bytes('foo')
+        list(self.storage.add_many([self.testfile]))
+        list(self.storage.equals('type', 'none'))
+        self.storage.remove(sum)
+
+        stats = self.storage.stats()
+        self.assertEquals(stats['cas_objects_added_total']['value'], 2)
+        self.assertEquals(stats['cas_objects_deduped_total']['value'], 1)
+        self.assertEquals(stats['cas_objects_removed_total']['value'], 1)
+        self.assertEquals(stats['cas_bytes_hashed_total']['value'], 6)
+        self.assertEquals(stats['cas_add_seconds']['count'], 2)
+        self.assertEquals(stats['cas_add_batch_seconds']['count'], 1)
+        self.assertEquals(stats['cas_match_seconds']['count'], 1)
+        self.assertTrue(stats['cas_index_sync_seconds']['count'] > 0)
+        self.assertEquals(stats['cas_objects']['value'], 1)
+        self.assertEquals(stats['cas_store_bytes']['value'], 0)
+
+    def test_list(self):
+        sums = sorted(self.storage.add_bytes(str(i)) for i in range(20))
+        self.assertEquals(list(self.storage.list()), sums)
+
+        prefix = sums[5][:1]
+        self.assertEquals(list(self.storage.list(prefix=prefix)),
+          [sum for sum in sums if sum.startswith(prefix)])
+
+        pages, after = [], None
+        while True:
+            page = list(self.storage.list(after=after, limit=7))
+            if not page:
+                break
+            pages.append(page)
+            after = page[-1]
+        self.assertEquals(map(len, pages), [7, 7, 6])
+        self.assertEquals([s for page in pages for s in page], sums)
+
+        self.storage.remove(sums[0])
+        self.assertEquals(list(self.storage.list(limit=1)), sums[1:2])
+
+    def test_resolve(self):
+        sums = [self.storage.add_bytes(str(i)) for i in range(50)]
+        for sum in sums:
+            self.assertEquals(self.storage.resolve(sum), sum)
+            self.assertEquals(self.storage.resolve(sum[:12]), sum)
+
+        self.assertRaises(KeyError, self.storage.resolve, 'z')
+        try:
+            self.storage.resolve(sums[0][:1])
+        except AmbiguousSum, e:
+            self.assertTrue(len(e.candidates) > 1)
+            self.assertTrue(all(c.startswith(sums[0][:1]) for c in e.candidates))
+        else:
+            self.fail('prefix should be ambiguous')
+
+    def test_sorted_sums_rebuilt(self):
+        sums = sorted(self.storage.add_bytes(str(i)) for i in range(5))
+        self.storage._index.reindex()
+        self.assertEquals(list(self.storage.list()), sums)
+
+    def test_hash(self):
+        self.storage.unlock()
+        shutil.rmtree(self.storage_dir)
+        self.storage = CAS(self.storage_dir, index=self.index, hash='sha256')
+        sum = self.storage.add_bytes('foo')
+        self.assertEquals(sum, hashlib.sha256('foo').hexdigest())
+        open(self.testfile, 'w').write('bar')
+        self.assertEquals(self.storage.add(self.testfile), hashlib.sha256('bar').hexdigest())
+        self.assertTrue(self.storage.has_file(self.testfile))
+        self.assertEquals(self.storage.meta()['hash'], 'sha256')
+        self.storage.unlock()
+
+        # the recorded hash wins
+        self.storage = CAS(self.storage_dir, hash='sha1')
+        self.assertEquals(self.storage.hash, 'sha256')
+        self.assertTrue(self.storage.has_sum(sum))
+
+    def test_hash_invalid(self):
+        self.assertRaises(ValueError, CAS, self.storage_dir, hash='md4')
+
+    def test_rehash(self):
+        loose = self.storage.add(self.testfile)
+        self.storage.pack_threshold = 16
+        packed = self.storage.add_bytes('packed')
+        self.storage.pack_threshold = 0
+        self.storage.chunk_threshold = 1024
+        chunked = self.storage.add_bytes('chunked' * 1000)
+        self.storage.chunk_threshold = 0
+        self.storage.compression = 'zlib'
+        compressed = self.storage.add_bytes('compressed' * 1000)
+        self.storage._meta_index.add('name', 'foo', compressed)
+
+        self.storage.rehash('sha256', workers=2, batch_size=2)
+        self.assertEquals(self.storage.hash, 'sha256')
+        self.assertFalse(os.path.isfile(self.storage.rehashfile))
+        expected = dict((old, hashlib.sha256(data).hexdigest()) for old, data in
+          [(loose, ''), (packed, 'packed'), (chunked, 'chunked' * 1000),
+           (compressed, 'compressed' * 1000)])
+        self.assertEquals(sorted(self.storage.list()), sorted(expected.values()))
+        for old, new in expected.items():
+            self.assertFalse(self.storage.has_sum(old))
+            self.assertTrue(self.storage.has_sum(new))
+        self.assertEquals(self.storage.read(expected[packed]), 'packed')
+        self.assertEquals(self.storage.read(expected[chunked]), 'chunked' * 1000)
+        self.assertEquals(list(self.storage.equals('name', 'foo')), [expected[compressed]])
+        self.assertEquals(list(self.storage.verify()), [])
+        self.assertEquals(self.storage.repack(), [])
+        pack = self.storage._packs.filename(self.storage._packs.packs()[0])
+        self.assertEquals(open(pack).readline(), '%s 6\n' % expected[packed])
+
+        self.storage.unlock()
+        storage = CAS(self.storage_dir)
+        self.assertEquals(storage.hash, 'sha256')
+        self.assertEquals(storage.add_bytes('packed'), expected[packed])
+
+    def test_rehash_interrupted(self):
+        sums = [self.storage.add_bytes(str(i)) for i in range(5)]
+        self.storage._plan_rehash('sha512', 1, 2)
+        os.rename(self.storage.rehashfile + '.plan', self.storage.rehashfile)
+        self.storage._rename(sums[0], hashlib.sha512('0').hexdigest())
+        self.storage.unlock()
+
+        storage = CAS(self.storage_dir)
+        self.assertEquals(storage.hash, 'sha512')
+        self.assertEquals(sorted(storage.list()),
+          sorted(hashlib.sha512(str(i)).hexdigest() for i in range(5)))
+
+    def test_rehash_resumes_plan(self):
+        sums = sorted(self.storage.add_bytes(str(i)) for i in range(5))
+        planfile = self.storage.rehashfile + '.plan'
+        open(planfile, 'w').write('sha256\n%s bogus\n%s tor' % (sums[0], sums[1]))
+
+        self.storage._plan_rehash('sha256', 1, 2)
+        lines = open(planfile).read().splitlines()
+        self.assertEquals(lines[:2], ['sha256', '%s bogus' % sums[0]])
+        self.assertEquals([line.split()[0] for line in lines[1:]], sums)
+
+    def test_rehash_corrupt(self):
+        sum = self.storage.add_bytes('foo')
+        open(self.storage.path(sum), 'w').write('bar')
+        self.assertRaises(ValueError, self.storage.rehash, 'sha256')
+        self.assertEquals(self.storage.hash, 'sha1')
+        self.assertEquals(list(self.storage.list()), [sum])
+
+    def test_check(self):
+        self.assertTrue(CAS.check(self.storage_dir))
+
+    def test_migrate_index(self):
+        sum = self.storage.add(self.testfile)
+        self.storage.pack_threshold = 16
+        packed = self.storage.add_bytes('foo')
+        other = self.index == 'shelve' and 'sqlite' or 'shelve'
+
+        self.storage.migrate_index(other)
+        self.assertEquals(self.storage.index_backend, other)
+        self.assertEquals(sorted(self.storage._meta_index.equals('type', 'none')),
+          sorted([sum, packed]))
+        self.assertFalse(get_backend(self.index).exists(self.storage_dir))
+
+        self.storage.unlock()
+        storage = CAS(self.storage_dir)
+        self.assertEquals(storage.index_backend, other)
+        self.assertEquals(storage.read(packed), 'foo')
+        self.assertEquals(sorted(storage.list()), sorted([sum, packed]))
+        self.assertTrue(storage._meta_index.has_sum(sum))
+
+class TestSqliteStorage(TestStorage):
+    index = 'sqlite'
+
+    def test_readonly_index(self):
+        self.storage.add(self.testfile)
+        self.storage.unlock()
+        reader = CAS(self.storage_dir, readonly=True)
+        self.assertTrue(self.checksum in reader._sum_index)
+        self.assertRaises(sqlite3.OperationalError, reader._sum_index.add, 'foo')
+        reader.unlock()
+
 class TestSumIndex(unittest.TestCase):
     def setUp(self):
         fdno, self.filename = tempfile.mkstemp()
@@ -105,10 +773,104 @@ class TestSumIndex(unittest.TestCase):
         self.index = SumIndex(self.filename)
 
     def tearDown(self):
-        os.remove(self.filename)
+        # the dbm module in use decides which files there are
+        for suffix in DBM_SUFFIXES:
+            if os.path.isfile(self.filename + suffix):
+                os.remove(self.filename + suffix)
+
+    def test_sorted(self):
+        for sum in ['d', 'b', 'a', 'c']:
+            self.index.add(sum)
+        self.index.remove('c')
+        self.assertEquals(list(self.index.sorted()), ['a', 'b', 'd'])
+        self.assertEquals(list(self.index.sorted('b')), ['b', 'd'])
+        self.assertEquals(list(self.index.sorted('a', 'd')), ['a', 'b'])
 
     def test_unicode_sum(self):
         self.index.add(u'foo')
         self.assertTrue(self.index.has_key('foo'))
         self.index.remove(u'foo')
         self.assertFalse(self.index.has_key('foo'))
+
+class TestMetaIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.reverse = ReverseMetaIndex(os.path.join(self.dir, 'reverse'))
+        self.index = MetaIndex(os.path.join(self.dir, 'forward'), self.reverse)
+
+    def tearDown(self):
+        self.index.close()
+        self.reverse.close()
+        shutil.rmtree(self.dir)
+
+    def test_reverse_tracks_forward(self):
+        self.index.add('type', 'rpm', 'foo')
+        self.index.add('rpm.arch', 'x86_64', 'foo')
+        self.assertEquals(sorted(self.reverse.find('foo')),
+          [('rpm.arch', 'x86_64'), ('type', 'rpm')])
+        self.assertTrue(self.index.has_sum('foo'))
+
+        self.index.remove_all('foo')
+        self.assertEquals(self.reverse.find('foo'), [])
+        self.assertFalse(self.index.has_sum('foo'))
+        self.assertEquals(self.index.equals('type', 'rpm'), [])
+
+    def test_rebuild_reverse(self):
+        self.index.add('type', 'rpm', 'foo')
+        self.index.add('type', 'rpm', 'bar')
+        self.reverse.clear()
+        self.assertFalse(self.index.has_sum('foo'))
+
+        self.index.rebuild_reverse()
+        self.assertTrue(self.index.has_sum('foo'))
+        self.assertTrue(self.index.has_sum('bar'))
+
+    def test_match(self):
+        for i, name in enumerate(['kernel', 'kernel-devel', 'bash', 'kernfs']):
+            self.index.add('rpm.name', name, 'sum%d' % i)
+
+        self.assertEquals(self.index.match('rpm.name', '^kernel'), ['sum0', 'sum1'])
+        self.assertEquals(self.index.match('rpm.name', 'vel$'), ['sum1'])
+        self.assertEquals(self.index.match('rpm.name', prefix='kern'),
+          ['sum0', 'sum1', 'sum3'])
+        self.assertEquals(self.index.match('rpm.name', 'fs', prefix='kern'), ['sum3'])
+        self.assertEquals(self.index.match('rpm.name', '^bash', prefix='kern'), [])
+        self.assertEquals(self.index.match('rpm.name', start='c', stop='kernel-'),
+          ['sum0'])
+
+    def test_values(self):
+        for name in ['kernel', 'bash', 'kernfs']:
+            self.index.add('rpm.name', name, 'foo')
+        self.assertEquals(list(self.index.values('rpm.name')), ['bash', 'kernel', 'kernfs'])
+        self.assertEquals(list(self.index.values('rpm.name', prefix='kerne')), ['kernel'])
+        self.assertEquals(list(self.index.values('rpm.name', start='c')), ['kernel', 'kernfs'])
+
+    def test_upgrade_legacy_layout(self):
+        self.index.close()
+        filename = os.path.join(self.dir, 'legacy')
+        legacy = shelve.open(filename)
+        legacy['type'] = {'rpm': {'foo': None, 'bar': None}}
+        legacy.close()
+
+        index = MetaIndex(filename, self.reverse)
+        self.assertEquals(index.equals('type', 'rpm'), ['bar', 'foo'])
+        self.assertTrue(index.has_sum('foo'))
+        self.assertEquals(index.keyspace(), {'type': ['rpm']})
+        self.index = index
+
+    def test_upgrade_legacy_format_key(self):
+        # a legacy store with a meta key that looks like a format marker
+        self.index.close()
+        filename = os.path.join(self.dir, 'legacy')
+        legacy = shelve.open(filename)
+        legacy['format'] = {'tar': {'foo': None}}
+        legacy.close()
+
+        index = MetaIndex(filename, self.reverse)
+        self.assertEquals(index.equals('format', 'tar'), ['foo'])
+        self.index = index
+
+    def test_non_string_values(self):
+        self.index.add('rpm.epoch', 0, 'foo')
+        self.assertEquals(self.index.equals('rpm.epoch', 0), ['foo'])
+        self.assertEquals(self.index.equals('rpm.epoch', '0'), ['foo'])
@@ -1,7 +1,11 @@
 import unittest
 import os
 import hashlib
+import tempfile
+import re
+from StringIO import StringIO
 from cas.util import *
+from mock import patch
 
 SHARD_TESTS = [
   ('foobar', 2, 2, ['fo', 'ob', 'ar']),
@@ -26,8 +30,93 @@ class UtilTest(unittest.TestCase):
         self.assertEquals(hashlib.sha1(open('/etc/hosts').read()).hexdigest(), 
           checksum('/etc/hosts'))
 
+    def test_copy_checksum(self):
+        fdno, dst = tempfile.mkstemp()
+        os.close(fdno)
+        try:
+            sum = copy_checksum('/etc/hosts', dst, block_size=16)
+            self.assertEquals(sum, checksum('/etc/hosts'))
+            self.assertEquals(open(dst).read(), open('/etc/hosts').read())
+            self.assertEquals(int(os.stat(dst).st_mtime), int(os.stat('/etc/hosts').st_mtime))
+        finally:
+            os.remove(dst)
+
+    def test_kernel_copy(self):
+        fdno, dst = tempfile.mkstemp()
+        os.close(fdno)
+        try:
+            kernel_copy('/etc/hosts', dst)
+            self.assertEquals(open(dst).read(), open('/etc/hosts').read())
+        finally:
+            os.remove(dst)
+
+    def test_prefix_end(self):
+        self.assertEquals(prefix_end('foo'), 'fop')
+        self.assertEquals(prefix_end('fo\xff'), 'fp')
+        self.assertEquals(prefix_end('\xff'), None)
+
+    def test_literal_prefix(self):
+        for regex, prefix in [('^kernel', 'kernel'), ('^kern.*l', 'kern'),
+                              ('^ab*', 'a'), ('kernel', ''), ('^foo|bar', ''),
+                              ('(?i)^foo', ''), ('\\Afoo', 'foo')]:
+            self.assertEquals(literal_prefix(re.compile(regex)), prefix)
+
     def test_mkdir_p_failure(self):
         self.assertRaises(OSError, lambda: mkdir_p('/etc/hosts'))
 
     def test_uuid(self):
         self.assertTrue(isinstance(get_uuid(), str))
+
+    def test_iter_delimited(self):
+        stream = StringIO('foo\0bar baz\0\0qux')
+        self.assertEquals(list(iter_delimited(stream, '\0', block_size=3)),
+          ['foo', 'bar baz', 'qux'])
+        stream = StringIO('foo\nbar\n')
+        self.assertEquals(list(iter_delimited(stream)), ['foo', 'bar'])
+
+    def test_range_reader(self):
+        fd = tempfile.TemporaryFile()
+        fd.write('0123456789')
+        reader = RangeReader(fd, 2, 5)
+        self.assertEquals(reader.read(2), '23')
+        self.assertEquals(reader.read(), '456')
+        self.assertEquals(reader.read(), '')
+        reader.seek(-2, os.SEEK_END)
+        self.assertEquals(reader.tell(), 3)
+        self.assertEquals(reader.read(10), '56')
+        reader.close()
+
+    def test_send_range(self):
+        src, dst = tempfile.TemporaryFile(), tempfile.TemporaryFile()
+        src.write('0123456789')
+        src.flush()
+        self.assertEquals(send_range(src.fileno(), dst.fileno(), 3, 4), 4)
+        dst.seek(0)
+        self.assertEquals(dst.read(), '3456')
+
+    @patch('time.sleep')
+    def test_rate_limiter(self, sleep):
+        limiter = RateLimiter(100)
+        limiter.consume(100)
+        self.assertFalse(sleep.called)
+        limiter.consume(50)
+        self.assertAlmostEqual(sleep.call_args[0][0], 0.5, places=1)
+
+    def test_read_checksum(self):
+        limiter = RateLimiter(2**30)
+        self.assertEquals(read_checksum(StringIO(''), limiter=limiter),
+          'da39a3ee5e6b4b0d3255bfef95601890afd80709')
+
+    def test_read_blocks(self):
+        data = ''.join(chr(i % 256) for i in range(1000))
+        fd = tempfile.TemporaryFile()
+        fd.write(data)
+        fd.seek(0)
+        blocks = [block.tobytes() for block in read_blocks(fd, 300)]
+        self.assertEquals(map(len, blocks), [300, 300, 300, 100])
+        self.assertEquals(''.join(blocks), data)
+        self.assertEquals(list(read_blocks(StringIO(data), 600)), [data[:600], data[600:]])
+
+    def test_read_checksums(self):
+        self.assertEquals(read_checksums(StringIO('foo'), [hashlib.sha1, hashlib.sha256]),
+          [hashlib.sha1('foo').hexdigest(), hashlib.sha256('foo').hexdigest()])
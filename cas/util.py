@@ -1,17 +1,35 @@
 import cas.log
+import cas.metrics
 import uuid
 import os
 import errno
 import hashlib
 from functools import wraps
 import time
+import threading
 import logging
 import imp
 import glob
+import re
+import sre_parse
+import sre_constants
+import shutil
+import fcntl
+import ctypes
+import ctypes.util
 
 LOG = logging.getLogger(__name__)
 
-def timeit(hint):
+BYTES_HASHED = cas.metrics.counter('cas_bytes_hashed_total', 'Bytes read to checksum them')
+BYTES_COPIED = cas.metrics.counter('cas_bytes_copied_total',
+  'Bytes copied into the temporary directory while checksumming them')
+cas.metrics.histogram('cas_checksum_seconds', 'Seconds taken to checksum a file or stream')
+
+def timeit(hint, metric=None):
+    """
+    Log how long each call takes, and record it in the histogram ``metric``
+    (see ``cas.metrics``)
+    """
     def outer_wrapper(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
@@ -19,6 +37,7 @@ def timeit(hint):
             results = func(*args, **kwargs)
             elapsed = time.time() - now
             LOG.debug('executing func "%s" took %.5f seconds' % (hint, elapsed))
+            cas.metrics.record_call(hint, elapsed, metric)
             return results
         return wrapper
     return outer_wrapper
@@ -39,6 +58,23 @@ def load_plugin_dir(directory):
     for filename in glob.glob('%s/*.py' % directory):
         load_plugin_file(filename)
 
+def iter_delimited(stream, delimiter='\n', block_size=2**16):
+    """
+    Lazily split a stream on ``delimiter``, skipping empty entries
+    """
+    remainder = ''
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            break
+        pieces = (remainder + data).split(delimiter)
+        remainder = pieces.pop()
+        for piece in pieces:
+            if piece:
+                yield piece
+    if remainder:
+        yield remainder
+
 def get_uuid():
     return uuid.uuid4().hex
 
@@ -50,6 +86,47 @@ def shard(string, width, depth, remainder=True):
 
     return [ i for i in pieces if i ]
 
+def to_str(value):
+    """
+    Coerce a meta key or value to the byte string used in the indices
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+def prefix_end(prefix):
+    """
+    The smallest string greater than every string starting with ``prefix``,
+    or ``None`` if there isn't one
+    """
+    prefix = prefix.rstrip('\xff')
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def literal_prefix(regex):
+    """
+    The literal string that every string searched by compiled ``regex``
+    must start with to match, which is only non-empty for anchored regexes
+    """
+    if regex.flags & (re.IGNORECASE | re.MULTILINE):
+        return ''
+
+    tokens = list(sre_parse.parse(regex.pattern, regex.flags))
+    if not tokens or tokens[0][0] != sre_constants.AT or \
+      tokens[0][1] not in (sre_constants.AT_BEGINNING, sre_constants.AT_BEGINNING_STRING):
+        return ''
+
+    prefix = []
+    for op, arg in tokens[1:]:
+        if op != sre_constants.LITERAL:
+            break
+        prefix.append(arg)
+
+    if isinstance(regex.pattern, unicode):
+        return u''.join(map(unichr, prefix))
+    return ''.join(map(chr, prefix))
+
 def mkdir_p(directory):
     try:
         os.makedirs(directory)
@@ -60,13 +137,249 @@ def mkdir_p(directory):
 def fullpath(filename):
     return os.path.realpath(os.path.expanduser(filename))
 
-@timeit('cas.util.checksum')
+def get_umask():
+    # there's no way to read the umask without setting it
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+def stat_key(filename):
+    """
+    The (device, inode, size, mtime in ns) of a file, which changes
+    whenever its contents are likely to have
+    """
+    st = os.stat(filename)
+    return (st.st_dev, st.st_ino, st.st_size, int(st.st_mtime * 10**9))
+
+def read_blocks(fileobj, block_size=2**20):
+    """
+    Lazily yield everything read from ``fileobj`` in blocks of up to
+    ``block_size`` bytes. Files that support ``readinto`` are read into
+    one reused buffer rather than a new string per block, so each block is
+    then a ``memoryview`` that is only valid until the next one is read.
+    """
+    readinto = getattr(fileobj, 'readinto', None)
+    if readinto is None:
+        while True:
+            data = fileobj.read(block_size)
+            if not data:
+                return
+            yield data
+
+    buf = bytearray(block_size)
+    view = memoryview(buf)
+    while True:
+        size = readinto(buf)
+        if not size:
+            return
+        yield view[:size]
+
+@timeit('cas.util.checksum', 'cas_checksum_seconds')
 def checksum(filename, hash_func=hashlib.sha1, block_size=2**20):
+    with open(filename, 'rb') as fd:
+        return read_checksum(fd, hash_func, block_size)
+
+@timeit('cas.util.copy_checksum')
+def copy_checksum(src, dst, hash_func=hashlib.sha1, block_size=2**20):
+    """
+    Copy ``src`` to ``dst`` (preserving its stat info, like ``shutil.copy2``)
+    and return the checksum of the copied data, reading the source once
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            sum = stream_checksum(fsrc, fdst, hash_func, block_size)
+    shutil.copystat(src, dst)
+    return sum
+
+@timeit('cas.util.stream_checksum', 'cas_checksum_seconds')
+def stream_checksum(fsrc, fdst, hash_func=hashlib.sha1, block_size=2**20):
+    """
+    Copy everything read from the file object ``fsrc`` to the file
+    ``fdst``, returning its checksum
+    """
     sum = hash_func()
-    fd = open(filename)
-    while True:
-        data = fd.read(block_size)
-        if not data:
-            break
+    for data in read_blocks(fsrc, block_size):
         sum.update(data)
+        fdst.write(data)
+        BYTES_HASHED.inc(len(data))
+        BYTES_COPIED.inc(len(data))
     return sum.hexdigest()
+
+def read_checksum(fileobj, hash_func=hashlib.sha1, block_size=2**20, limiter=None):
+    """
+    The checksum of everything read from the file object ``fileobj``,
+    reading no faster than the ``RateLimiter`` ``limiter`` allows
+    """
+    return read_checksums(fileobj, [hash_func], block_size, limiter)[0]
+
+def read_checksums(fileobj, hash_funcs, block_size=2**20, limiter=None):
+    """
+    Like ``read_checksum``, but the checksums of the data under each of
+    ``hash_funcs`` at once
+    """
+    sums = [hash_func() for hash_func in hash_funcs]
+    for data in read_blocks(fileobj, block_size):
+        if limiter is not None:
+            limiter.consume(len(data))
+        for sum in sums:
+            sum.update(data)
+        BYTES_HASHED.inc(len(data))
+    return [sum.hexdigest() for sum in sums]
+
+class RateLimiter(object):
+    """
+    Holds the threads sharing it to ``rate`` bytes per second between them,
+    allowing bursts of up to a second's worth
+    """
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._allowance = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """
+        Account for ``size`` bytes, sleeping until they fit in the rate
+        """
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate,
+              self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            # go into debt rather than waiting for the allowance, so that
+            # later callers wait for earlier ones too
+            self._allowance -= size
+            delay = -self._allowance / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+def hardlink(src, dst):
+    """
+    Make ``dst`` a hard link to ``src``, replacing ``dst`` if it exists
+    """
+    if os.path.lexists(dst):
+        os.remove(dst)
+    os.link(src, dst)
+
+def reflink(src, dst):
+    """
+    Make ``dst`` a copy-on-write clone of ``src`` (btrfs, XFS, ...)
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    shutil.copystat(src, dst)
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+          ctypes.c_void_p, ctypes.c_size_t]
+        _libc.sendfile.restype = ctypes.c_ssize_t
+        if hasattr(_libc, 'copy_file_range'):
+            _libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.c_void_p,
+              ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+            _libc.copy_file_range.restype = ctypes.c_ssize_t
+    return _libc
+
+def _checked(copied):
+    if copied < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    return copied
+
+def _copy_file_range(fdin, fdout, block_size):
+    libc = _get_libc()
+    while _checked(libc.copy_file_range(fdin, None, fdout, None, block_size, 0)):
+        pass
+
+def _sendfile(fdin, fdout, block_size):
+    libc = _get_libc()
+    while _checked(libc.sendfile(fdout, fdin, None, block_size)):
+        pass
+
+def kernel_copy(src, dst, block_size=2**30):
+    """
+    Copy ``src`` to ``dst`` inside the kernel, using ``copy_file_range``
+    where available and ``sendfile`` otherwise, so data never passes
+    through userspace
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                if not hasattr(_get_libc(), 'copy_file_range'):
+                    raise OSError(errno.ENOSYS, 'copy_file_range')
+                _copy_file_range(fsrc.fileno(), fdst.fileno(), block_size)
+            except OSError, e:
+                if e.errno not in (errno.ENOSYS, errno.EXDEV, errno.EINVAL):
+                    raise
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                _sendfile(fsrc.fileno(), fdst.fileno(), block_size)
+    shutil.copystat(src, dst)
+
+def send_range(fdin, fdout, offset, length, block_size=2**30):
+    """
+    Send ``length`` bytes of the file ``fdin`` from ``offset`` to ``fdout``
+    (a file, pipe or socket) inside the kernel with ``sendfile``, returning
+    how many bytes were sent
+    """
+    libc = _get_libc()
+    position = ctypes.c_int64(offset)
+    remaining = length
+    while remaining > 0:
+        sent = _checked(libc.sendfile(fdout, fdin, ctypes.addressof(position),
+          min(remaining, block_size)))
+        if not sent:
+            break
+        remaining -= sent
+    return length - remaining
+
+class RangeReader(object):
+    """
+    A read-only file object over ``length`` bytes of the open file
+    ``fileobj`` from ``offset``
+    """
+    def __init__(self, fileobj, offset, length):
+        self.fileobj = fileobj
+        self.offset = offset
+        self.length = length
+        self.seek(0)
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def read(self, size=-1):
+        remaining = self.length - self._pos
+        if size < 0 or size > remaining:
+            size = remaining
+        data = self.fileobj.read(size)
+        self._pos += len(data)
+        return data
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self.length
+        self._pos = min(max(pos, 0), self.length)
+        self.fileobj.seek(self.offset + self._pos)
+
+    def tell(self):
+        return self._pos
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -11,5 +11,6 @@ setup(
   entry_points="""
     [console_scripts]
     cas=cas.cli:main
+    cas-bench=cas.bench:main
   """,
 )